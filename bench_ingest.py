@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+# vim: ts=4 sw=4 expandtab
+
+# Load generator for the telemetry REST server.
+#
+# Sends synthetic cluster (/report) and device (/device) reports, or
+# replays real reports from the raw archive, at a given concurrency and
+# prints throughput and latency percentiles per endpoint, plus the number
+# of rows that landed in public.report and public.device_report.
+# Replayed reports get new report ids and timestamps, so that they are
+# stored rather than acknowledged as duplicates.
+#
+# Against a running server:
+#   bench_ingest.py --url https://localhost:9000 --dsn "$(cat /opt/telemetry/server.dsn)"
+# In-process, through the Flask app (set TELEMETRY_DSN to a scratch database):
+#   TELEMETRY_DSN="dbname=telemetry_bench" bench_ingest.py --in-process --dsn "dbname=telemetry_bench"
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, join, realpath
+
+import psycopg2
+
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+
+CPU_MODELS = ['Intel(R) Xeon(R) CPU E5-2620 v4 @ 2.10GHz', 'AMD EPYC 7502P 32-Core Processor',
+              'Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz', 'ARMv8 Processor rev 1 (v8l)']
+VERSIONS = ['ceph version 15.2.17 (8a82819d84cf884bd39c17e3236e0632ac146dc4) octopus (stable)',
+            'ceph version 16.2.13 (5378749ba6be3a0868b51803968ee9cde4833a3e) pacific (stable)',
+            'ceph version 17.2.6 (d7ff0d10654d2280e08f1ab989c7cdf3064446a5) quincy (stable)']
+SMART_ATTRS = ['Raw_Read_Error_Rate', 'Spin_Up_Time', 'Start_Stop_Count', 'Reallocated_Sector_Ct',
+               'Seek_Error_Rate', 'Power_On_Hours', 'Spin_Retry_Count', 'Power_Cycle_Count',
+               'Temperature_Celsius', 'Current_Pending_Sector', 'Offline_Uncorrectable', 'UDMA_CRC_Error_Count']
+
+
+class Stamps(object):
+    '''
+    Unique report timestamps, so every generated report is a new row.
+    They are a second apart: device report stamps only have seconds.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ts = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def next(self):
+        with self._lock:
+            self._ts += datetime.timedelta(seconds=1)
+            return self._ts
+
+
+def gen_cluster_report(args, cluster_id, ts):
+    pools = []
+    for i in range(args.pools):
+        pool = {'pool': i, 'pg_num': random.choice([32, 64, 128, 256]), 'pgp_num': 64,
+                'size': 3, 'min_size': 2, 'type': random.choice(['replicated', 'erasure']),
+                'cache_mode': 'none', 'target_max_objects': 0, 'target_max_bytes': 0,
+                'pg_autoscale_mode': 'on'}
+        if pool['type'] == 'erasure':
+            pool['erasure_code_profile'] = {'k': '4', 'm': '2', 'plugin': 'jerasure',
+                                            'technique': 'reed_sol_van', 'crush_failure_domain': 'host'}
+        pools.append(pool)
+
+    metadata = {}
+    for entity in ('osd', 'mon', 'mgr', 'mds'):
+        metadata[entity] = {
+            'cpu': {random.choice(CPU_MODELS): random.randint(1, 100)},
+            'ceph_version': {random.choice(VERSIONS): random.randint(1, 100)},
+            'kernel_version': {f"5.{random.randint(0, args.metadata_cardinality)}.0": 1
+                               for _ in range(random.randint(1, 3))},
+            'distro_description': {f"Distro {random.randint(0, args.metadata_cardinality)}": 1},
+        }
+
+    crashes = []
+    for _ in range(args.crashes):
+        crashes.append({
+            'crash_id': f"{ts.isoformat()}Z_{uuid.uuid4()}",
+            'timestamp': ts.isoformat(),
+            'entity_name': f"osd.{random.randint(0, 99)}",
+            'utsname_hostname': 'node1.example.com',
+            'ceph_version': '16.2.13',
+            'assert_msg': f"/src/osd/PG.cc: In function 'void PG::f()' thread 7f time {ts.isoformat()}\n/src/osd/PG.cc: 42: FAILED ceph_assert(x)\n",
+            'backtrace': [f"(func_{random.randint(0, 50)}()+0x{random.randint(0, 4096):x}) [0x55]" for _ in range(20)],
+        })
+
+    return {
+        'report_id': cluster_id,
+        'report_timestamp': ts.isoformat(),
+        'created': '2020-01-01T00:00:00.000000',
+        'channels': ['basic', 'crash', 'device'],
+        'usage': {'pools': args.pools, 'pg_num': args.pools * 64,
+                  'total_bytes': 10 ** 14, 'total_used_bytes': 10 ** 13},
+        'osd': {'count': random.randint(3, 1000)},
+        'mon': {'count': 3, 'ipv4_addr_mons': 3, 'ipv6_addr_mons': 0, 'v1_addr_mons': 3, 'v2_addr_mons': 3},
+        'fs': {'count': 1},
+        'hosts': {'num': 10},
+        'rbd': {'num_pools': 1, 'num_images_by_pool': [10], 'mirroring_by_pool': [False]},
+        'pools': pools,
+        'metadata': metadata,
+        'crashes': crashes,
+    }
+
+
+def gen_device_report(args, host, ts):
+    report = {}
+    for d in range(args.devices):
+        devid = f"VENDOR_MODEL{d % 4}_{host}{d:03d}"
+        report[devid] = {}
+        for day in range(args.smart_days):
+            stamp = (ts - datetime.timedelta(days=day)).strftime('%Y%m%d-%H%M%S')
+            report[devid][stamp] = {
+                'host_id': host,
+                'device': {'protocol': 'ATA'},
+                'rotation_rate': 7200,
+                'user_capacity': {'bytes': 4 * 10 ** 12},
+                'ata_smart_attributes': {'table': [
+                    {'id': i, 'name': name, 'value': 100, 'worst': 100,
+                     'raw': {'value': random.randint(0, 10000), 'string': '0'}}
+                    for i, name in enumerate(SMART_ATTRS)]},
+            }
+    return report
+
+
+def load_replay(count, directory=None):
+    '''
+    Return up to `count` archived reports (JSON bytes), from the segment
+    archive or from a directory of legacy one-file-per-report files.
+    '''
+    from ceph_telemetry import archive, segments
+    if directory:
+        return [archive.read_file(path) for path in archive.sample_files(directory, count)]
+    return segments.SegmentArchive().sample(count)
+
+
+def as_new_report(data, cluster_id, ts):
+    '''
+    Return an archived report (JSON bytes) as a new upload of cluster_id
+    at ts, with fresh crash ids, so that the server stores it rather
+    than acknowledging it as a duplicate.
+    '''
+    report = json.loads(data)
+    report['report_id'] = cluster_id
+    report['report_timestamp'] = ts.isoformat()
+    crashes = report.get('crashes')
+    if isinstance(crashes, dict):
+        crashes = list(crashes.values())
+    if isinstance(crashes, list):
+        for crash in crashes:
+            if isinstance(crash, dict):
+                crash['crash_id'] = f"{ts.isoformat()}Z_{uuid.uuid4()}"
+        report['crashes'] = crashes
+    return json.dumps(report)
+
+
+def count_rows(dsn):
+    if not dsn:
+        return None
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    counts = {}
+    for table in ('report', 'device_report'):
+        cur.execute(f"SELECT COUNT(*) FROM public.{table}")
+        counts[table] = cur.fetchone()[0]
+    conn.close()
+    return counts
+
+
+def make_sender(args):
+    '''
+    Return send(endpoint, body) -> HTTP status.
+    '''
+    if args.in_process:
+        from ceph_telemetry import create_app
+        client = create_app('bench').test_client()
+
+        def send(endpoint, body):
+            return client.put(endpoint, data=body).status_code
+        return send
+
+    import requests
+    local = threading.local()
+
+    def send(endpoint, body):
+        s = getattr(local, 'session', None)
+        if s is None:
+            s = local.session = requests.Session()
+        return s.put(args.url + endpoint, data=body, verify=not args.insecure).status_code
+    return send
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ceph Telemetry REST server load generator')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='server base URL')
+    target.add_argument('--in-process', action='store_true', help='call the Flask app directly')
+    parser.add_argument('--insecure', action='store_true', help="don't verify the server certificate")
+    parser.add_argument('--dsn', help='database to count written rows in')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='requests to send (default %(default)d)')
+    parser.add_argument('--device-ratio', type=float, default=0.5, help='fraction of requests sent to /device (default %(default)s)')
+    parser.add_argument('--clusters', type=int, default=100, help='distinct cluster ids (default %(default)d)')
+    parser.add_argument('--pools', type=int, default=10)
+    parser.add_argument('--crashes', type=int, default=2, help='crashes per report (default %(default)d)')
+    parser.add_argument('--metadata-cardinality', type=int, default=20, help='distinct metadata values (default %(default)d)')
+    parser.add_argument('--devices', type=int, default=12, help='devices per /device upload (default %(default)d)')
+    parser.add_argument('--smart-days', type=int, default=1, help='SMART scrapes per device per upload (default %(default)d)')
+    parser.add_argument('--replay', action='store_true', help='send reports sampled from the raw archive instead of synthetic ones')
+    parser.add_argument('--replay-dir', help='replay legacy raw report files from this directory')
+    args = parser.parse_args()
+
+    stamps = Stamps()
+    clusters = [str(uuid.uuid4()) for _ in range(args.clusters)]
+    replay = None
+    if args.replay or args.replay_dir:
+        replay = load_replay(args.requests, args.replay_dir)
+    if replay is not None and not replay:
+        print('the raw archive is empty', file=sys.stderr)
+        return 1
+
+    def build(i):
+        if replay is not None:
+            return '/report', as_new_report(replay[i % len(replay)], random.choice(clusters), stamps.next())
+        if random.random() < args.device_ratio:
+            return '/device', json.dumps(gen_device_report(args, random.choice(clusters)[:8], stamps.next()))
+        return '/report', json.dumps(gen_cluster_report(args, random.choice(clusters), stamps.next()))
+
+    # Generate bodies up front so the generator isn't part of the measurement
+    bodies = [build(i) for i in range(args.requests)]
+    send = make_sender(args)
+    latencies = {}
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(item):
+        endpoint, body = item
+        start = time.perf_counter()
+        status = send(endpoint, body)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(endpoint, []).append(elapsed)
+            statuses[(endpoint, status)] = statuses.get((endpoint, status), 0) + 1
+
+    before = count_rows(args.dsn)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, bodies))
+    elapsed = time.perf_counter() - start
+    after = count_rows(args.dsn)
+
+    print(f"{args.requests} requests in {elapsed:.2f} s, concurrency {args.concurrency}: "
+          f"{args.requests / elapsed:.1f} req/s")
+    for endpoint, values in sorted(latencies.items()):
+        nbytes = sum(len(b) for e, b in bodies if e == endpoint)
+        print(f"  {endpoint:8} {len(values):6d} req  {len(values) / elapsed:8.1f} req/s  "
+              f"{nbytes / elapsed / 1e6:7.2f} MB/s  "
+              f"p50 {percentile(values, 50) * 1000:8.1f} ms  p99 {percentile(values, 99) * 1000:8.1f} ms")
+    for (endpoint, status), n in sorted(statuses.items()):
+        print(f"  {endpoint:8} HTTP {status}: {n}")
+    if before is not None:
+        for table in before:
+            print(f"  public.{table}: {after[table] - before[table]} rows written")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,12 @@
 #! /bin/bash
 
-# Deal with spaces in filenames:
-# https://www.reeltoreel.nl/wiki/index.php/Dealing_with_spaces_in_filenames
-# The default value of IFS is " \t\n" (e.g. <space><tab><newline>)
-SAVEIFS=$IFS
-IFS=$(echo -en "\n\b")
-
-path="/opt/telemetry/raw/"
-
-for f in `ls -1 $path | grep -v ".gz"`; do
-  echo $f
-  gzip $path/$f
-done
-
-IFS=$SAVEIFS
+# The REST server appends compressed reports to daily segment files under
+# /opt/telemetry/raw/segments. Pack any per-report files written by older
+# versions of the server into segments as well.
+/opt/telemetry/raw_archive.py pack --delete
+
+# Retrain the compression dictionary once a month, so it follows
+# changes in the report format.
+if [ "$(date +%d)" = "01" ]; then
+  /opt/telemetry/raw_archive.py train
+fi
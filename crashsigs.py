@@ -1,44 +1,16 @@
 #!/usr/bin/env python3
 # vim: ts=4 sw=4 expandtab:
 import argparse
-import hashlib
 import json
 import psycopg2
-import re
 import sys
+from os.path import dirname, join, realpath
 
-conn = None
-
-def sanitize_backtrace(bt):
-    ret = list()
-    for func_record in bt:
-        # split into two fields on last space, take the first one,
-        # strip off leading ( and trailing )
-        func_plus_offset = func_record.rsplit(' ', 1)[0][1:-1]
-        ret.append(func_plus_offset.split('+')[0])
-
-    return ret
-
-def sanitize_assert_msg(msg):
-
-    # (?s) allows matching newline.  get everything up to "thread" and
-    # then after-and-including the last colon-space.  This skips the
-    # thread id, timestamp, and file:lineno, because file is already in
-    # the beginning, and lineno may vary.
-
-    matchexpr = re.compile(r'(?s)(.*) thread .* time .*(: .*)\n')
-    return ''.join(matchexpr.match(msg).groups())
-
-
-
-def calc_sig(bt, assert_msg):
-    sig = hashlib.sha256()
-    for func in sanitize_backtrace(bt):
-        sig.update(func.encode())
-    if assert_msg:
-        sig.update(sanitize_assert_msg(assert_msg).encode())
-    return ''.join('%02x' % c for c in sig.digest())
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import shards
+from ceph_telemetry.crashes import calc_sig
 
+conn = None
 
 def update_crash(cluster_id, report):
     cur = conn.cursor()
@@ -82,7 +54,8 @@ def parse_args():
     
 def load_and_call_update(cid, ts, report):
     try:
-        report = json.loads(report)
+        if isinstance(report, str):
+            report = json.loads(report)
     except TypeError:
         print('cluster %s ts %s has malformed report' % (cid, ts))
         return
@@ -103,31 +76,35 @@ def main():
         password=password
     )
 
-    ccur = conn.cursor()
-    rcur = conn.cursor()
-
-
     args = parse_args()
-    
-    cluster_count = update_count = 0
-    ccur.execute("SELECT DISTINCT cluster_id from report")
-
-    if args.clusters is None:
-        clusters = ccur.fetchall()
-    else:
-        clusters = args.clusters
-    for cid in clusters:
-        if isinstance(cid, tuple):
-            cid = cid[0]
-        if args.all: 
-            rcur.execute("SELECT report_stamp, report FROM report WHERE cluster_id=%s", (cid,))
-            for ts, report in rcur.fetchall():
-                load_and_call_update(cid, ts, report)
+
+    # Reports may be spread over several databases (see
+    # server/ceph_telemetry/shards.py); crashes are in the primary one.
+    shard_conns = shards.connect_all(conn)
+
+    cluster_count = 0
+    for shard_conn in shard_conns.values():
+        ccur = shard_conn.cursor()
+        rcur = shard_conn.cursor()
+        if args.clusters is None:
+            ccur.execute("SELECT DISTINCT cluster_id from report")
+            clusters = ccur.fetchall()
         else:
-            rcur.execute("SELECT report_stamp, report FROM report WHERE cluster_id=%s ORDER BY report_stamp DESC LIMIT 1", (cid,))
-            ts, report = rcur.fetchone()
-            load_and_call_update(cid, ts, report)
-        cluster_count += 1
+            clusters = args.clusters
+        for cid in clusters:
+            if isinstance(cid, tuple):
+                cid = cid[0]
+            if args.all:
+                rcur.execute("SELECT report_stamp, report FROM report WHERE cluster_id=%s", (cid,))
+            else:
+                rcur.execute("SELECT report_stamp, report FROM report WHERE cluster_id=%s ORDER BY report_stamp DESC LIMIT 1", (cid,))
+            rows = rcur.fetchall()
+            if not rows:
+                # the cluster's reports are on another shard
+                continue
+            for ts, report in rows:
+                load_and_call_update(cid, ts, report)
+            cluster_count += 1
 
     print('Processed %d cluster ids' % cluster_count)
     conn.commit()
@@ -13,10 +13,26 @@ GRANT ALL ON ALL TABLES IN SCHEMA grafana TO grafana;
 GRANT ALL ON ALL SEQUENCES IN SCHEMA grafana TO grafana;
 
 
-CREATE TABLE grafana.ts_cluster (
+/*
+  Strings that repeat on every report are stored once, in dimension
+  tables, and referenced by integer keys: cluster ids in ts_cluster_fact,
+  and the entity, attribute and value names in metadata_fact. The
+  importer caches the keys (dbhelper.Dictionary).
+
+  The views grafana.ts_cluster and grafana.metadata show the facts with
+  their strings, as the tables of that name used to; Grafana panels and
+  ad hoc queries read them. The dashboard functions use the fact tables
+  and look the strings up in the (small) dimension tables first.
+*/
+CREATE TABLE grafana.cluster_ids (
+    id                  SERIAL PRIMARY KEY,
+    cluster_id          VARCHAR(50) NOT NULL UNIQUE
+);
+
+CREATE TABLE grafana.ts_cluster_fact (
     report_id           INTEGER REFERENCES public.report(id) PRIMARY KEY,
     ts                  TIMESTAMP,
-    cluster_id          VARCHAR(50),
+    cluster_key         INTEGER REFERENCES grafana.cluster_ids(id),
     created             TIMESTAMP, /* cluster creation date */
     channel_basic       BOOLEAN,
     channel_crash       BOOLEAN,
@@ -37,7 +53,40 @@ CREATE TABLE grafana.ts_cluster (
     pg_num              INTEGER
 );
 
-CREATE INDEX ON grafana.ts_cluster (ts);
+CREATE INDEX ON grafana.ts_cluster_fact (ts);
+CREATE INDEX ON grafana.ts_cluster_fact (cluster_key, ts);
+
+-- LEFT JOINs on the dimensions' primary keys, which Postgres leaves out
+-- of queries that don't use their columns.
+CREATE VIEW grafana.ts_cluster AS
+    SELECT
+        c.report_id,
+        c.ts,
+        k.cluster_id,
+        c.created,
+        c.channel_basic,
+        c.channel_crash,
+        c.channel_device,
+        c.channel_ident,
+        c.total_bytes,
+        c.total_used_bytes,
+        c.osd_count,
+        c.mon_count,
+        c.ipv4_addr_mons,
+        c.ipv6_addr_mons,
+        c.v1_addr_mons,
+        c.v2_addr_mons,
+        c.rbd_num_pools,
+        c.fs_count,
+        c.hosts_num,
+        c.pools_num,
+        c.pg_num
+    FROM
+        grafana.ts_cluster_fact c
+    LEFT JOIN
+        grafana.cluster_ids k
+    ON
+        k.id = c.cluster_key;
 
 /*
   The json report's metadata section:
@@ -50,25 +99,55 @@ CREATE INDEX ON grafana.ts_cluster (ts);
       }
     }
 
-  translates to:
-
-    INSERT INTO metadata (report_id, ts, entity, attr, value, total)
-      VALUES ($report_id, $ts, "osd", "cpu", "Intel(R) Xeon(R) CPU E5-2620 v4 @ 2.10GHz", 90);
+  translates to a row of metadata_fact, with the keys of ("osd", "cpu")
+  in metadata_attrs and of "Intel(R) Xeon(R) CPU E5-2620 v4 @ 2.10GHz"
+  in metadata_values, and a total of 90.
 
   example query - number of different ceph versions per cluster:
 
     SELECT COUNT(DISTINCT(value)) FROM metadata WHERE report_id=$report_id AND attr='ceph_version';
 */
 
-CREATE TABLE grafana.metadata (
-    report_id       INTEGER REFERENCES public.report(id) ON DELETE CASCADE,
+CREATE TABLE grafana.metadata_attrs (
+    id              SERIAL PRIMARY KEY,
+    entity          VARCHAR(16) NOT NULL,
+    attr            VARCHAR(32) NOT NULL,
+    UNIQUE (entity, attr)
+);
+
+CREATE TABLE grafana.metadata_values (
+    id              SERIAL PRIMARY KEY,
+    value           VARCHAR(128) NOT NULL UNIQUE
+);
+
+-- ts first, so that the row has no alignment padding
+CREATE TABLE grafana.metadata_fact (
     ts              TIMESTAMP,
-    entity          VARCHAR(16),
-    attr            VARCHAR(32),
-    value           VARCHAR(128),
+    report_id       INTEGER REFERENCES public.report(id) ON DELETE CASCADE,
+    attr_key        INTEGER REFERENCES grafana.metadata_attrs(id),
+    value_key       INTEGER REFERENCES grafana.metadata_values(id),
     total           INTEGER
 );
 
+CREATE VIEW grafana.metadata AS
+    SELECT
+        m.report_id,
+        m.ts,
+        a.entity,
+        a.attr,
+        v.value,
+        m.total
+    FROM
+        grafana.metadata_fact m
+    LEFT JOIN
+        grafana.metadata_attrs a
+    ON
+        a.id = m.attr_key
+    LEFT JOIN
+        grafana.metadata_values v
+    ON
+        v.id = m.value_key;
+
 CREATE TABLE grafana.rbd_pool (
     report_id       INTEGER REFERENCES public.report(id) ON DELETE CASCADE,
     ts              TIMESTAMP,
@@ -117,42 +196,5 @@ INSERT INTO grafana.version_to_name(version, name)
         ('18', 'Reef'),
         ('Dev', NULL);
 
--- When grafana draws a graph with a resolution of a day, it expects the DB
--- query to return a data point per day. A cluster may report less frequently
--- than once a day, thus the DB query will return a spike on the day that
--- the cluster reports, and a drop on days it doesn't.
--- To normalize this, we create a materialized view that for each day holds
--- a list of all reports that occurred on the previous week - only the most
--- recent report for each cluster within that previous week.
--- We use a materialized view because it's much faster than a regular view.
--- We update the materialized view in import_clusters.py.
-CREATE MATERIALIZED VIEW grafana.weekly_reports_sliding AS
-    SELECT
-        DISTINCT ON(daily_window, cluster_id)
-        daily_window,
-        report_id
-        /*
-        GENERATE_SERIES generates a table with a single column 'daily_window'
-        which holds all the days (a row per day) between the first report
-        and today. Day format is 'YYYY-MM-DD 00:00:00'.
-        */
-    FROM
-        grafana.ts_cluster c,
-        GENERATE_SERIES('2019-03-01', now()::date, interval '1' day) daily_window
-    WHERE
-        c.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
-    -- Include only clusters that reported more than once
-    AND (c.cluster_id IN (
-            SELECT _c.cluster_id
-            FROM grafana.ts_cluster _c
-            GROUP BY _c.cluster_id
-            HAVING count(*) > 1)
-        )
-    ORDER BY
-        daily_window,
-        cluster_id,
-        c.ts DESC;
-
-CREATE INDEX ON grafana.weekly_reports_sliding (daily_window);
-
-ALTER MATERIALIZED VIEW grafana.weekly_reports_sliding OWNER TO grafana;
+-- grafana.weekly_reports_sliding, the reports of the week before each day,
+-- is created by db_create_weekly_reports_sliding.sql.
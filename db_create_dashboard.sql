@@ -43,13 +43,21 @@ CREATE FUNCTION dashboard.minor_versions(
 LANGUAGE SQL SECURITY DEFINER
 AS $$
     SELECT
-        DISTINCT(value)
+        DISTINCT(v.value)
     FROM
-        grafana.metadata
+        grafana.metadata_fact m
+    INNER JOIN
+        grafana.metadata_attrs a
+    ON
+        a.id = m.attr_key
+    INNER JOIN
+        grafana.metadata_values v
+    ON
+        v.id = m.value_key
     WHERE
-            attr='ceph_version_norm'
+            a.attr='ceph_version_norm'
         AND
-            SPLIT_PART(value, '.', '1') = ANY (major);
+            SPLIT_PART(v.value, '.', '1') = ANY (major);
 $$;
 
 /*
@@ -70,7 +78,7 @@ AS $$
 	FROM
         grafana.weekly_reports_sliding w
 	INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
 	WHERE
@@ -110,7 +118,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -143,29 +151,44 @@ AS $$
     weekly_metadata AS (
         SELECT
             daily_window,
-            grafana.metadata.*
+            m.report_id,
+            a.entity,
+            v.value,
+            m.total
         FROM
-            grafana.metadata
+            grafana.metadata_fact m
+        INNER JOIN
+            grafana.metadata_attrs a
+        ON
+            a.id = m.attr_key
+        INNER JOIN
+            grafana.metadata_values v
+        ON
+            v.id = m.value_key
         INNER JOIN
             grafana.WEEKLY_REPORTS_SLIDING w
         ON
-            w.report_id = grafana.metadata.report_id
+            w.report_id = m.report_id
         WHERE
-            attr='ceph_version_norm'
+            a.attr='ceph_version_norm'
     ),
     -- This retrieves total daemons per report (which is of a cluster, per week)
     weekly_cluster_daemons AS (
         SELECT
-            report_id,
-            SUM(total) sum_daemons
+            m.report_id,
+            SUM(m.total) sum_daemons
         FROM
-            grafana.metadata
+            grafana.metadata_fact m
+        INNER JOIN
+            grafana.metadata_attrs a
+        ON
+            a.id = m.attr_key
         WHERE
-                attr='ceph_version_norm'
+                a.attr='ceph_version_norm'
             AND
-                entity = ANY (daemons)
+                a.entity = ANY (daemons)
         GROUP BY
-            report_id
+            m.report_id
     )
     SELECT
         daily_window,
@@ -245,25 +268,33 @@ AS $$
         -- value is metadata.value that holds the version
         CASE
             WHEN display = 'Major'
-            THEN SPLIT_PART(value, '.', 1)
-            ELSE value
+            THEN SPLIT_PART(v.value, '.', 1)
+            ELSE v.value
         END,
-        SUM(total)
+        SUM(m.total)
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.metadata
+        grafana.metadata_fact m
+    ON
+        w.report_id = m.report_id
+    INNER JOIN
+        grafana.metadata_attrs a
+    ON
+        a.id = m.attr_key
+    INNER JOIN
+        grafana.metadata_values v
     ON
-        w.report_id = grafana.metadata.report_id
+        v.id = m.value_key
     WHERE
-            attr='ceph_version_norm'
+            a.attr='ceph_version_norm'
         AND
             w.daily_window BETWEEN time_from AND time_to
         -- and value in ($major/$minor):
         AND
             CASE WHEN display = 'Major'
-                 THEN SPLIT_PART(value, '.', 1)
-                 ELSE value
+                 THEN SPLIT_PART(v.value, '.', 1)
+                 ELSE v.value
             END
             = ANY (
                     CASE WHEN display = 'Major'
@@ -272,7 +303,7 @@ AS $$
                     END
                   )
         AND
-            entity = ANY (daemons)
+            a.entity = ANY (daemons)
     GROUP BY
         w.daily_window, 2
     ORDER BY
@@ -313,7 +344,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -350,7 +381,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -389,7 +420,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -437,7 +468,7 @@ AS $$
         FROM
             grafana.weekly_reports_sliding w
         INNER JOIN
-            grafana.ts_cluster c
+            grafana.ts_cluster_fact c
         ON w.report_id = c.report_id
         WHERE osd_count > 0 -- avoid division by zero;
         -- if osd_count is reported as 0, so are 'total_bytes' and 'total_used_bytes'
@@ -445,8 +476,8 @@ AS $$
     SELECT
         cpo.daily_window,
         CASE WHEN display = 'Major'
-             THEN SPLIT_PART(gm.value, '.', 1)
-             ELSE gm.value
+             THEN SPLIT_PART(v.value, '.', 1)
+             ELSE v.value
         END AS value,
         -- gm.total is the total number of daemons with a certain attribute
         SUM(gm.total * total_bytes_per_osd) AS "total_bytes_by_version", -- total bytes
@@ -456,16 +487,22 @@ AS $$
     FROM
         cpo
     INNER JOIN
-        grafana.metadata gm
+        grafana.metadata_fact gm
     ON cpo.report_id = gm.report_id
+    INNER JOIN
+        grafana.metadata_attrs a
+    ON a.id = gm.attr_key
+    INNER JOIN
+        grafana.metadata_values v
+    ON v.id = gm.value_key
     WHERE
         cpo.daily_window BETWEEN time_from AND time_to
         AND
-            gm.attr = 'ceph_version_norm'
+            a.attr = 'ceph_version_norm'
         AND
             CASE WHEN display='Major'
-                 THEN SPLIT_PART(gm.value, '.', 1)
-                 ELSE gm.value
+                 THEN SPLIT_PART(v.value, '.', 1)
+                 ELSE v.value
             END
               IN
               (SELECT UNNEST(CASE WHEN display='Major'
@@ -474,7 +511,7 @@ AS $$
                              END)
               )
         AND
-            gm.entity = 'osd'
+            a.entity = 'osd'
     GROUP BY 1, 2
     ORDER BY 1; --cpo.daily_window
 $$;
@@ -516,7 +553,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -551,7 +588,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -586,7 +623,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -630,7 +667,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -682,7 +719,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -730,7 +767,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -778,7 +815,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -824,7 +861,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -872,7 +909,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -920,7 +957,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -968,7 +1005,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -1018,7 +1055,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -1068,7 +1105,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -1114,7 +1151,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -1162,7 +1199,7 @@ AS $$
     FROM
         grafana.weekly_reports_sliding w
     INNER JOIN
-        grafana.ts_cluster c
+        grafana.ts_cluster_fact c
     ON
         w.report_id = c.report_id
     WHERE
@@ -1204,9 +1241,10 @@ BEGIN
             '<span>Please enter your cluster ID.'
             '<br><br>You can find it with:&nbsp;&nbsp;''ceph telemetry show | grep report_id''</span>';
 	ELSE
-		SELECT cluster_id INTO cluster_id_res
-			FROM grafana.ts_cluster
-			WHERE cluster_id = uuid
+		SELECT k.cluster_id INTO cluster_id_res
+			FROM grafana.cluster_ids k
+			WHERE k.cluster_id = uuid
+			AND EXISTS (SELECT 1 FROM grafana.ts_cluster_fact c WHERE c.cluster_key = k.id)
 			LIMIT 1;
 		IF cluster_id_res IS NOT NULL
 		THEN
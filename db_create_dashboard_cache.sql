@@ -0,0 +1,33 @@
+/*
+    Result cache of the dashboard functions, served by the REST server
+    at /dashboard/<schema>.<function> (see server/ceph_telemetry/aggregates.py).
+
+    Must be run by the 'grafana' db user, like db_create_dashboard.sql.
+    The importers bump the generation of a schema when they have loaded
+    new data, which invalidates its cached results, and warm the cache
+    with the results of the common panel queries.
+*/
+
+CREATE TABLE dashboard.cache_generation (
+    schema_name TEXT PRIMARY KEY,
+    generation BIGINT NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+INSERT INTO dashboard.cache_generation (schema_name, generation)
+VALUES ('dashboard', 1), ('dashboard_device', 1);
+
+CREATE TABLE dashboard.cache (
+    function TEXT NOT NULL,
+    args TEXT NOT NULL,
+    generation BIGINT NOT NULL,
+    result TEXT NOT NULL,
+    -- time it took to compute the result
+    backend_seconds DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (function, args, generation)
+);
+
+-- The REST server connects as 'telemetry' (schema USAGE is granted in db_create_roles.sql)
+GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA dashboard, dashboard_device TO telemetry;
+GRANT SELECT ON dashboard.cache_generation TO telemetry;
+GRANT SELECT, INSERT ON dashboard.cache TO telemetry;
@@ -84,7 +84,7 @@ CREATE TABLE device.device (
 );
 
 -- Time series table that holds a reference of each device report.
--- Mainly used to create the weekly_reports_sliding materialized view.
+-- Mainly used to compute the weekly_reports_sliding table.
 CREATE TABLE device.ts_device (
     report_id   INTEGER REFERENCES public.device_report(id) NOT NULL PRIMARY KEY,
     device_id   INTEGER NOT NULL REFERENCES device.device(id) ON DELETE CASCADE,
@@ -134,51 +134,8 @@ CREATE TABLE device.smart_nvme_vs (
     attr_val_err    TEXT -- Same as in device.smart_nvme
 );
 
-/*
-When Grafana draws a graph with a resolution of a day, it expects the DB
-query to return a data point per day. A device may report less frequently
-than once a day, thus the DB query will return a spike on the day that
-the device reports, and a drop on days it doesn't.
-To normalize this, we create a materialized view that for each day holds
-a list of all reports that occurred on the previous week - only the most
-recent report for each device within that previous week.
-We use a materialized view because it's much faster than a regular view.
-We update the materialized view in import_devices.py, which creates it
-from scratch with the most recent reports.
-*/
-CREATE MATERIALIZED VIEW device.weekly_reports_sliding AS
-    SELECT
-        DISTINCT ON(daily_window, device_id)
-        daily_window,
-        report_id,
-        device_id,
-        error
-        /*
-        GENERATE_SERIES generates a table with a single column 'daily_window'
-        which holds all the days (a row per day) between the first report
-        and *tomorrow*. Day format is 'YYYY-MM-DD 00:00:00'.
-        */
-    FROM
-        device.ts_device d,
-        GENERATE_SERIES('2019-03-01', now()::date + interval '1' day, interval '1' day) daily_window
-    WHERE
-        d.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
-    -- Include only devices that reported more than once
-    AND (d.device_id IN (
-            SELECT ts_device.device_id
-            FROM device.ts_device
-            GROUP BY ts_device.device_id
-            HAVING count(*) > 1)
-        )
-    ORDER BY
-        daily_window,
-        device_id,
-        d.ts DESC;
-
--- Run this command as user 'postgres', since user 'telemetry' is not part of 'grafana' role.
-ALTER MATERIALIZED VIEW device.weekly_reports_sliding OWNER TO grafana;
-
-GRANT SELECT ON device.weekly_reports_sliding TO grafana_ro;
+-- device.weekly_reports_sliding, the reports of the week before each day,
+-- is created by db_create_weekly_reports_sliding.sql.
 
 -- Holds (vendor, model) mappings results - for debugging purposes only.
 -- It can be removed at some point.
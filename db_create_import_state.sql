@@ -0,0 +1,54 @@
+/*
+    Progress and failures of import_clusters.py and import_devices.py.
+
+    Run as 'postgres' after db_create_cluster.sql and db_create_device.sql,
+    also on existing databases:
+
+    psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U postgres telemetry < db_create_import_state.sql
+
+    import_checkpoint holds the last report id processed, per shard that
+    assigned it (see server/ceph_telemetry/shards.py; -1 when there are no
+    shards). It is updated in the transaction that imports the reports, so
+    an interrupted run resumes where the last commit left off. Before the
+    first checkpoint the importers start after the highest report id in
+    grafana.ts_cluster_fact or device.ts_device.
+
+    import_quarantine holds the reports that failed to import, with the
+    exception. They are skipped until the importer runs with
+    --retry-quarantined, which removes the ones that import this time:
+
+    SELECT report_id, quarantined, error FROM grafana.import_quarantine ORDER BY report_id;
+*/
+
+CREATE TABLE IF NOT EXISTS grafana.import_checkpoint (
+    shard       INTEGER PRIMARY KEY,
+    last_id     INTEGER NOT NULL,
+    updated     TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS grafana.import_quarantine (
+    report_id   INTEGER PRIMARY KEY,
+    error       TEXT,
+    quarantined TIMESTAMP NOT NULL DEFAULT now()
+);
+
+ALTER TABLE grafana.import_checkpoint OWNER TO grafana;
+ALTER TABLE grafana.import_quarantine OWNER TO grafana;
+
+CREATE TABLE IF NOT EXISTS device.import_checkpoint (
+    shard       INTEGER PRIMARY KEY,
+    last_id     INTEGER NOT NULL,
+    updated     TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS device.import_quarantine (
+    report_id   INTEGER PRIMARY KEY,
+    error       TEXT,
+    quarantined TIMESTAMP NOT NULL DEFAULT now()
+);
+
+ALTER TABLE device.import_checkpoint OWNER TO grafana;
+ALTER TABLE device.import_quarantine OWNER TO grafana;
+
+GRANT SELECT ON grafana.import_checkpoint, grafana.import_quarantine,
+                device.import_checkpoint, device.import_quarantine TO grafana_ro;
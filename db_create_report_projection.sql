@@ -0,0 +1,26 @@
+/*
+report_project(report, path, ...) returns only the given paths of a
+report, as one jsonb object keyed by path, so that panels and scripts
+that show a few keys don't have to fetch the whole report:
+
+    SELECT report_project(report, 'osd.count', 'pools[*].pg_num', 'crashes[*].crash_id')
+    FROM public.report
+    WHERE id = $id;
+
+Paths use the syntax of the REST server's
+/report/<cluster_id>/<report_stamp>?path=... endpoint, with keys made of
+letters, digits and underscores.  A path with [*] yields an array of
+every match; other paths yield the value, or null.
+*/
+CREATE OR REPLACE FUNCTION public.report_project(report JSONB, VARIADIC paths TEXT[])
+RETURNS JSONB
+LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT jsonb_object_agg(
+        p,
+        CASE WHEN strpos(p, '[*]') > 0
+            THEN jsonb_path_query_array(report, ('strict $.' || p)::jsonpath, '{}', true)
+            ELSE jsonb_path_query_first(report, ('strict $.' || p)::jsonpath, '{}', true)
+        END)
+    FROM unnest(paths) AS p
+$$;
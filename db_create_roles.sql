@@ -2,7 +2,7 @@
 --CREATE USER grafana_ro WITH PASSWORD '<PASSWORD>';
 
 -- This command must be run as user 'postgres', since user 'telemetry' is not part of 'grafana' role
-ALTER MATERIALIZED VIEW device.weekly_reports_sliding OWNER TO grafana;
+ALTER TABLE device.weekly_reports_sliding OWNER TO grafana;
 
 GRANT USAGE ON SCHEMA grafana TO grafana, grafana_ro;
 GRANT ALL ON ALL TABLES IN SCHEMA grafana TO grafana; -- "ALL TABLES" includes views
@@ -64,6 +64,8 @@ REVOKE CONNECT ON DATABASE postgres FROM PUBLIC;
 CREATE SCHEMA IF NOT EXISTS dashboard_device;
 
 GRANT USAGE ON SCHEMA dashboard_device TO dashboard, grafana, grafana_ro;
+-- the REST server caches dashboard results, see db_create_dashboard_cache.sql
+GRANT USAGE ON SCHEMA dashboard, dashboard_device TO telemetry;
 GRANT CREATE ON SCHEMA dashboard_device TO grafana;
 GRANT ALL ON ALL TABLES IN SCHEMA dashboard_device TO grafana;
 GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA dashboard_device TO dashboard, grafana_ro;
@@ -0,0 +1,316 @@
+/*
+    The weekly_reports_sliding tables of the grafana and device schemas.
+
+    Run as 'postgres' after db_create_cluster.sql and db_create_device.sql:
+
+    psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U postgres telemetry < db_create_weekly_reports_sliding.sql
+
+    They used to be materialized views refreshed in full by the importers;
+    on such a database this replaces the views. The tables are (re)created
+    and filled from scratch, in one transaction, so this can be run again,
+    for example after db_migrate_dimension_tables.sql. The dashboard
+    functions and panels read them by name and need no changes.
+*/
+
+BEGIN;
+
+DROP MATERIALIZED VIEW IF EXISTS grafana.weekly_reports_sliding;
+DROP MATERIALIZED VIEW IF EXISTS device.weekly_reports_sliding;
+DROP TABLE IF EXISTS grafana.weekly_reports_sliding;
+DROP TABLE IF EXISTS device.weekly_reports_sliding;
+DROP FUNCTION IF EXISTS grafana.weekly_reports_sliding_full();
+DROP FUNCTION IF EXISTS grafana.update_weekly_reports_sliding(INTEGER[]);
+DROP FUNCTION IF EXISTS device.weekly_reports_sliding_full();
+DROP FUNCTION IF EXISTS device.update_weekly_reports_sliding(INTEGER[]);
+
+-- When grafana draws a graph with a resolution of a day, it expects the DB
+-- query to return a data point per day. A cluster may report less frequently
+-- than once a day, thus the DB query will return a spike on the day that
+-- the cluster reports, and a drop on days it doesn't.
+-- To normalize this, we keep a table that for each day holds a list of all
+-- reports that occurred on the previous week - only the most recent report
+-- for each cluster within that previous week.
+-- import_clusters.py updates it with grafana.update_weekly_reports_sliding(),
+-- which recomputes only the windows that the newly imported reports fall in.
+-- grafana.weekly_reports_sliding_full() computes the whole table from
+-- scratch; verify_weekly_reports_sliding.py compares the two. Reports
+-- with the same timestamp are told apart by their id.
+CREATE TABLE grafana.weekly_reports_sliding (
+    daily_window    TIMESTAMPTZ NOT NULL,
+    report_id       INTEGER NOT NULL REFERENCES grafana.ts_cluster_fact(report_id) ON DELETE CASCADE
+);
+
+CREATE INDEX ON grafana.weekly_reports_sliding (daily_window);
+CREATE INDEX ON grafana.weekly_reports_sliding (report_id);
+
+CREATE FUNCTION grafana.weekly_reports_sliding_full()
+    RETURNS TABLE (daily_window TIMESTAMPTZ, report_id INTEGER)
+LANGUAGE SQL STABLE
+AS $$
+    SELECT
+        DISTINCT ON(daily_window, cluster_key)
+        daily_window,
+        report_id
+        /*
+        GENERATE_SERIES generates a table with a single column 'daily_window'
+        which holds all the days (a row per day) between the first report
+        and today. Day format is 'YYYY-MM-DD 00:00:00'.
+        */
+    FROM
+        grafana.ts_cluster_fact c,
+        GENERATE_SERIES('2019-03-01', now()::date, interval '1' day) daily_window
+    WHERE
+        c.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
+    -- Include only clusters that reported more than once
+    AND (c.cluster_key IN (
+            SELECT _c.cluster_key
+            FROM grafana.ts_cluster_fact _c
+            GROUP BY _c.cluster_key
+            HAVING count(*) > 1)
+        )
+    ORDER BY
+        daily_window,
+        cluster_key,
+        c.ts DESC,
+        c.report_id DESC;
+$$;
+
+/*
+  Recompute the windows of the clusters of report_ids from the day before
+  their earliest new report, and add the days since the last update for
+  every cluster that reported in the week before. A cluster that had no
+  windows yet (it reported once) is recomputed from the start. An empty
+  table is filled from scratch. Returns the number of rows written.
+
+    SELECT grafana.update_weekly_reports_sliding(ARRAY[<new report ids>]);
+*/
+CREATE FUNCTION grafana.update_weekly_reports_sliding(report_ids INTEGER[])
+    RETURNS BIGINT
+LANGUAGE SQL
+AS $$
+    WITH last AS (
+        SELECT MAX(daily_window) AS daily_window FROM grafana.weekly_reports_sliding
+    ),
+    touched AS (
+        SELECT cluster_key, MIN(since) AS since
+        FROM (
+            SELECT c.cluster_key, c.ts::date - 1 AS since
+            FROM grafana.ts_cluster_fact c
+            WHERE c.report_id = ANY(report_ids)
+            UNION ALL
+            SELECT c.cluster_key, COALESCE(last.daily_window::date + 1, '2019-03-01'::date)
+            FROM grafana.ts_cluster_fact c, last
+            WHERE c.ts >= COALESCE(last.daily_window - interval '8' day, '-infinity')
+        ) t
+        WHERE cluster_key IS NOT NULL
+        GROUP BY cluster_key
+    ),
+    scope AS (
+        SELECT
+            t.cluster_key,
+            CASE WHEN EXISTS (
+                    SELECT 1
+                    FROM grafana.ts_cluster_fact c
+                    INNER JOIN grafana.weekly_reports_sliding w ON w.report_id = c.report_id
+                    WHERE c.cluster_key = t.cluster_key)
+                THEN t.since
+                ELSE '2019-03-01'::date
+            END AS since
+        FROM touched t
+        -- Include only clusters that reported more than once
+        WHERE (SELECT count(*) FROM grafana.ts_cluster_fact c WHERE c.cluster_key = t.cluster_key) > 1
+    ),
+    deleted AS (
+        DELETE FROM grafana.weekly_reports_sliding w
+        USING grafana.ts_cluster_fact c, scope s
+        WHERE w.report_id = c.report_id
+        AND c.cluster_key = s.cluster_key
+        AND w.daily_window >= s.since
+    ),
+    inserted AS (
+        INSERT INTO grafana.weekly_reports_sliding (daily_window, report_id)
+        SELECT
+            DISTINCT ON(daily_window, c.cluster_key)
+            daily_window,
+            c.report_id
+        FROM
+            scope s
+        INNER JOIN
+            grafana.ts_cluster_fact c
+        ON
+            c.cluster_key = s.cluster_key AND c.ts >= s.since - interval '8' day
+        CROSS JOIN LATERAL
+            -- the days around each report, rather than all of them
+            GENERATE_SERIES(GREATEST(s.since, c.ts::date - 1, '2019-03-01'::date),
+                            LEAST(now()::date, c.ts::date + 8),
+                            interval '1' day) daily_window
+        WHERE
+            c.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
+        ORDER BY
+            daily_window,
+            c.cluster_key,
+            c.ts DESC,
+            c.report_id DESC
+        RETURNING 1
+    )
+    SELECT count(*) FROM inserted;
+$$;
+
+ALTER TABLE grafana.weekly_reports_sliding OWNER TO grafana;
+ALTER FUNCTION grafana.weekly_reports_sliding_full() OWNER TO grafana;
+ALTER FUNCTION grafana.update_weekly_reports_sliding(INTEGER[]) OWNER TO grafana;
+
+GRANT SELECT ON grafana.weekly_reports_sliding TO grafana_ro;
+
+/*
+When Grafana draws a graph with a resolution of a day, it expects the DB
+query to return a data point per day. A device may report less frequently
+than once a day, thus the DB query will return a spike on the day that
+the device reports, and a drop on days it doesn't.
+To normalize this, we keep a table that for each day holds a list of all
+reports that occurred on the previous week - only the most recent report
+for each device within that previous week.
+import_devices.py updates it with device.update_weekly_reports_sliding(),
+which recomputes only the windows that the newly imported reports fall in.
+device.weekly_reports_sliding_full() computes the whole table from scratch;
+verify_weekly_reports_sliding.py compares the two. Reports with the same
+timestamp are told apart by their id.
+*/
+CREATE TABLE device.weekly_reports_sliding (
+    daily_window    TIMESTAMP NOT NULL,
+    report_id       INTEGER NOT NULL REFERENCES device.ts_device(report_id) ON DELETE CASCADE,
+    device_id       INTEGER NOT NULL,
+    error           TEXT
+);
+
+CREATE INDEX ON device.weekly_reports_sliding (daily_window);
+CREATE INDEX ON device.weekly_reports_sliding (device_id, daily_window);
+
+CREATE FUNCTION device.weekly_reports_sliding_full()
+    RETURNS TABLE (daily_window TIMESTAMP, report_id INTEGER, device_id INTEGER, error TEXT)
+LANGUAGE SQL STABLE
+AS $$
+    SELECT
+        DISTINCT ON(daily_window, device_id)
+        daily_window,
+        report_id,
+        device_id,
+        error
+        /*
+        GENERATE_SERIES generates a table with a single column 'daily_window'
+        which holds all the days (a row per day) between the first report
+        and *tomorrow*. Day format is 'YYYY-MM-DD 00:00:00'.
+        */
+    FROM
+        device.ts_device d,
+        GENERATE_SERIES('2019-03-01', now()::date + interval '1' day, interval '1' day) daily_window
+    WHERE
+        d.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
+    -- Include only devices that reported more than once
+    AND (d.device_id IN (
+            SELECT ts_device.device_id
+            FROM device.ts_device
+            GROUP BY ts_device.device_id
+            HAVING count(*) > 1)
+        )
+    ORDER BY
+        daily_window,
+        device_id,
+        d.ts DESC,
+        d.report_id DESC;
+$$;
+
+/*
+Recompute the windows of the devices of report_ids from the day before
+their earliest new report, and add the days since the last update for
+every device that reported in the week before. A device that had no
+windows yet (it reported once) is recomputed from the start. An empty
+table is filled from scratch. Returns the number of rows written.
+
+    SELECT device.update_weekly_reports_sliding(ARRAY[<new report ids>]);
+*/
+CREATE FUNCTION device.update_weekly_reports_sliding(report_ids INTEGER[])
+    RETURNS BIGINT
+LANGUAGE SQL
+AS $$
+    WITH last AS (
+        SELECT MAX(daily_window) AS daily_window FROM device.weekly_reports_sliding
+    ),
+    touched AS (
+        SELECT device_id, MIN(since) AS since
+        FROM (
+            SELECT d.device_id, d.ts::date - 1 AS since
+            FROM device.ts_device d
+            WHERE d.report_id = ANY(report_ids)
+            UNION ALL
+            SELECT d.device_id, COALESCE(last.daily_window::date + 1, '2019-03-01'::date)
+            FROM device.ts_device d, last
+            WHERE d.ts >= COALESCE(last.daily_window - interval '8' day, '-infinity')
+        ) t
+        GROUP BY device_id
+    ),
+    scope AS (
+        SELECT
+            t.device_id,
+            CASE WHEN EXISTS (
+                    SELECT 1
+                    FROM device.weekly_reports_sliding w
+                    WHERE w.device_id = t.device_id)
+                THEN t.since
+                ELSE '2019-03-01'::date
+            END AS since
+        FROM touched t
+        -- Include only devices that reported more than once
+        WHERE (SELECT count(*) FROM device.ts_device d WHERE d.device_id = t.device_id) > 1
+    ),
+    deleted AS (
+        DELETE FROM device.weekly_reports_sliding w
+        USING scope s
+        WHERE w.device_id = s.device_id
+        AND w.daily_window >= s.since
+    ),
+    inserted AS (
+        INSERT INTO device.weekly_reports_sliding (daily_window, report_id, device_id, error)
+        SELECT
+            DISTINCT ON(daily_window, d.device_id)
+            daily_window,
+            d.report_id,
+            d.device_id,
+            d.error
+        FROM
+            scope s
+        INNER JOIN
+            device.ts_device d
+        ON
+            d.device_id = s.device_id AND d.ts >= s.since - interval '8' day
+        CROSS JOIN LATERAL
+            -- the days around each report, rather than all of them
+            GENERATE_SERIES(GREATEST(s.since, d.ts::date - 1, '2019-03-01'::date)::timestamp,
+                            LEAST(now()::date + interval '1' day, d.ts::date + 8),
+                            interval '1' day) daily_window
+        WHERE
+            d.ts BETWEEN daily_window - interval '7' day AND daily_window + interval '1' day
+        ORDER BY
+            daily_window,
+            d.device_id,
+            d.ts DESC,
+            d.report_id DESC
+        RETURNING 1
+    )
+    SELECT count(*) FROM inserted;
+$$;
+
+ALTER TABLE device.weekly_reports_sliding OWNER TO grafana;
+ALTER FUNCTION device.weekly_reports_sliding_full() OWNER TO grafana;
+ALTER FUNCTION device.update_weekly_reports_sliding(INTEGER[]) OWNER TO grafana;
+
+GRANT SELECT ON device.weekly_reports_sliding TO grafana_ro;
+
+-- Fill the tables when there are reports already
+SELECT grafana.update_weekly_reports_sliding('{}');
+SELECT device.update_weekly_reports_sliding('{}');
+
+COMMIT;
+
+ANALYZE grafana.weekly_reports_sliding;
+ANALYZE device.weekly_reports_sliding;
@@ -0,0 +1,140 @@
+/*
+    Compare the size and query times of grafana.ts_cluster and
+    grafana.metadata before and after db_migrate_dimension_tables.sql,
+    then drop the old tables.
+
+    Run as 'postgres' after the migration, before the importers add
+    reports to the new tables only:
+
+    psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U postgres telemetry < db_measure_dimension_tables.sql
+
+    Run it with -v keep=1 to keep the old tables, e.g. to measure again.
+*/
+
+VACUUM ANALYZE grafana.ts_cluster_before_dimensions, grafana.metadata_before_dimensions,
+               grafana.cluster_ids, grafana.ts_cluster_fact,
+               grafana.metadata_attrs, grafana.metadata_values, grafana.metadata_fact;
+
+-- Table and index sizes
+SELECT
+    layout,
+    relname,
+    pg_size_pretty(pg_table_size(oid)) AS table_size,
+    pg_size_pretty(pg_indexes_size(oid)) AS indexes_size,
+    pg_size_pretty(pg_total_relation_size(oid)) AS total_size,
+    pg_total_relation_size(oid) AS total_bytes
+FROM (
+    SELECT 'before' AS layout, c.oid, c.relname
+    FROM pg_class c
+    WHERE c.oid IN ('grafana.ts_cluster_before_dimensions'::regclass,
+                    'grafana.metadata_before_dimensions'::regclass)
+    UNION ALL
+    SELECT 'after', c.oid, c.relname
+    FROM pg_class c
+    WHERE c.oid IN ('grafana.cluster_ids'::regclass,
+                    'grafana.ts_cluster_fact'::regclass,
+                    'grafana.metadata_attrs'::regclass,
+                    'grafana.metadata_values'::regclass,
+                    'grafana.metadata_fact'::regclass)
+) r
+ORDER BY layout DESC, relname;
+
+\timing on
+
+-- Version by daemon count, as in dashboard.version_by_daemon_count()
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT
+    w.daily_window,
+    SPLIT_PART(m.value, '.', 1),
+    SUM(m.total)
+FROM
+    grafana.weekly_reports_sliding w
+INNER JOIN
+    grafana.metadata_before_dimensions m
+ON
+    w.report_id = m.report_id
+WHERE
+        m.attr = 'ceph_version_norm'
+    AND
+        m.entity = ANY (ARRAY['osd', 'mon'])
+GROUP BY 1, 2;
+
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT
+    w.daily_window,
+    SPLIT_PART(v.value, '.', 1),
+    SUM(m.total)
+FROM
+    grafana.weekly_reports_sliding w
+INNER JOIN
+    grafana.metadata_fact m
+ON
+    w.report_id = m.report_id
+INNER JOIN
+    grafana.metadata_attrs a
+ON
+    a.id = m.attr_key
+INNER JOIN
+    grafana.metadata_values v
+ON
+    v.id = m.value_key
+WHERE
+        a.attr = 'ceph_version_norm'
+    AND
+        a.entity = ANY (ARRAY['osd', 'mon'])
+GROUP BY 1, 2;
+
+-- Minor versions, as in dashboard.minor_versions()
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT DISTINCT(value)
+FROM grafana.metadata_before_dimensions
+WHERE attr = 'ceph_version_norm';
+
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT DISTINCT(v.value)
+FROM
+    grafana.metadata_fact m
+INNER JOIN
+    grafana.metadata_attrs a
+ON
+    a.id = m.attr_key
+INNER JOIN
+    grafana.metadata_values v
+ON
+    v.id = m.value_key
+WHERE a.attr = 'ceph_version_norm';
+
+-- Clusters by reports count, through the grafana.ts_cluster view
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT cluster_id, count(*)
+FROM grafana.ts_cluster_before_dimensions
+GROUP BY cluster_id;
+
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT cluster_id, count(*)
+FROM grafana.ts_cluster
+GROUP BY cluster_id;
+
+-- Cluster x-ray, as in dashboard.get_ts_cluster()
+SELECT cluster_id AS sample_cluster_id
+FROM grafana.cluster_ids
+ORDER BY id DESC
+LIMIT 1 \gset
+
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT *
+FROM grafana.ts_cluster_before_dimensions
+WHERE cluster_id = :'sample_cluster_id';
+
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT *
+FROM grafana.ts_cluster
+WHERE cluster_id = :'sample_cluster_id';
+
+\timing off
+
+\if :{?keep}
+\else
+DROP TABLE grafana.ts_cluster_before_dimensions;
+DROP TABLE grafana.metadata_before_dimensions;
+\endif
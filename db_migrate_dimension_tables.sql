@@ -0,0 +1,239 @@
+/*
+    Move grafana.ts_cluster and grafana.metadata to the dimension and fact
+    tables of db_create_cluster.sql, on a database created before them.
+
+    Run as 'postgres' while the importers are stopped; it rewrites both
+    tables, in one transaction:
+
+    psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U postgres telemetry < db_migrate_dimension_tables.sql
+
+    then recreate the weekly_reports_sliding functions and the dashboard
+    functions, which now read the fact tables:
+
+    psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U postgres telemetry < db_create_weekly_reports_sliding.sql
+    sed 's/^CREATE FUNCTION/CREATE OR REPLACE FUNCTION/' db_create_dashboard.sql | psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U grafana telemetry
+
+    The old tables are kept as grafana.ts_cluster_before_dimensions and
+    grafana.metadata_before_dimensions, to compare with the new layout
+    (db_measure_dimension_tables.sql, which drops them at the end).
+*/
+
+BEGIN;
+
+ALTER TABLE grafana.ts_cluster RENAME TO ts_cluster_before_dimensions;
+ALTER TABLE grafana.metadata RENAME TO metadata_before_dimensions;
+
+-- Returns SETOF grafana.ts_cluster, which is about to change type; the
+-- dashboard functions above create it again.
+DROP FUNCTION IF EXISTS dashboard.get_ts_cluster(TIMESTAMP WITH TIME ZONE, TIMESTAMP WITH TIME ZONE, TEXT);
+
+CREATE TABLE grafana.cluster_ids (
+    id                  SERIAL PRIMARY KEY,
+    cluster_id          VARCHAR(50) NOT NULL UNIQUE
+);
+
+-- The reference to public.report is added below, unless the database is
+-- sharded (see db_shard_setup.sql).
+CREATE TABLE grafana.ts_cluster_fact (
+    report_id           INTEGER PRIMARY KEY,
+    ts                  TIMESTAMP,
+    cluster_key         INTEGER REFERENCES grafana.cluster_ids(id),
+    created             TIMESTAMP, /* cluster creation date */
+    channel_basic       BOOLEAN,
+    channel_crash       BOOLEAN,
+    channel_device      BOOLEAN,
+    channel_ident       BOOLEAN,
+    total_bytes         BIGINT,
+    total_used_bytes    BIGINT,
+    osd_count           INTEGER,
+    mon_count           INTEGER,
+    ipv4_addr_mons      INTEGER,
+    ipv6_addr_mons      INTEGER,
+    v1_addr_mons        INTEGER,
+    v2_addr_mons        INTEGER,
+    rbd_num_pools       INTEGER,
+    fs_count            INTEGER,
+    hosts_num           INTEGER,
+    pools_num           INTEGER,
+    pg_num              INTEGER
+);
+
+CREATE TABLE grafana.metadata_attrs (
+    id              SERIAL PRIMARY KEY,
+    entity          VARCHAR(16) NOT NULL,
+    attr            VARCHAR(32) NOT NULL,
+    UNIQUE (entity, attr)
+);
+
+CREATE TABLE grafana.metadata_values (
+    id              SERIAL PRIMARY KEY,
+    value           VARCHAR(128) NOT NULL UNIQUE
+);
+
+CREATE TABLE grafana.metadata_fact (
+    ts              TIMESTAMP,
+    report_id       INTEGER,
+    attr_key        INTEGER REFERENCES grafana.metadata_attrs(id),
+    value_key       INTEGER REFERENCES grafana.metadata_values(id),
+    total           INTEGER
+);
+
+INSERT INTO grafana.cluster_ids (cluster_id)
+    SELECT DISTINCT cluster_id
+    FROM grafana.ts_cluster_before_dimensions
+    WHERE cluster_id IS NOT NULL
+    ORDER BY 1;
+
+INSERT INTO grafana.ts_cluster_fact
+    SELECT
+        c.report_id,
+        c.ts,
+        k.id,
+        c.created,
+        c.channel_basic,
+        c.channel_crash,
+        c.channel_device,
+        c.channel_ident,
+        c.total_bytes,
+        c.total_used_bytes,
+        c.osd_count,
+        c.mon_count,
+        c.ipv4_addr_mons,
+        c.ipv6_addr_mons,
+        c.v1_addr_mons,
+        c.v2_addr_mons,
+        c.rbd_num_pools,
+        c.fs_count,
+        c.hosts_num,
+        c.pools_num,
+        c.pg_num
+    FROM
+        grafana.ts_cluster_before_dimensions c
+    LEFT JOIN
+        grafana.cluster_ids k
+    ON
+        k.cluster_id = c.cluster_id
+    ORDER BY
+        c.report_id;
+
+INSERT INTO grafana.metadata_attrs (entity, attr)
+    SELECT DISTINCT entity, attr
+    FROM grafana.metadata_before_dimensions
+    WHERE entity IS NOT NULL AND attr IS NOT NULL
+    ORDER BY 1, 2;
+
+INSERT INTO grafana.metadata_values (value)
+    SELECT DISTINCT value
+    FROM grafana.metadata_before_dimensions
+    WHERE value IS NOT NULL
+    ORDER BY 1;
+
+INSERT INTO grafana.metadata_fact (ts, report_id, attr_key, value_key, total)
+    SELECT
+        m.ts,
+        m.report_id,
+        a.id,
+        v.id,
+        m.total
+    FROM
+        grafana.metadata_before_dimensions m
+    LEFT JOIN
+        grafana.metadata_attrs a
+    ON
+        a.entity = m.entity AND a.attr = m.attr
+    LEFT JOIN
+        grafana.metadata_values v
+    ON
+        v.value = m.value
+    ORDER BY
+        m.report_id;
+
+CREATE INDEX ON grafana.ts_cluster_fact (ts);
+CREATE INDEX ON grafana.ts_cluster_fact (cluster_key, ts);
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ts_cluster_report_id_fkey') THEN
+        ALTER TABLE grafana.ts_cluster_fact
+            ADD CONSTRAINT ts_cluster_fact_report_id_fkey
+            FOREIGN KEY (report_id) REFERENCES public.report(id);
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'metadata_report_id_fkey') THEN
+        ALTER TABLE grafana.metadata_fact
+            ADD CONSTRAINT metadata_fact_report_id_fkey
+            FOREIGN KEY (report_id) REFERENCES public.report(id) ON DELETE CASCADE;
+    END IF;
+END
+$$;
+
+ALTER TABLE grafana.weekly_reports_sliding
+    DROP CONSTRAINT IF EXISTS weekly_reports_sliding_report_id_fkey;
+ALTER TABLE grafana.weekly_reports_sliding
+    ADD CONSTRAINT weekly_reports_sliding_report_id_fkey
+    FOREIGN KEY (report_id) REFERENCES grafana.ts_cluster_fact(report_id) ON DELETE CASCADE;
+
+CREATE VIEW grafana.ts_cluster AS
+    SELECT
+        c.report_id,
+        c.ts,
+        k.cluster_id,
+        c.created,
+        c.channel_basic,
+        c.channel_crash,
+        c.channel_device,
+        c.channel_ident,
+        c.total_bytes,
+        c.total_used_bytes,
+        c.osd_count,
+        c.mon_count,
+        c.ipv4_addr_mons,
+        c.ipv6_addr_mons,
+        c.v1_addr_mons,
+        c.v2_addr_mons,
+        c.rbd_num_pools,
+        c.fs_count,
+        c.hosts_num,
+        c.pools_num,
+        c.pg_num
+    FROM
+        grafana.ts_cluster_fact c
+    LEFT JOIN
+        grafana.cluster_ids k
+    ON
+        k.id = c.cluster_key;
+
+CREATE VIEW grafana.metadata AS
+    SELECT
+        m.report_id,
+        m.ts,
+        a.entity,
+        a.attr,
+        v.value,
+        m.total
+    FROM
+        grafana.metadata_fact m
+    LEFT JOIN
+        grafana.metadata_attrs a
+    ON
+        a.id = m.attr_key
+    LEFT JOIN
+        grafana.metadata_values v
+    ON
+        v.id = m.value_key;
+
+ALTER TABLE grafana.cluster_ids OWNER TO grafana;
+ALTER TABLE grafana.ts_cluster_fact OWNER TO grafana;
+ALTER TABLE grafana.metadata_attrs OWNER TO grafana;
+ALTER TABLE grafana.metadata_values OWNER TO grafana;
+ALTER TABLE grafana.metadata_fact OWNER TO grafana;
+ALTER VIEW grafana.ts_cluster OWNER TO grafana;
+ALTER VIEW grafana.metadata OWNER TO grafana;
+
+GRANT SELECT ON grafana.cluster_ids, grafana.ts_cluster_fact, grafana.metadata_attrs,
+                grafana.metadata_values, grafana.metadata_fact,
+                grafana.ts_cluster, grafana.metadata TO grafana_ro;
+
+COMMIT;
+
+ANALYZE grafana.cluster_ids, grafana.ts_cluster_fact,
+        grafana.metadata_attrs, grafana.metadata_values, grafana.metadata_fact;
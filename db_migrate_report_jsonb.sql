@@ -0,0 +1,26 @@
+-- Convert public.report.report from TEXT to JSONB and add the extracted
+-- organization and channels columns (see tables.txt).
+--
+-- Rewrites the whole table; run it while the importers are stopped:
+--   psql -v ON_ERROR_STOP=1 -b -h 127.0.0.1 -U telemetry telemetry < db_migrate_report_jsonb.sql
+--
+-- Postgres can't store NUL in jsonb, so \u0000 escapes (found in some
+-- crash assert messages) are replaced with spaces, as the server now
+-- does at ingest.
+
+BEGIN;
+
+ALTER TABLE public.report
+    ALTER COLUMN report TYPE JSONB USING replace(report, '\u0000', ' ')::jsonb;
+
+ALTER TABLE public.report
+    ADD COLUMN organization TEXT GENERATED ALWAYS AS (report->>'organization') STORED,
+    ADD COLUMN channels JSONB GENERATED ALWAYS AS (report->'channels') STORED;
+
+CREATE INDEX report_id_not_qa ON public.report (id) WHERE organization IS DISTINCT FROM 'ceph-qa';
+CREATE INDEX report_organization ON public.report (organization);
+CREATE INDEX report_channels ON public.report USING GIN (channels);
+
+COMMIT;
+
+ANALYZE public.report;
@@ -0,0 +1,43 @@
+/*
+    Prepare a database to be shard number :shard of public.report and
+    public.device_report (see server/ceph_telemetry/shards.py).
+
+    Run as 'postgres' on every shard, after tables.txt, including the
+    existing database when it becomes shard 0:
+
+    psql -v ON_ERROR_STOP=1 -v shard=1 -v first_id=<id> -U postgres telemetry < db_shard_setup.sql
+
+    first_id must be the same on every shard and higher than any report
+    or device report id already assigned (the largest of
+    "SELECT MAX(id) FROM report" and "SELECT MAX(id) FROM device_report"
+    on the existing database).
+*/
+
+SELECT set_config('telemetry.shard', :'shard', false),
+       set_config('telemetry.first_id', :'first_id', false);
+
+DO $$
+DECLARE
+    shard INTEGER := current_setting('telemetry.shard')::INTEGER;
+    first_id BIGINT := current_setting('telemetry.first_id')::BIGINT;
+    -- first id at or above first_id that belongs to this shard
+    start_id BIGINT := first_id + ((shard - first_id) % 16 + 16) % 16;
+BEGIN
+    IF shard < 0 OR shard >= 16 THEN
+        RAISE EXCEPTION 'shard must be between 0 and 15';
+    END IF;
+    EXECUTE format('ALTER SEQUENCE report_id_seq INCREMENT BY 16 RESTART WITH %s', start_id);
+    EXECUTE format('ALTER SEQUENCE device_report_id_seq INCREMENT BY 16 RESTART WITH %s', start_id);
+END
+$$;
+
+-- The importers keep the ids of reports from every shard in the primary
+-- database, where they can't reference public.report.
+ALTER TABLE IF EXISTS grafana.ts_cluster_fact DROP CONSTRAINT IF EXISTS ts_cluster_fact_report_id_fkey;
+ALTER TABLE IF EXISTS grafana.metadata_fact DROP CONSTRAINT IF EXISTS metadata_fact_report_id_fkey;
+ALTER TABLE IF EXISTS grafana.rbd_pool DROP CONSTRAINT IF EXISTS rbd_pool_report_id_fkey;
+ALTER TABLE IF EXISTS grafana.pool DROP CONSTRAINT IF EXISTS pool_report_id_fkey;
+ALTER TABLE IF EXISTS device.ts_device DROP CONSTRAINT IF EXISTS ts_device_report_id_fkey;
+ALTER TABLE IF EXISTS device.smart_sata DROP CONSTRAINT IF EXISTS smart_sata_report_id_fkey;
+ALTER TABLE IF EXISTS device.smart_nvme DROP CONSTRAINT IF EXISTS smart_nvme_report_id_fkey;
+ALTER TABLE IF EXISTS device.smart_nvme_vs DROP CONSTRAINT IF EXISTS smart_nvme_vs_report_id_fkey;
@@ -2,10 +2,28 @@
 # vim: ts=4 sw=4 expandtab
 
 import psycopg2
+import psycopg2.extras
 from psycopg2.extensions import AsIs
+import datetime
+import io
 import os
 import json
-from os.path import isfile, join
+import sys
+import time
+import traceback
+from os.path import dirname, isfile, join, realpath
+
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import aggregates, shards
+
+# Rows buffered by a BulkWriter before they are written
+BATCH_SIZE = int(os.environ.get('TELEMETRY_IMPORT_BATCH_SIZE', 1000))
+# 'values' (multi-row INSERT) or 'copy' (COPY FROM STDIN)
+WRITE_METHOD = os.environ.get('TELEMETRY_IMPORT_WRITE_METHOD', 'values')
+# Reports imported per transaction
+COMMIT_EVERY = int(os.environ.get('TELEMETRY_IMPORT_COMMIT_EVERY', 100))
+# import_checkpoint.shard of an unsharded database
+UNSHARDED = -1
 
 
 def run_insert(cur, sql, d, extra_vals = None):
@@ -16,3 +34,258 @@ def run_insert(cur, sql, d, extra_vals = None):
         extra_vals = ()
     cur.execute(sql, (AsIs(','.join(columns)), tuple(values)) + extra_vals)
     #print(cur.mogrify(sql, (AsIs(','.join(columns)), tuple(values))))
+
+
+def _copy_field(v):
+    # COPY ... (FORMAT csv): an unquoted empty field is NULL, a quoted
+    # one is the empty string
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 't' if v else 'f'
+    if isinstance(v, (int, float)):
+        return str(v)
+    if isinstance(v, str):
+        return '"' + v.replace('"', '""') + '"'
+    if isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    raise TypeError(f"Can't COPY a {type(v).__name__}")
+
+
+class BulkWriter(object):
+    '''
+    Buffers the rows inserted into each (table, columns) and writes them
+    with one multi-row INSERT or COPY per table, once batch_size rows are
+    buffered or at commit().  Buffers are written in the order they were
+    first used, so rows referencing each other must be added parents
+    first.  Rows that are still buffered are not visible to queries.
+    '''
+    def __init__(self, conn, batch_size=BATCH_SIZE, method=WRITE_METHOD):
+        if method not in ('values', 'copy'):
+            raise ValueError(f"Unknown write method '{method}'")
+        self.conn = conn
+        self.batch_size = batch_size
+        self.method = method
+        self._buffers = {}
+        self._pending = 0
+        self.rows = {}
+        self.seconds = 0.0
+
+    def insert(self, table, d):
+        columns = tuple(d.keys())
+        self._buffers.setdefault((table, columns), []).append(tuple(d[column] for column in columns))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered rows in the current transaction.
+        '''
+        if not self._pending:
+            return
+        start = time.monotonic()
+        cur = self.conn.cursor()
+        for (table, columns), rows in self._buffers.items():
+            if self.method == 'copy':
+                buf = io.StringIO()
+                for row in rows:
+                    buf.write(','.join(_copy_field(v) for v in row) + '\n')
+                buf.seek(0)
+                cur.copy_expert(f"COPY {table} ({','.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+            else:
+                psycopg2.extras.execute_values(
+                    cur, f"INSERT INTO {table} ({','.join(columns)}) VALUES %s",
+                    rows, page_size=len(rows))
+            self.rows[table] = self.rows.get(table, 0) + len(rows)
+        cur.close()
+        self.seconds += time.monotonic() - start
+        self._buffers = {}
+        self._pending = 0
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+
+    def discard(self):
+        self._buffers = {}
+        self._pending = 0
+
+    def rollback(self):
+        self.discard()
+        self.conn.rollback()
+
+    def summary(self):
+        total = sum(self.rows.values())
+        rate = total / self.seconds if self.seconds else 0.0
+        tables = ', '.join(f"{table} {n}" for table, n in sorted(self.rows.items()))
+        return f"Wrote {total} rows in {self.seconds:.1f} seconds ({rate:.0f} rows/sec): {tables}"
+
+
+class Dictionary(object):
+    '''
+    Integer keys of the rows of a dimension table (see
+    db_create_cluster.sql), cached in memory: key(*values) returns the
+    id of the row with those values in columns, adding the row if it is
+    new.  conn should be a connection of its own in autocommit mode, so
+    that keys stay valid when the importer's transaction rolls back.
+    '''
+    def __init__(self, conn, table, columns):
+        self.conn = conn
+        self.table = table
+        self.columns = tuple(columns)
+        self.misses = 0
+        cur = conn.cursor()
+        cur.execute(f"SELECT id, {','.join(self.columns)} FROM {table}")
+        self._keys = {tuple(row[1:]): row[0] for row in cur.fetchall()}
+        cur.close()
+
+    def key(self, *values):
+        if any(v is None for v in values):
+            return None
+        key = self._keys.get(values)
+        if key is None:
+            key = self._keys[values] = self._add(values)
+        return key
+
+    def _add(self, values):
+        self.misses += 1
+        columns = ','.join(self.columns)
+        cur = self.conn.cursor()
+        cur.execute(f"""INSERT INTO {self.table} ({columns}) VALUES %s
+                        ON CONFLICT ({columns}) DO NOTHING
+                        RETURNING id""", (values,))
+        row = cur.fetchone()
+        if row is None:
+            # added by another importer meanwhile
+            cur.execute(f"SELECT id FROM {self.table} WHERE ({columns}) = %s", (values,))
+            row = cur.fetchone()
+        cur.close()
+        return row[0]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def load_checkpoint(conn, schema, table, column):
+    '''
+    Return the last report id processed per shard (see shards.watermarks()),
+    from schema.import_checkpoint, or from the highest id in table.column
+    for shards without a checkpoint yet.
+    '''
+    cur = conn.cursor()
+    cur.execute(f"SELECT shard, last_id FROM {schema}.import_checkpoint")
+    saved = {None if shard == UNSHARDED else shard: last_id for shard, last_id in cur.fetchall()}
+    config = shards.load_shards()
+    keys = [None] if config is None else list(config)
+    if all(key in saved for key in keys):
+        marks = {key: saved[key] for key in keys}
+    else:
+        marks = shards.watermarks(cur, table, column)
+        marks.update((key, saved[key]) for key in keys if key in saved)
+    cur.close()
+    return marks
+
+
+class BatchImport(object):
+    '''
+    Imports reports commit_every at a time, in one transaction that also
+    moves schema.import_checkpoint past them.  A report that fails is
+    rolled back on its own and recorded, with its exception, in
+    schema.import_quarantine, and the others are imported.
+
+    run() calls import_one(item) for each (report id, item), which writes
+    through writer; the writer is flushed before every commit.
+    '''
+    def __init__(self, conn, writer, schema, marks, commit_every=COMMIT_EVERY, retry=False):
+        self.conn = conn
+        self.writer = writer
+        self.schema = schema
+        self.marks = dict(marks)
+        self.commit_every = commit_every
+        # importing quarantined reports again
+        self.retry = retry
+        # report ids committed
+        self.imported = []
+        self.quarantined = 0
+
+    def run(self, items, import_one):
+        batch = []
+        for report_id, item in items:
+            batch.append((report_id, item))
+            if len(batch) >= self.commit_every:
+                self._commit(batch, import_one)
+                batch = []
+        if batch:
+            self._commit(batch, import_one)
+
+    def _commit(self, batch, import_one):
+        cur = self.conn.cursor()
+        cur.execute("SAVEPOINT batch")
+        try:
+            for report_id, item in batch:
+                import_one(item)
+            self.writer.flush()
+            cur.execute("RELEASE SAVEPOINT batch")
+            imported = [report_id for report_id, _ in batch]
+        except Exception:
+            # find the culprits one report at a time
+            cur.execute("ROLLBACK TO SAVEPOINT batch")
+            self.writer.discard()
+            imported = []
+            for report_id, item in batch:
+                cur.execute("SAVEPOINT report")
+                try:
+                    import_one(item)
+                    self.writer.flush()
+                    cur.execute("RELEASE SAVEPOINT report")
+                    imported.append(report_id)
+                except Exception:
+                    error = traceback.format_exc()
+                    cur.execute("ROLLBACK TO SAVEPOINT report")
+                    self.writer.discard()
+                    print(f"Quarantining report id {report_id}:\n{error}")
+                    cur.execute(f"""INSERT INTO {self.schema}.import_quarantine (report_id, error)
+                                    VALUES (%s, %s)
+                                    ON CONFLICT (report_id) DO UPDATE
+                                    SET error = EXCLUDED.error, quarantined = now()""",
+                                (report_id, error))
+                    self.quarantined += 1
+
+        if self.retry:
+            cur.execute(f"DELETE FROM {self.schema}.import_quarantine WHERE report_id = ANY(%s)", (imported,))
+        for report_id, _ in batch:
+            key = None if None in self.marks else report_id % shards.SHARD_SLOTS
+            self.marks[key] = max(self.marks.get(key, 0), report_id)
+        psycopg2.extras.execute_values(
+            cur,
+            f"""INSERT INTO {self.schema}.import_checkpoint (shard, last_id) VALUES %s
+                ON CONFLICT (shard) DO UPDATE SET last_id = EXCLUDED.last_id, updated = now()""",
+            [(UNSHARDED if key is None else key, mark) for key, mark in self.marks.items()])
+        self.conn.commit()
+        cur.close()
+        self.imported.extend(imported)
+
+
+def update_weekly_reports_sliding(conn, schema, report_ids):
+    # Recompute the daily windows of schema.weekly_reports_sliding that
+    # the newly imported report_ids fall in (see
+    # db_create_weekly_reports_sliding.sql).
+    start = time.monotonic()
+    cur = conn.cursor()
+    cur.execute(f"SELECT {schema}.update_weekly_reports_sliding(%s::INTEGER[])", (list(report_ids),))
+    rows = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    print(f"Updated {schema}.weekly_reports_sliding with {rows} rows in {time.monotonic() - start:.1f} seconds\n")
+
+
+def refresh_dashboard_cache(conn, schema):
+    # Invalidate and re-warm the REST server's cache of the dashboard
+    # functions of schema; a failure here must not fail the import.
+    try:
+        generation = aggregates.refresh(conn, schema)
+        print(f"Refreshed the dashboard cache of {schema}, generation {generation}\n")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Failed to refresh the dashboard cache of {schema}: {e}\n")
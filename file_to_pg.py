@@ -1,11 +1,9 @@
-import json
-from os import listdir
-from os.path import isfile, join
+import sys
+from os.path import dirname, join, realpath
 import psycopg2
 
-DIR = '/opt/telemetry/raw'
-
-files = [f for f in listdir(DIR) if isfile(join(DIR, f))]
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import segments, serialize, shards
 
 f = open('/opt/telemetry/pg_pass.txt', 'r')
 password = f.read().strip()
@@ -17,20 +15,22 @@ conn = psycopg2.connect(
     user='telemetry',
     password=password
 )
-cur = conn.cursor()
 
-for fn in files:
-    f = open('/opt/telemetry/raw/' + fn, 'r')
-    report = f.read()
-    f.close()
-    j = json.loads(report)
-    ts = j.get('report_timestamp')
-    if not ts:
-        continue
-    cur.execute(
+# Each report goes to the shard of its cluster (see
+# server/ceph_telemetry/shards.py), the primary database when unsharded.
+shard_conns = shards.connect_all(conn)
+ring = shards.HashRing(shard_conns)
+cursors = {shard: shard_conn.cursor() for shard, shard_conn in shard_conns.items()}
+
+# Read the archive one segment file at a time; the index already
+# holds each report's cluster_id and report_stamp.  Older archived
+# reports may contain NUL escapes, which jsonb can't store.
+for cluster_id, ts, report in segments.SegmentArchive().scan():
+    cursors[ring.shard_for(cluster_id)].execute(
         'INSERT INTO report (cluster_id, report_stamp, report) VALUES (%s,%s,%s) ON CONFLICT DO NOTHING',
-        (j.get('report_id'),
+        (cluster_id,
          ts,
-         report)
+         serialize.strip_nul(report).decode('utf-8'))
     )
-conn.commit()
+for shard_conn in shard_conns.values():
+    shard_conn.commit()
@@ -1,23 +1,44 @@
 #! /usr/bin/env python3
 # vim: ts=4 sw=4 expandtab
 
+import argparse
+import collections
+import concurrent.futures
 import dbhelper
+import json
 import psycopg2
 import psycopg2.extras
-import json
 import re
 import sys
 from pathlib import Path
 from os import listdir
-from os.path import isfile, join
+from os.path import dirname, isfile, join, realpath
 import time
 
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import shards
+
 # Data Source Name file
 DSN = '/opt/telemetry/grafana.dsn'
 
+CEPH_VERSION_NORM = re.compile('ceph version v*([0-9.]+|Dev).*')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import new reports into the grafana tables')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='processes decoding reports and building rows (default 0: decode in this process)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='reports fetched and handed to a worker at a time')
+    parser.add_argument('--commit-every', type=int, default=dbhelper.COMMIT_EVERY,
+                        help='reports imported per transaction')
+    parser.add_argument('--retry-quarantined', action='store_true',
+                        help='import the reports in grafana.import_quarantine again, instead of new ones')
+    return parser.parse_args()
+
 # 'j' stands for report_json
-def insert_into_all_tables(conn, report_id_serial, j):
-    cur = conn.cursor()
+# Returns the [(table, row), ...] of a report, in insertion order.
+def build_rows(report_id_serial, j):
+    rows = []
     report_timestamp = j.get('report_timestamp')
 
     cluster = {}
@@ -28,7 +49,7 @@ def insert_into_all_tables(conn, report_id_serial, j):
     cluster['created']              = j.get('created')
     if cluster['created'] == '0.000000':
         print("Weird created value for cluster. Skipping\n")
-        return
+        return rows
     cluster['channel_basic']        = 'basic' in j.get('channels', [])
     cluster['channel_crash']        = 'crash' in j.get('channels', [])
     cluster['channel_device']       = 'device' in j.get('channels', [])
@@ -52,8 +73,7 @@ def insert_into_all_tables(conn, report_id_serial, j):
     # Compatibility with older telemetry modules
     cluster['pg_num']               = j.get('usage', {}).get('pg_num') or j.get('usage', {}).get('pg_num:')
 
-    sql = 'INSERT INTO grafana.ts_cluster (%s) VALUES %s'
-    dbhelper.run_insert(cur, sql, cluster)
+    rows.append(('grafana.ts_cluster', cluster))
 
     for p in j.get('pools', []):
         pool = {}
@@ -75,8 +95,7 @@ def insert_into_all_tables(conn, report_id_serial, j):
         pool['ec_plugin']               = p.get('erasure_code_profile', {}).get('plugin')
         pool['ec_technique']            = p.get('erasure_code_profile', {}).get('technique')
 
-        sql = 'INSERT INTO grafana.pool (%s) VALUES %s'
-        dbhelper.run_insert(cur, sql, pool)
+        rows.append(('grafana.pool', pool))
 
     for entity, entity_val in j.get('metadata', {}).items():
         for attr, attr_val in entity_val.items():
@@ -89,18 +108,17 @@ def insert_into_all_tables(conn, report_id_serial, j):
                 metadata['value']       = value
                 metadata['total']       = total
 
-                sql = 'INSERT INTO grafana.metadata (%s) VALUES %s'
-                dbhelper.run_insert(cur, sql, metadata)
+                rows.append(('grafana.metadata', metadata))
                 # Adding a normalized 'ceph_version' record
                 # to 'metadata' table by extracting the numeric version part
                 if attr == 'ceph_version':
-                    metadata['attr'] = 'ceph_version_norm'
-                    ceph_version_norm = re.match('ceph version v*([0-9.]+|Dev).*', value)
+                    ceph_version_norm = CEPH_VERSION_NORM.match(value)
                     if ceph_version_norm is None:
                         print(f"public.report.id = {report_id_serial} contains an invalid ceph_version value ({value}), skipping this metadata attribute")
                         continue
-                    metadata['value'] = ceph_version_norm.group(1)
-                    dbhelper.run_insert(cur, sql, metadata)
+                    rows.append(('grafana.metadata', dict(metadata,
+                                                          attr='ceph_version_norm',
+                                                          value=ceph_version_norm.group(1))))
 
     for i in range(j.get('rbd', {}).get('num_pools', 0)):
         rbd_pool = {}
@@ -110,66 +128,141 @@ def insert_into_all_tables(conn, report_id_serial, j):
         rbd_pool['num_images']  = j['rbd']['num_images_by_pool'][i] # FIXME Will crash in case key is missing
         rbd_pool['mirroring']   = j['rbd']['mirroring_by_pool'][i]
 
-        sql = 'INSERT INTO grafana.rbd_pool (%s) VALUES %s'
-        dbhelper.run_insert(cur, sql, rbd_pool)
+        rows.append(('grafana.rbd_pool', rbd_pool))
+
+    return rows
+
+# The dimension tables of grafana.ts_cluster and grafana.metadata, see
+# db_create_cluster.sql.
+def load_dimensions(conn):
+    return {
+        'cluster': dbhelper.Dictionary(conn, 'grafana.cluster_ids', ('cluster_id',)),
+        'attr': dbhelper.Dictionary(conn, 'grafana.metadata_attrs', ('entity', 'attr')),
+        'value': dbhelper.Dictionary(conn, 'grafana.metadata_values', ('value',)),
+    }
+
+# Called by dbhelper.BatchImport, which commits every --commit-every
+# reports and quarantines the ones that fail. Rows of the views
+# grafana.ts_cluster and grafana.metadata are written to their fact
+# tables, with the strings replaced by their keys in dims.
+def insert_into_all_tables(writer, dims, rows):
+    if isinstance(rows, Exception):
+        raise rows
+    for table, row in rows:
+        if table == 'grafana.ts_cluster':
+            row = dict(row)
+            row['cluster_key'] = dims['cluster'].key(row.pop('cluster_id'))
+            table = 'grafana.ts_cluster_fact'
+        elif table == 'grafana.metadata':
+            row = dict(row)
+            row['attr_key'] = dims['attr'].key(row.pop('entity'), row.pop('attr'))
+            row['value_key'] = dims['value'].key(row.pop('value'))
+            table = 'grafana.metadata_fact'
+        writer.insert(table, row)
+
+# Returns the rows of a report, or the exception building them, which
+# insert_into_all_tables() raises again to quarantine the report.
+def transform_one(report_id, report, decode):
+    try:
+        return build_rows(report_id, json.loads(report) if decode else report)
+    except Exception as e:
+        return e
+
+# Runs in the worker processes of --workers: decodes a batch of
+# (id, report text) and returns [(id, rows), ...] in the same order.
+def transform(batch):
+    return [(report_id, transform_one(report_id, report, True)) for report_id, report in batch]
+
+def batches(reports, size):
+    batch = []
+    for r in reports:
+        batch.append((r['id'], r['report']))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    # Commiting once, so everything is one transaction
-    conn.commit()
+# Yields (id, rows) in id order while the workers transform the
+# following batches; at most two batches per worker are in flight.
+def transformed(reports, workers, batch_size):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = collections.deque()
+        for batch in batches(reports, batch_size):
+            in_flight.append(executor.submit(transform, batch))
+            if len(in_flight) >= 2 * workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
 
 def main():
+    args = parse_args()
     start_time = time.time()
     with open(DSN, 'r') as f:
         dsn_str = f.read().strip()
 
     conn = psycopg2.connect(dsn_str)
-    # Create a named server-side cursor
-    dict_cur = conn.cursor(name='server_side_cursor', withhold=True, cursor_factory=psycopg2.extras.DictCursor)
-    dict_cur.itersize = 10
-    # Fetch only reports which are not already in ts_cluster;
-    # COALESCE returns the first non-NULL value, so '0' is
-    # the returned id in case ts_cluster table is empty.
+    # Reports may be spread over several databases (see
+    # server/ceph_telemetry/shards.py); read them all, merged by id.
+    shard_conns = shards.connect_all(conn)
+    # Fetch only reports which were not processed yet, i.e. past the
+    # checkpoint of each shard (or the highest id in ts_cluster_fact
+    # before the first checkpoint), or with --retry-quarantined
+    # the quarantined ones.
     #
     # Also, filter out test clusters so they will not appear
-    # in the dashboard. Please note that 'organization' key
-    # does not always exist in report (NULL); but when it does,
-    # report['organization'] can have the value "null".
+    # in the dashboard. 'organization' is extracted from the report
+    # at insert time; it is NULL when the report has no organization
+    # key or it is "null". The filter matches the partial index
+    # report_id_not_qa, so this is an index range scan.
+    marks = dbhelper.load_checkpoint(conn, 'grafana', 'grafana.ts_cluster_fact', 'report_id')
+    if args.retry_quarantined:
+        cur = conn.cursor()
+        cur.execute("SELECT report_id FROM grafana.import_quarantine")
+        new, params = "id = ANY(%s)", [[report_id for report_id, in cur.fetchall()]]
+        cur.close()
+    else:
+        new, params = shards.after(marks)
     #
-    # We replace '\u0000' with ' ' since some reports might contain
-    # it in an assert_msg of one of the reported crashes. This is interpreted by
-    # Postgres as Unicode NULL and throws an error:
-    #     psycopg2.DataError: unsupported Unicode escape sequence
-    #     DETAIL:  \u0000 cannot be converted to text.
-    dict_cur.execute("""SELECT id, report
-                        FROM public.report
-                        WHERE id > (SELECT COALESCE(MAX(ts_cluster.report_id), 0)
-                                    FROM grafana.ts_cluster)
-                        AND
-                            (   --either the key does not exist in the report
-                                NOT replace(report, '\\u0000', ' ')::jsonb ? 'organization'
-                            OR
-                                -- or it exists, but its value is not 'ceph-qa'
-                                replace(report, '\\u0000', ' ')::jsonb#>'{organization}' != '"ceph-qa"'
-                            )
-                        ORDER BY id""")
-    cnt = 0
+    # With --workers, the reports are read as text and decoded by the
+    # workers; otherwise jsonb arrives already decoded.
+    report = 'report::text AS report' if args.workers else 'report'
+    reports = shards.gather(shard_conns, f"""SELECT id, {report}
+                                             FROM public.report
+                                             WHERE {new}
+                                             AND organization IS DISTINCT FROM 'ceph-qa'
+                                             ORDER BY id""", params, itersize=args.batch_size)
+    if args.workers:
+        rows = transformed(reports, args.workers, args.batch_size)
+    else:
+        rows = ((r['id'], transform_one(r['id'], r['report'], False)) for r in reports)
+    # New dimension rows are committed right away, on a connection of
+    # their own, so that their cached keys survive a rollback.
+    dims_conn = psycopg2.connect(dsn_str)
+    dims_conn.autocommit = True
+    dims = load_dimensions(dims_conn)
+    # Rows of each table are written together, see dbhelper.BulkWriter
+    writer = dbhelper.BulkWriter(conn)
+    importer = dbhelper.BatchImport(conn, writer, 'grafana', marks, args.commit_every,
+                                    retry=args.retry_quarantined)
     try:
-        for r in dict_cur:
-            cnt += 1
-            insert_into_all_tables(conn, r['id'], json.loads(r['report']))
-        dict_cur.close()
+        importer.run(rows, lambda report_rows: insert_into_all_tables(writer, dims, report_rows))
+        reports.close()
     except:
-        print(f"Exception when processing public.report.id={r['id']}\n")
-        conn.rollback()
+        print(f"Exception after importing {len(importer.imported)} reports\n")
+        writer.rollback()
         raise
     finally:
-        refresh_cur = conn.cursor()
-        refresh_cur.execute("REFRESH MATERIALIZED VIEW grafana.weekly_reports_sliding")
-        conn.commit()
-        refresh_cur.close()
+        dbhelper.update_weekly_reports_sliding(conn, 'grafana', importer.imported)
+        # the dashboard results cached by the REST server are stale now
+        dbhelper.refresh_dashboard_cache(conn, 'dashboard')
 
     end_time = time.time()
     time_delta = int(end_time - start_time)
-    print(f"Processed {cnt} reports in {time_delta} seconds\n")
+    print(f"Imported {len(importer.imported)} reports and quarantined {importer.quarantined} in {time_delta} seconds\n")
+    print(writer.summary() + "\n")
+    print("Dimension keys: " + ', '.join(f"{name} {len(d)} ({d.misses} new)" for name, d in dims.items()) + "\n")
+    dims_conn.close()
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 # vim: ts=4 sw=4 expandtab
 
+import argparse
 import dbhelper
 import psycopg2
 import psycopg2.extras
@@ -10,13 +11,24 @@ import time
 import re
 from pathlib import Path
 from os import listdir
-from os.path import isfile, join
+from os.path import dirname, isfile, join, realpath
+
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import shards
 
 # Data Source Name file
 DSN = '/opt/telemetry/grafana.dsn'
 
 # Device tables are created via db_create_device.sql (DDL file)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import new device reports into the device tables')
+    parser.add_argument('--commit-every', type=int, default=dbhelper.COMMIT_EVERY,
+                        help='reports imported per transaction')
+    parser.add_argument('--retry-quarantined', action='store_true',
+                        help='import the reports in device.import_quarantine again, instead of new ones')
+    return parser.parse_args()
+
 
 # Flatten
 #     "crc_error_count": {
@@ -315,7 +327,7 @@ def parse_value_by_type(v):
     else:
         return v
 
-def populate_device_smart_nvme(cur, smart_attr_nvme, device_id, report_id, ts):
+def populate_device_smart_nvme(writer, smart_attr_nvme, device_id, report_id, ts):
     for k, v in smart_attr_nvme.items():
         device_smart_nvme = {}
         device_smart_nvme['device_id'] = device_id
@@ -326,12 +338,11 @@ def populate_device_smart_nvme(cur, smart_attr_nvme, device_id, report_id, ts):
 
         if device_smart_nvme['attr_val'] is None:
             print(f"attr_name: {k} of device report id {report_id}, attr_val is of type list.\n")
-        sql = 'INSERT INTO device.smart_nvme (%s) VALUES %s'
-        dbhelper.run_insert(cur, sql, device_smart_nvme)
+        writer.insert('device.smart_nvme', device_smart_nvme)
 
 # NVMe vendor specific data:
 # TODO: Support newer versions of nvme-cli here and in the telemetry client
-def populate_device_smart_nvme_vs(cur, device, report, device_id, report_id, ts):
+def populate_device_smart_nvme_vs(writer, device, report, device_id, report_id, ts):
     data = report.get('nvme_smart_health_information_add_log', {})
     # 'Device stats' is found in Intel drives
     dev_stats = data.get('Device stats') if data.get('Device stats') else data
@@ -349,10 +360,9 @@ def populate_device_smart_nvme_vs(cur, device, report, device_id, report_id, ts)
         device_smart_nvme_vs['attr_name'] = k
         device_smart_nvme_vs['attr_val']  = v
 
-        sql = 'INSERT INTO device.smart_nvme_vs (%s) VALUES %s'
-        dbhelper.run_insert(cur, sql, device_smart_nvme_vs)
+        writer.insert('device.smart_nvme_vs', device_smart_nvme_vs)
 
-def populate_device_smart_sata(cur, sata_smart_attr, device_id, report_id, ts):
+def populate_device_smart_sata(writer, sata_smart_attr, device_id, report_id, ts):
     for attr in sata_smart_attr.get('table', []):
         device_smart_sata = {}
         device_smart_sata['device_id']    = device_id
@@ -365,10 +375,9 @@ def populate_device_smart_sata(cur, sata_smart_attr, device_id, report_id, ts):
         device_smart_sata['attr_norm']    = attr['value']
         device_smart_sata['attr_worst']   = attr['worst']
 
-        sql = 'INSERT INTO device.smart_sata (%s) VALUES %s'
-        dbhelper.run_insert(cur, sql, device_smart_sata)
+        writer.insert('device.smart_sata', device_smart_sata)
 
-def import_report(conn, r):
+def import_report(conn, writer, r):
     cur = conn.cursor()
     # vmu stands for vendor_model_uuid
     # (that's the original anonymized device id generated on the client side)
@@ -417,8 +426,7 @@ def import_report(conn, r):
     mapping['o_vendor'] = new_vendor
     mapping['o_model'] = new_model
 
-    sql = """INSERT INTO device.mapping (%s) VALUES %s"""
-    dbhelper.run_insert(cur, sql, mapping)
+    writer.insert('device.mapping', mapping)
 
     # Assigning the new values
     device_spec['vendor'] = new_vendor
@@ -439,24 +447,22 @@ def import_report(conn, r):
     device_id = fetch_device_id(cur, device)
     ts_device['device_id'] = device_id
 
-    sql = """INSERT INTO device.ts_device (%s) VALUES %s"""
-    dbhelper.run_insert(cur, sql, ts_device)
+    writer.insert('device.ts_device', ts_device)
 
     smart_attr_nvme = rep.get('nvme_smart_health_information_log')
     if smart_attr_nvme:
-        populate_device_smart_nvme(cur, smart_attr_nvme, device_id, report_id, ts)
+        populate_device_smart_nvme(writer, smart_attr_nvme, device_id, report_id, ts)
 
     # Device's Vendor Specific extended SMART log page contents.
     # Currently all records accidentally have this key, filtering nvme only:
     if device_spec['interface'] == 'nvme' and 'nvme_smart_health_information_add_log' in rep:
-        populate_device_smart_nvme_vs(cur, device, rep, device_id, report_id, ts)
+        populate_device_smart_nvme_vs(writer, device, rep, device_id, report_id, ts)
 
     sata_smart_attr = rep.get('ata_smart_attributes')
     if sata_smart_attr:
-        populate_device_smart_sata(cur, sata_smart_attr, device_id, report_id, ts)
+        populate_device_smart_sata(writer, sata_smart_attr, device_id, report_id, ts)
 
-    # Committing everything as a single transaction
-    conn.commit()
+    # Committed by dbhelper.BatchImport, together with the reports around it
     cur.close()
 
 """
@@ -512,6 +518,7 @@ def update_unknown_spec(conn):
     dict_cur_update.close()
 
 def main():
+    args = parse_args()
     start_time = time.time()
     with open(DSN, 'r') as f:
         dsn_str = f.read().strip()
@@ -520,47 +527,55 @@ def main():
 
     update_unknown_spec(conn)
 
-    # Create a named server-side cursor
-    dict_cur = conn.cursor(name='server_side_cursor', withhold=True, cursor_factory=psycopg2.extras.DictCursor)
-
-    dict_cur.itersize = 10
+    # Device reports may be spread over several databases (see
+    # server/ceph_telemetry/shards.py); read them all, merged by id.
+    shard_conns = shards.connect_all(conn)
 
     """
-    Fetch only reports which are not in ts_device;
-    COALESCE returns the first non-NULL value, so '0' is
-    the returned id in case ts_device table is empty.
+    Fetch only reports which were not processed yet, i.e. past the
+    checkpoint of each shard (or the highest id in ts_device before
+    the first checkpoint), or with --retry-quarantined the quarantined
+    ones.
     This SELECT query is outside of the 'try' block, since we prefer
-    not to refresh materialized view (via finally block) in case this query fails
+    not to update weekly_reports_sliding (via finally block) in case this query fails
     (even though it's okay to do so, it's just not the correct flow).
     """
-    dict_cur.execute("""SELECT device_id, report_stamp, report, id
-                        FROM public.device_report
-                        WHERE device_report.id > (SELECT COALESCE(MAX(ts_device.report_id), 0)
-                                    FROM device.ts_device)
-                        ORDER BY id""")
-    cnt = 0
+    marks = dbhelper.load_checkpoint(conn, 'device', 'device.ts_device', 'report_id')
+    if args.retry_quarantined:
+        cur = conn.cursor()
+        cur.execute("SELECT report_id FROM device.import_quarantine")
+        new, params = "id = ANY(%s)", [[report_id for report_id, in cur.fetchall()]]
+        cur.close()
+    else:
+        new, params = shards.after(marks)
+    dict_cur = shards.gather(shard_conns, f"""SELECT device_id, report_stamp, report, id
+                                              FROM public.device_report
+                                              WHERE {new}
+                                              ORDER BY id""", params)
+    # Rows of each table are written together, see dbhelper.BulkWriter
+    writer = dbhelper.BulkWriter(conn)
+    importer = dbhelper.BatchImport(conn, writer, 'device', marks, args.commit_every,
+                                    retry=args.retry_quarantined)
     try:
-        for r in dict_cur:
-            cnt += 1
-            import_report(conn, r)
+        importer.run(((r['id'], r) for r in dict_cur), lambda r: import_report(conn, writer, r))
     except:
-        print(f"Exception when processing public.device_report.id={r['id']}\n")
-        # Since we insert / update multiple tables in each import_report() call,
-        # we rollback all pending actions to avoid any inconsistencies.
-        conn.rollback()
+        print(f"Exception after importing {len(importer.imported)} reports\n")
+        # Reports that fail on their own are quarantined; this is
+        # something else, e.g. a lost connection. Roll back the
+        # uncommitted batch; the next run starts after the last one.
+        writer.rollback()
         raise
     finally:
-        # Creating a new cursor in case something happened to the existing one:
-        refresh_cur = conn.cursor()
-        refresh_cur.execute("REFRESH MATERIALIZED VIEW device.weekly_reports_sliding")
-        conn.commit()
-        refresh_cur.close()
+        dbhelper.update_weekly_reports_sliding(conn, 'device', importer.imported)
+        # the dashboard results cached by the REST server are stale now
+        dbhelper.refresh_dashboard_cache(conn, 'dashboard_device')
 
         dict_cur.close()
         end_time = time.time()
         time_delta = int(end_time - start_time)
         conn.close()
-        print(f"Processed {cnt} reports in {time_delta} seconds\n")
+        print(f"Imported {len(importer.imported)} reports and quarantined {importer.quarantined} in {time_delta} seconds\n")
+        print(writer.summary() + "\n")
 
 
 if __name__ == '__main__':
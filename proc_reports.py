@@ -1,43 +1,16 @@
 #!/usr/bin/env python3
 # vim: ts=4 sw=4 expandtab:
-import hashlib
+import argparse
 import json
 import psycopg2
-import re
 import sys
+from os.path import dirname, join, realpath
 
-conn = None
-
-
-def sanitize_backtrace(bt):
-    ret = list()
-    for func_record in bt:
-        # split into two fields on last space, take the first one,
-        # strip off leading ( and trailing )
-        func_plus_offset = func_record.rsplit(' ', 1)[0][1:-1]
-        ret.append(func_plus_offset.split('+')[0])
-
-    return ret
-
-
-def sanitize_assert_msg(msg):
-
-    # (?s) allows matching newline.  get everything up to "thread" and
-    # then after-and-including the last colon-space.  This skips the
-    # thread id, timestamp, and file:lineno, because file is already in
-    # the beginning, and lineno may vary.
-
-    matchexpr = re.compile(r'(?s)(.*) thread .* time .*(: .*)\n')
-    return ''.join(matchexpr.match(msg).groups())
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import shards
+from ceph_telemetry.crashes import calc_sig
 
-
-def calc_sig(bt, assert_msg):
-    sig = hashlib.sha256()
-    for func in sanitize_backtrace(bt):
-        sig.update(func.encode())
-    if assert_msg:
-        sig.update(sanitize_assert_msg(assert_msg).encode())
-    return ''.join('%02x' % c for c in sig.digest())
+conn = None
 
 
 def update_cluster(cluster_id, latest_report_ts, report):
@@ -122,7 +95,32 @@ def update_crash(cluster_id, latest_report_ts, report):
     return len(crashes), update_count
 
 
+def latest_reports(shard_conns):
+    '''
+    Return {cluster_id: (shard, latest report_stamp)}.  A cluster's
+    reports are on one shard, except while rebalance_shards.py moves them.
+    '''
+    latest = {}
+    for shard, shard_conn in shard_conns.items():
+        cur = shard_conn.cursor()
+        cur.execute("SELECT cluster_id, MAX(report_stamp) FROM report GROUP BY cluster_id")
+        for cid, ts in cur.fetchall():
+            if cid not in latest or ts > latest[cid][1]:
+                latest[cid] = (shard, ts)
+        cur.close()
+    return latest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-crashes", action='store_false', dest='crashes',
+                        help="don't import crashes from the latest reports (the server extracts most of them at upload time)")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+
     f = open('/opt/telemetry/pg_pass.txt', 'r')
     password = f.read().strip()
     f.close()
@@ -135,17 +133,20 @@ def main():
         password=password
     )
 
-    ccur = conn.cursor()
-    rcur = conn.cursor()
+    # Reports may be spread over several databases (see
+    # server/ceph_telemetry/shards.py); the tables updated here are in
+    # the primary one.
+    shard_conns = shards.connect_all(conn)
+    rcurs = {shard: shard_conn.cursor() for shard, shard_conn in shard_conns.items()}
 
     cluster_count = update_count = crash_count = crash_update_count = 0
-    ccur.execute("SELECT DISTINCT cluster_id from report")
-    for cid in ccur.fetchall():
-        cid = cid[0]
+    for cid, (shard, _) in latest_reports(shard_conns).items():
+        rcur = rcurs[shard]
         rcur.execute("SELECT report_stamp, report FROM report WHERE cluster_id=%s ORDER BY report_stamp DESC LIMIT 1", (cid,))
         latest_report_ts, report = rcur.fetchone()
         try:
-            report = json.loads(report)
+            if isinstance(report, str):
+                report = json.loads(report)
         except TypeError:
             print('cluster %s ts %s has malformed report' % (cid, latest_report_ts))
             continue
@@ -153,9 +154,10 @@ def main():
         if update_cluster(cid, latest_report_ts, report):
             update_count += 1
         update_cluster_version(cid, latest_report_ts, report)
-        visited, updated = update_crash(cid, latest_report_ts, report)
-        crash_count += visited
-        crash_update_count += updated
+        if args.crashes:
+            visited, updated = update_crash(cid, latest_report_ts, report)
+            crash_count += visited
+            crash_update_count += updated
     print('updated %d/%d clusters, updated %d/%d crashes' % (update_count, cluster_count, crash_update_count, crash_count))
     conn.commit()
 
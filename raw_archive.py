@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# vim: ts=4 sw=4 expandtab
+
+# Read and maintain the raw report archive written by the REST server.
+#
+#   raw_archive.py get <cluster_id> <report_stamp>   print one report (or --path fragments of it)
+#   raw_archive.py history <cluster_id>              print a cluster's reports, oldest first
+#   raw_archive.py cat <file>...                     print legacy per-report files (plain, gzip or zstd)
+#   raw_archive.py pack [--delete]                   move legacy per-report files into segments
+#   raw_archive.py reindex [<segment>...]            rebuild index entries from segment files
+#   raw_archive.py train                             train a new zstd compression dictionary
+
+import argparse
+import datetime
+import json
+import os
+import sys
+from os.path import dirname, join, realpath
+
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import archive, projection, segments
+
+
+# Subdirectory of the per-report files that pack --delete couldn't pack
+UNPACKABLE = 'unpackable'
+
+
+def set_aside(directory, path):
+    aside = join(directory, UNPACKABLE)
+    os.makedirs(aside, exist_ok=True)
+    os.rename(path, join(aside, os.path.basename(path)))
+
+
+def pack(store, directory, delete):
+    '''
+    Append every per-report file in `directory` to the segment of the
+    day it was written, oldest first.  With delete, packed files are
+    removed and unreadable ones moved to the UNPACKABLE subdirectory.
+    '''
+    files = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file():
+                files.append((entry.stat().st_mtime, entry.path))
+    files.sort()
+
+    packed = skipped = 0
+    for mtime, path in files:
+        try:
+            data = archive.read_file(path)
+            j = json.loads(data)
+        except archive.DECOMPRESS_ERRORS as e:
+            j = None
+            print(f"{path}: unreadable ({e}), skipping")
+        else:
+            if not isinstance(j, dict) or 'report_id' not in j or 'report_timestamp' not in j:
+                j = None
+                print(f"{path}: no report_id or report_timestamp, skipping")
+        if j is None:
+            skipped += 1
+            if delete:
+                set_aside(directory, path)
+            continue
+        day = datetime.datetime.utcfromtimestamp(mtime).date()
+        if store.append(j['report_id'], j['report_timestamp'], data, day=day):
+            packed += 1
+        else:
+            skipped += 1
+        if delete:
+            os.unlink(path)
+    print(f"Packed {packed} reports, skipped {skipped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ceph Telemetry raw report archive')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('get', help='print one report')
+    p.add_argument('cluster_id')
+    p.add_argument('report_stamp')
+    p.add_argument('--path', action='append', help='print only this path, e.g. pools[*].pg_num (repeatable)')
+    p = sub.add_parser('history', help="print a cluster's reports, oldest first")
+    p.add_argument('cluster_id')
+    p.add_argument('--since', help='first report_stamp to print')
+    p.add_argument('--path', action='append', help='print only this path, e.g. pools[*].pg_num (repeatable)')
+    p = sub.add_parser('cat', help='print legacy per-report files, in any format')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('pack', help='move legacy per-report files into segments')
+    p.add_argument('--dir', default=archive.ARCHIVE_DIR, help='directory of per-report files (default %(default)s)')
+    p.add_argument('--delete', action='store_true', help='remove files once packed')
+    p = sub.add_parser('reindex', help='add segment records missing from the index')
+    p.add_argument('segments', nargs='*', help='segment names (YYYY-MM-DD, default all)')
+    p = sub.add_parser('train', help='train a new compression dictionary')
+    p.add_argument('--samples', type=int, default=archive.TRAIN_SAMPLES, help='reports to sample (default %(default)d)')
+    p.add_argument('--size', type=int, default=archive.DICT_SIZE, help='dictionary size in bytes (default %(default)d)')
+    args = parser.parse_args()
+
+    store = segments.SegmentArchive()
+    out = sys.stdout.buffer
+
+    def fragments(data):
+        if not getattr(args, 'path', None):
+            return data
+        return json.dumps(projection.project(json.loads(data), args.path)).encode('utf-8')
+
+    if args.command == 'get':
+        data = store.get(args.cluster_id, args.report_stamp)
+        if data is None:
+            print('not found', file=sys.stderr)
+            return 1
+        out.write(fragments(data) + b'\n')
+    elif args.command == 'history':
+        for stamp, data in store.history(args.cluster_id, since=args.since):
+            out.write(fragments(data) + b'\n')
+    elif args.command == 'cat':
+        for path in args.files:
+            out.write(archive.read_file(path) + b'\n')
+    elif args.command == 'pack':
+        pack(store, args.dir, args.delete)
+    elif args.command == 'reindex':
+        for segment in args.segments or store.segments():
+            print(f"{segment}: indexed {store.reindex(segment)} missing records")
+    elif args.command == 'train':
+        if archive.zstandard is None:
+            print('zstandard is not installed', file=sys.stderr)
+            return 1
+        data = store.sample(args.samples)
+        if not data:
+            # Nothing packed yet, sample the legacy files
+            data = [archive.read_file(p) for p in archive.sample_files(archive.ARCHIVE_DIR, args.samples)]
+        dict_id, raw, packed = archive.train(data, args.size)
+        print(f"Trained dictionary {dict_id}; the sample compresses {raw} -> {packed} bytes ({raw / max(packed, 1):.1f}x)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# vim: ts=4 sw=4 expandtab
+'''
+Move reports and device reports to the shard that owns them after
+shards were added to or removed from /opt/telemetry/shards.conf (see
+server/ceph_telemetry/shards.py).
+
+Restart the servers with the new shard file first, so that new uploads
+already go to their new shards, then run this until it finds nothing
+to move.  It can be interrupted and run again: rows are copied with
+their ids and committed on the destination before they are deleted
+from the source.
+
+    ./rebalance_shards.py --dry-run
+    ./rebalance_shards.py
+'''
+import argparse
+import sys
+from os.path import dirname, join, realpath
+
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, join(dirname(realpath(__file__)), 'server'))
+from ceph_telemetry import shards
+
+# table -> (sharding key, columns read, columns written)
+TABLES = {
+    'report': ('cluster_id',
+               'id, cluster_id, report_stamp, report::text',
+               'id, cluster_id, report_stamp, report'),
+    'device_report': ('device_id',
+                      'id, device_id, report_stamp, report',
+                      'id, device_id, report_stamp, report'),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Move rows to the shards that own them')
+    parser.add_argument('--shards', default=shards.SHARDS_FILE, help='shard file')
+    parser.add_argument('--table', choices=sorted(TABLES), action='append',
+                        help='only this table (repeatable; default all)')
+    parser.add_argument('--batch', type=int, default=10,
+                        help='cluster or device ids moved per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would move')
+    return parser.parse_args()
+
+
+def misplaced(conn, ring, shard, table, key):
+    '''
+    Return {destination shard: [key, ...]} for the keys of table in
+    shard that the ring places elsewhere.
+    '''
+    cur = conn.cursor()
+    cur.execute(f"SELECT DISTINCT {key} FROM {table}")
+    moves = {}
+    for value, in cur:
+        dest = ring.shard_for(value)
+        if dest != shard:
+            moves.setdefault(dest, []).append(value)
+    cur.close()
+    conn.rollback()
+    return moves
+
+
+def move(src, dst, table, keys):
+    key, read, write = TABLES[table]
+    scur = src.cursor()
+    scur.execute(f"SELECT {read} FROM {table} WHERE {key} = ANY(%s)", (keys,))
+    rows = scur.fetchall()
+    if rows:
+        dcur = dst.cursor()
+        # a conflicting id (rather than key) fails loudly: the shards'
+        # id sequences overlap, see db_shard_setup.sql
+        psycopg2.extras.execute_values(
+            dcur,
+            f"INSERT INTO {table} ({write}) VALUES %s ON CONFLICT ({key}, report_stamp) DO NOTHING",
+            rows)
+        dst.commit()
+        dcur.close()
+        # only what was copied: the source may still be receiving
+        # uploads from servers that haven't seen the new shard file
+        scur.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", ([row[0] for row in rows],))
+    src.commit()
+    scur.close()
+    return len(rows)
+
+
+def main():
+    args = parse_args()
+    config = shards.load_shards(args.shards)
+    if config is None:
+        print(f"{args.shards} does not exist; there is nothing to rebalance")
+        return 1
+    ring = shards.HashRing(config)
+    conns = {shard: psycopg2.connect(dsn) for shard, dsn in config.items()}
+
+    total = 0
+    for table in args.table or sorted(TABLES):
+        key = TABLES[table][0]
+        for shard, conn in sorted(conns.items()):
+            for dest, keys in sorted(misplaced(conn, ring, shard, table, key).items()):
+                print(f"{table}: {len(keys)} {key}s belong on shard {dest}, not {shard}")
+                if args.dry_run:
+                    continue
+                for i in range(0, len(keys), args.batch):
+                    moved = move(conn, conns[dest], table, keys[i:i + args.batch])
+                    total += moved
+                    print(f"{table}: moved {moved} rows from shard {shard} to {dest}")
+
+    for conn in conns.values():
+        conn.close()
+    print(f"Moved {total} rows")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
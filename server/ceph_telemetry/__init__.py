@@ -1 +1,8 @@
-from .app import create_app
\ No newline at end of file
+def __getattr__(name):
+    # The apps are loaded on first use, so that the importers can use the
+    # modules of the package without loading the REST server (whose
+    # logging goes to its own log file).
+    if name in ('create_app', 'create_internal_app'):
+        from . import app
+        return getattr(app, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
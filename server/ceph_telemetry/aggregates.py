@@ -0,0 +1,310 @@
+'''
+Cached results of the dashboard functions (db_create_dashboard*.sql).
+
+The aggregates behind the Grafana panels only change when the nightly
+importers load new data, yet every panel refresh recomputes them from
+weekly_reports_sliding.  Results are cached by function and arguments
+at two levels: in each server process, and in dashboard.cache, which
+all processes share and the importers fill ahead of time.
+
+Each schema (dashboard, dashboard_device) has a generation in
+dashboard.cache_generation.  An importer that loaded new data bumps it
+(refresh()), which makes every cached result of the schema stale.
+Server processes read the generations at most every GENERATION_TTL
+seconds, so a result may be served for that long after an import.
+
+Time arguments are rounded outwards to whole days (UTC), the
+resolution of the daily windows, so that panels asking for "the last
+30 days" at different times of the day share a result.
+'''
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from ceph_telemetry import metrics, serialize
+
+# Results kept per process, by size of their JSON encoding
+CACHE_BYTES = 64 * 1024 * 1024
+# How long a process trusts the generations it read
+GENERATION_TTL = float(os.environ.get('TELEMETRY_DASHBOARD_GENERATION_TTL', 10))
+# Time range, in days up to today, of the results refresh() computes ahead
+WARM_DAYS = int(os.environ.get('TELEMETRY_DASHBOARD_WARM_DAYS', 90))
+
+TIMESTAMP = 'timestamptz'
+TEXT = 'text'
+TEXT_ARRAY = 'text[]'
+
+_RANGE = (('time_from', TIMESTAMP), ('time_to', TIMESTAMP))
+_VERSIONS = _RANGE + (('display', TEXT), ('major', TEXT_ARRAY), ('minor', TEXT_ARRAY))
+_DEVICES = (('v_class', TEXT_ARRAY), ('v_vendor', TEXT_ARRAY), ('v_model', TEXT_ARRAY))
+
+# schema.function -> ((argument, type), ...), in call order
+FUNCTIONS = {
+    'dashboard.version_to_name': (),
+    'dashboard.minor_versions': (('major', TEXT_ARRAY),),
+    'dashboard.osd_count': (),
+    'dashboard.active_clusters': (),
+    'dashboard.total_capacity': (),
+    'dashboard.version_by_cluster_count': _VERSIONS + (('daemons', TEXT_ARRAY),),
+    'dashboard.version_by_daemon_count': _VERSIONS + (('daemons', TEXT_ARRAY),),
+    'dashboard.active_clusters_dsw': _RANGE,
+    'dashboard.osd_count_dsw': _RANGE,
+    'dashboard.total_capacity_dsw': _RANGE,
+    'dashboard.capacity_by_version': _VERSIONS,
+    'dashboard.cluster_distribution_by_total_capacity': _RANGE,
+    'dashboard.cluster_distribution_by_total_used_capacity': _RANGE,
+    'dashboard.cluster_distribution_by_osd_count': _RANGE,
+    'dashboard.cluster_tib_capacity_percentiles_dsw': _RANGE,
+    'dashboard.cluster_tib_lt_1_pib_capacity_percentiles_dsw': _RANGE,
+    'dashboard.cluster_tib_gt_1_pib_capacity_percentiles_dsw': _RANGE,
+    'dashboard.osd_host_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard.osd_host_lt_1_pib_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard.osd_host_gt_1_pib_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard.tib_osd_capacity_per_osd_count_percentiles_dsw': _RANGE,
+    'dashboard.tib_osd_lt_1_pib_capacity_per_osd_count_percentiles_dsw': _RANGE,
+    'dashboard.tib_osd_gt_1_pib_capacity_per_osd_count_percentiles_dsw': _RANGE,
+    'dashboard.tib_host_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard.tib_host_lt_1_pib_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard.tib_host_gt_1_pib_capacity_per_hosts_percentiles_dsw': _RANGE,
+    'dashboard_device.get_class': (),
+    'dashboard_device.get_vendors': (('v_class', TEXT_ARRAY),),
+    'dashboard_device.get_models': (('v_vendor', TEXT_ARRAY),),
+    'dashboard_device.active_devices': _DEVICES,
+    'dashboard_device.with_valid_telemetry': _DEVICES,
+    'dashboard_device.total_capacity': _DEVICES,
+    'dashboard_device.hosts_all_time': _DEVICES[:2],
+    'dashboard_device.vendors_all_time': _DEVICES[:1],
+    'dashboard_device.models_all_time': _DEVICES[:2],
+    'dashboard_device.devices_by_vendors': _RANGE + _DEVICES,
+    'dashboard_device.active_devices_graph': _RANGE + _DEVICES,
+    'dashboard_device.distinct_hosts': _RANGE + _DEVICES,
+    'dashboard_device.distinct_models': _RANGE + _DEVICES[1:],
+    'dashboard_device.devices_by_type': _RANGE + _DEVICES[1:2],
+    'dashboard_device.ssd_devices_by_interface': _RANGE + _DEVICES[1:2],
+    'dashboard_device.hdd_devices_by_interface': _RANGE + _DEVICES[1:2],
+    'dashboard_device.total_capacity_graph': _RANGE + _DEVICES,
+    'dashboard_device.devices_by_hw_raid': _RANGE,
+    'dashboard_device.devices_by_class': _RANGE,
+    'dashboard_device.invalid_reports_by_device_class': _RANGE + _DEVICES[:1],
+    'dashboard_device.models_count_per_vendor': _DEVICES[1:2],
+    'dashboard_device.models_per_vendor': _DEVICES,
+}
+
+CACHE = metrics.Counter(
+    'telemetry_dashboard_cache_total',
+    'Dashboard function lookups, by where the result came from (memory, shared or computed)',
+    ('function', 'result'))
+SAVED = metrics.Counter(
+    'telemetry_dashboard_backend_seconds_saved_total',
+    'Database time cache hits would have cost, as measured when the results were computed',
+    ('function',))
+
+
+def _parse_timestamp(value):
+    # Grafana sends epoch milliseconds ($__from/$__to)
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value) / 1000, datetime.timezone.utc)
+    stamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+    return stamp.astimezone(datetime.timezone.utc)
+
+
+def _round_day(stamp, up):
+    day = stamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if up and day != stamp:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+def parse_args(function, args):
+    '''
+    Return the arguments of function from args, a dict of lists (e.g.
+    request.args.to_dict(flat=False)), as a tuple of strings and
+    sorted lists.  Raises ValueError for unknown functions and missing,
+    extra or malformed arguments.
+    '''
+    if function not in FUNCTIONS:
+        raise ValueError(f"unknown function {function}")
+    params = FUNCTIONS[function]
+    extra = set(args) - {name for name, _ in params}
+    if extra:
+        raise ValueError(f"unexpected arguments {', '.join(sorted(extra))}")
+    values = []
+    for name, kind in params:
+        given = args.get(name)
+        if kind == TEXT_ARRAY:
+            values.append(sorted(set(given or [])))
+            continue
+        if not given or len(given) != 1:
+            raise ValueError(f"give one {name} argument")
+        if kind == TIMESTAMP:
+            try:
+                stamp = _parse_timestamp(given[0])
+            except (ValueError, OverflowError, OSError):
+                raise ValueError(f"invalid timestamp {given[0]!r} for {name}")
+            values.append(_round_day(stamp, up=name == 'time_to').isoformat())
+        else:
+            values.append(given[0])
+    return tuple(values)
+
+
+def _jsonable(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def compute(cur, function, values):
+    '''
+    Run function and return (encoded result, seconds it took).
+    '''
+    casts = ', '.join(f"%s::{kind}" for _, kind in FUNCTIONS[function])
+    start = time.perf_counter()
+    with metrics.STAGE_SECONDS.time('dashboard', 'postgres'):
+        cur.execute(f"SELECT * FROM {function}({casts})", values)
+        rows = cur.fetchall()
+    seconds = time.perf_counter() - start
+    result = {
+        'function': function,
+        'columns': [column[0] for column in cur.description],
+        'rows': [[_jsonable(v) for v in row] for row in rows],
+    }
+    return serialize.dumps(result), seconds
+
+
+def etag(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class AggregateCache(object):
+    '''
+    A process' view of the cache: an LRU of results bounded by their
+    size, and the generations they belong to.
+    '''
+    def __init__(self, max_bytes=CACHE_BYTES, generation_ttl=GENERATION_TTL):
+        self.max_bytes = max_bytes
+        self.generation_ttl = generation_ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._generations_read = None
+        self._lock = threading.Lock()
+
+    def generations(self, cur):
+        now = time.monotonic()
+        if self._generations_read is None or now - self._generations_read > self.generation_ttl:
+            cur.execute('SELECT schema_name, generation FROM dashboard.cache_generation')
+            generations = dict(cur.fetchall())
+            with self._lock:
+                if generations != self._generations:
+                    # results of older generations can't be asked for again
+                    for key in [k for k in self._entries if generations.get(k[0]) != k[1]]:
+                        self.size -= len(self._entries.pop(key)[0])
+                self._generations = generations
+                self._generations_read = now
+        return self._generations
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, data, seconds):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._entries[key] = (data, seconds)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, cur, function, values):
+        '''
+        Return the encoded result of function(*values), from this
+        process, the shared table or the database, in that order.
+        '''
+        schema = function.split('.', 1)[0]
+        generation = self.generations(cur).get(schema, 0)
+        args = json.dumps(values)
+        key = (schema, generation, function, args)
+
+        entry = self._get(key)
+        if entry is not None:
+            CACHE.inc(function, 'memory')
+            SAVED.inc(function, amount=entry[1])
+            return entry[0]
+
+        cur.execute('SELECT result, backend_seconds FROM dashboard.cache '
+                    'WHERE function = %s AND args = %s AND generation = %s',
+                    (function, args, generation))
+        row = cur.fetchone()
+        if row is not None:
+            data, seconds = row[0].encode('utf-8'), row[1]
+            CACHE.inc(function, 'shared')
+            SAVED.inc(function, amount=seconds)
+        else:
+            data, seconds = compute(cur, function, values)
+            store(cur, function, args, generation, data, seconds)
+            CACHE.inc(function, 'computed')
+        self._put(key, data, seconds)
+        return data
+
+
+def store(cur, function, args, generation, data, seconds):
+    cur.execute('INSERT INTO dashboard.cache (function, args, generation, result, backend_seconds) '
+                'VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING',
+                (function, args, generation, data.decode('utf-8'), seconds))
+
+
+def warm_calls(schema, days=WARM_DAYS):
+    '''
+    The calls of schema whose arguments are known without a user: no
+    arguments, or just the time range of the last `days` days.
+    '''
+    today = datetime.datetime.now(datetime.timezone.utc)
+    time_range = (_round_day(today - datetime.timedelta(days=days), up=False).isoformat(),
+                  _round_day(today, up=True).isoformat())
+    for function, params in FUNCTIONS.items():
+        if not function.startswith(schema + '.'):
+            continue
+        if params == ():
+            yield function, ()
+        elif params == _RANGE:
+            yield function, time_range
+
+
+def refresh(conn, schema, warm=True):
+    '''
+    Invalidate the cached results of schema after an import, then
+    compute the common ones ahead of the dashboards.  Commits.
+    '''
+    cur = conn.cursor()
+    cur.execute('UPDATE dashboard.cache_generation SET generation = generation + 1, updated = now() '
+                'WHERE schema_name = %s RETURNING generation', (schema,))
+    generation = cur.fetchone()[0]
+    cur.execute('DELETE FROM dashboard.cache WHERE function LIKE %s AND generation < %s',
+                (schema + '.%', generation))
+    conn.commit()
+    if warm:
+        for function, values in warm_calls(schema):
+            data, seconds = compute(cur, function, values)
+            store(cur, function, json.dumps(values), generation, data, seconds)
+            conn.commit()
+    cur.close()
+    return generation
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''
+asyncio entry point for the ingest endpoints (/, /report and /device),
+an alternative to the WSGI app for many slow uploaders.  /metrics is
+served on a separate internal address, TELEMETRY_AIO_METRICS_HOST and
+TELEMETRY_AIO_METRICS_PORT (127.0.0.1:9100 by default).
+
+Request bodies are read without blocking the event loop, so one
+process can hold thousands of uploads in progress.  Once a body is
+complete, decompression, parsing and sanitizing run in a small thread
+pool with the same code as the Flask resources, and reports are
+inserted through an asyncpg pool.  Requires aiohttp and asyncpg.
+
+    python3 -m ceph_telemetry.aio --port 9000
+
+or, with several processes:
+
+    gunicorn ceph_telemetry.aio:create_app --worker-class aiohttp.GunicornWebWorker -w 4
+'''
+import argparse
+import asyncio
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+import psycopg2.extensions
+from aiohttp import web
+from werkzeug.exceptions import HTTPException
+
+from ceph_telemetry import body, crashes, db, dedup, encoding, metrics, ratelimit, serialize, shards, spool
+from ceph_telemetry.rest.device import MAX_DEVICE_REPORT_SIZE, device_rows
+from ceph_telemetry.rest.report import MAX_REPORT_SIZE, Report, recent_reports, valid_key
+
+# Uploads being received or processed at once; more get 503
+MAX_UPLOADS = int(os.environ.get('TELEMETRY_AIO_MAX_UPLOADS', 4096))
+# Threads decompressing, parsing and sanitizing complete uploads
+WORKERS = int(os.environ.get('TELEMETRY_AIO_WORKERS', 4))
+# Internal address of /metrics; shared by the processes of a gunicorn
+# server, so a scrape sees one of them
+METRICS_HOST = os.environ.get('TELEMETRY_AIO_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('TELEMETRY_AIO_METRICS_PORT', 9100))
+
+INSERT_REPORT = '''
+INSERT INTO report (cluster_id, report_stamp, report)
+VALUES ($1, $2::text::timestamp, $3)
+ON CONFLICT DO NOTHING
+'''
+INSERT_DEVICE_ROWS = '''
+INSERT INTO device_report (device_id, report_stamp, report)
+SELECT * FROM unnest($1::text[], $2::timestamp[], $3::text[])
+ON CONFLICT DO NOTHING
+'''
+INSERT_CRASH_ROWS = '''
+INSERT INTO crash (crash_id, cluster_id, raw_report, timestamp, entity_name, version, stack_sig, stack)
+SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::text[]::timestamp[],
+                     $5::text[], $6::text[], $7::text[], $8::text[])
+ON CONFLICT DO NOTHING
+'''
+
+
+def _connect_args(dsn):
+    # asyncpg takes URIs or keywords, not libpq key=value strings
+    args = psycopg2.extensions.parse_dsn(dsn)
+    if 'dbname' in args:
+        args['database'] = args.pop('dbname')
+    if 'port' in args:
+        args['port'] = int(args['port'])
+    return args
+
+
+async def read_body(request, endpoint, max_size):
+    '''
+    Read the raw (possibly compressed) body, at most max_size bytes.
+    '''
+    if request.content_length is not None and request.content_length > max_size:
+        body.REJECTED.inc(endpoint, 'too_large')
+        raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=request.content_length)
+    buf = bytearray()
+    while True:
+        chunk = await request.content.read(body.CHUNK_SIZE)
+        if not chunk:
+            return bytes(buf)
+        if len(buf) + len(chunk) > max_size:
+            body.REJECTED.inc(endpoint, 'too_large')
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(buf) + len(chunk))
+        buf += chunk
+
+
+def decode(endpoint, content_encoding, wire, max_size):
+    '''
+    Decompress and parse an upload, at most max_size bytes of it once
+    decompressed.  Runs in the worker pool.
+    '''
+    encoding.WIRE_BYTES.inc(content_encoding, amount=len(wire))
+    if content_encoding == 'identity':
+        data = wire
+    else:
+        stream = encoding.STREAMS[content_encoding](io.BytesIO(wire))
+        buf = bytearray()
+        while True:
+            try:
+                chunk = stream.read(body.CHUNK_SIZE)
+            except encoding.DecodeError as e:
+                body.REJECTED.inc(endpoint, 'bad_encoding')
+                logging.warning(f"rejected a {endpoint} upload: {e}")
+                raise web.HTTPBadRequest()
+            if not chunk:
+                break
+            if len(buf) + len(chunk) > max_size:
+                body.REJECTED.inc(endpoint, 'too_large')
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(buf) + len(chunk))
+            buf += chunk
+        data = bytes(buf)
+    encoding.DECODED_BYTES.inc(content_encoding, amount=len(data))
+    metrics.BODY_BYTES.observe(len(data), endpoint)
+    with metrics.STAGE_SECONDS.time(endpoint, 'parse'):
+        try:
+            return body.parse_json(endpoint, data)
+        except HTTPException:
+            raise web.HTTPBadRequest()
+
+
+def prepare_report(endpoint, content_encoding, wire):
+    '''
+    Returns (key, Report, encoded report, new crash rows), with Report
+    and data None for a recently stored duplicate, or None if the report
+    isn't valid.
+    '''
+    report = Report(decode(endpoint, content_encoding, wire, MAX_REPORT_SIZE))
+    if not isinstance(report.report, dict):
+        body.REJECTED.inc(endpoint, 'invalid')
+        raise web.HTTPBadRequest()
+    if 'report_id' not in report.report or 'report_timestamp' not in report.report:
+        return None
+    if not valid_key(report.report):
+        body.REJECTED.inc(endpoint, 'invalid')
+        raise web.HTTPBadRequest()
+    key = (str(report.report['report_id']), str(report.report['report_timestamp']))
+    if key in recent_reports:
+        return key, None, None, None
+    data = report.sanitize()
+    with metrics.STAGE_SECONDS.time(endpoint, 'crashes'):
+        crash_rows = crashes.new_crash_rows(report.report)
+    return key, report, data, crash_rows
+
+
+class IngestServer(object):
+    def __init__(self, max_uploads=MAX_UPLOADS, workers=WORKERS):
+        self.uploads = asyncio.Semaphore(max_uploads)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pool = None
+        self.internal = None
+
+    async def start(self, app):
+        # the asyncpg pool only reaches the primary database; the spool
+        # drain routes reports to their shards
+        if shards.get_router().sharded and not spool.enabled():
+            raise RuntimeError('with sharded storage the asyncio server needs TELEMETRY_INGEST_MODE=spool')
+        self.pool = await asyncpg.create_pool(
+            min_size=db.POOL_MIN_CONN,
+            max_size=db.POOL_MAX_CONN,
+            timeout=db.POOL_TIMEOUT,
+            **_connect_args(db.load_dsn()))
+        internal = web.Application()
+        internal.router.add_get('/metrics', self.get_metrics)
+        self.internal = web.AppRunner(internal)
+        await self.internal.setup()
+        await web.TCPSite(self.internal, METRICS_HOST, METRICS_PORT, reuse_port=True).start()
+
+    async def stop(self, app):
+        if self.internal is not None:
+            await self.internal.cleanup()
+        if self.pool is not None:
+            await self.pool.close()
+        self.executor.shutdown(wait=False)
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        resource = request.match_info.route.resource
+        ep = (resource.canonical.strip('/') or 'index') if resource is not None else 'unknown'
+        if request.method == 'PUT' and self.uploads.locked():
+            metrics.RESPONSES.inc(ep, '503')
+            return web.json_response({'status': False}, status=503)
+        start = time.perf_counter()
+        metrics.IN_FLIGHT.inc(ep)
+        status = 500
+        try:
+            async with self.uploads:
+                response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.IN_FLIGHT.dec(ep)
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, ep)
+            metrics.RESPONSES.inc(ep, str(status))
+            if status >= 500:
+                metrics.ERRORS.inc(ep)
+
+    async def read_upload(self, request, endpoint, max_size):
+        content_encoding = request.headers.get('Content-Encoding', 'identity').strip().lower() or 'identity'
+        if content_encoding != 'identity' and content_encoding not in encoding.STREAMS:
+            encoding.REQUESTS.inc('unsupported')
+            raise web.HTTPUnsupportedMediaType(text=f"unsupported Content-Encoding {content_encoding}\n")
+        encoding.REQUESTS.inc(content_encoding)
+        with metrics.STAGE_SECONDS.time(endpoint, 'read'):
+            wire = await read_body(request, endpoint, max_size)
+        return content_encoding, wire
+
+    async def index(self, request):
+        return web.json_response({'status': True})
+
+    async def get_metrics(self, request):
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    async def check_rate(self, endpoint, key):
+        '''
+        Answer 429 as ratelimit.check() does.
+        '''
+        wait = await self.run(ratelimit.wait_for, endpoint, key)
+        if wait:
+            raise web.HTTPTooManyRequests(headers={'Retry-After': str(int(wait) + 1)},
+                                          text='{"status": false, "error": "rate limited"}',
+                                          content_type='application/json')
+
+    async def report(self, request):
+        content_encoding, wire = await self.read_upload(request, 'report', MAX_REPORT_SIZE)
+        prepared = await self.run(prepare_report, 'report', content_encoding, wire)
+        if prepared is None:
+            return web.json_response(None)
+        key, report, data, crash_rows = prepared
+        await self.check_rate('report', key[0])
+        if report is None:
+            dedup.DUPLICATES.inc('report', 'cache')
+            return web.json_response({'status': True})
+
+        stage = metrics.STAGE_SECONDS.time
+        if len(data) < MAX_REPORT_SIZE and spool.enabled():
+            with stage('report', 'spool'):
+                await self.run(report.post_to_spool, data, crash_rows)
+            recent_reports.add(key)
+            return web.json_response({'status': True})
+
+        with stage('report', 'archive'):
+            await self.run(report.post_to_file, data)
+        if len(data) < MAX_REPORT_SIZE:
+            with stage('report', 'postgres'):
+                result = await self.insert_report(key, data, crash_rows)
+            if result.endswith(' 0'):
+                dedup.DUPLICATES.inc('report', 'database')
+            recent_reports.add(key)
+        else:
+            logging.warning(f"report_id {report._report_id()} was not posted to postgres due to its size ({len(data)} bytes)")
+        return web.json_response({'status': True})
+
+    async def insert_report(self, key, data, crash_rows):
+        '''
+        Insert a report and its new crashes; returns the report INSERT's
+        status.  As in crashes.insert(), a failed crash insert doesn't
+        fail the report.
+        '''
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute(INSERT_REPORT, key[0], key[1], data.decode('utf-8'))
+                crashes_inserted = False
+                if crash_rows:
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(INSERT_CRASH_ROWS, *(list(c) for c in zip(*crash_rows)))
+                        crashes_inserted = True
+                    except asyncpg.PostgresError as e:
+                        logging.warning(f"failed to insert {len(crash_rows)} crashes of cluster {key[0]}: {e}")
+        if crashes_inserted:
+            crashes.remember(crash_rows)
+        return result
+
+    async def device(self, request):
+        await self.check_rate('device', ratelimit.device_key(request.remote))
+        content_encoding, wire = await self.read_upload(request, 'device', MAX_DEVICE_REPORT_SIZE)
+        upload = await self.run(decode, 'device', content_encoding, wire, MAX_DEVICE_REPORT_SIZE)
+
+        stage = metrics.STAGE_SECONDS.time
+        # also in spool mode, so that the drain never sees a bad upload
+        try:
+            with stage('device', 'rows'):
+                rows = await self.run(device_rows, upload)
+        except ValueError as e:
+            body.REJECTED.inc('device', 'invalid')
+            logging.warning(f"rejected a device upload: {e}")
+            raise web.HTTPBadRequest()
+
+        if spool.enabled():
+            with stage('device', 'spool'):
+                data = await self.run(serialize.dumps, upload)
+                await self.run(spool.get_spool().append, 'device', {}, data)
+            return web.json_response({'status': True})
+
+        inserted = 0
+        if rows:
+            with stage('device', 'postgres'):
+                result = await self.pool.execute(INSERT_DEVICE_ROWS, *(list(c) for c in zip(*rows)))
+            inserted = int(result.split()[-1])
+        return web.json_response({'status': True, 'inserted': inserted, 'duplicates': len(rows) - inserted})
+
+
+def create_app():
+    server = IngestServer()
+    # Bodies are decompressed by us, with a size cap, not by aiohttp
+    app = web.Application(middlewares=[server.middleware],
+                          handler_args={'auto_decompress': False})
+    app.router.add_get('/', server.index)
+    app.router.add_put('/report', server.report)
+    app.router.add_put('/device', server.device)
+    app.on_startup.append(server.start)
+    app.on_cleanup.append(server.stop)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ceph Telemetry REST API (asyncio)')
+    parser.add_argument("--host", action="store", dest="host",
+                        default="::", help="Host/IP to bind on")
+    parser.add_argument("--port", action="store", dest="port", type=int,
+                        default=9000, help="Port to listen on")
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,9 @@
 import argparse
 from flask_restful import Api
 from flask import Flask
-from ceph_telemetry.rest import Index, Report, Device
+from ceph_telemetry import metrics
+from ceph_telemetry.rest import Index, Report, Reports, Projection, Device, Dashboard, Metrics
+from ceph_telemetry.encoding import DecompressMiddleware
 
 
 def create_app(name):
@@ -10,7 +12,26 @@ def create_app(name):
     api = Api(app, catch_all_404s=True)
     api.add_resource(Index, '/')
     api.add_resource(Report, '/report')
+    api.add_resource(Reports, '/reports')
     api.add_resource(Device, '/device')
+    metrics.instrument(app)
+    # Accept gzip and zstd compressed uploads
+    app.wsgi_app = DecompressMiddleware(app.wsgi_app, ('/report', '/reports', '/device'))
+    return app
+
+
+def create_internal_app(name):
+    '''
+    Endpoints for the operators only, served on an internal address
+    (see internal.wsgi) by the same processes as the public app.
+    '''
+    app = Flask(name)
+    api = Api(app, catch_all_404s=True)
+    api.add_resource(Metrics, '/metrics')
+    # reads stored reports, private channels included
+    api.add_resource(Projection, '/report/<string:cluster_id>/<string:report_stamp>')
+    # each new argument tuple costs a query and a dashboard.cache row
+    api.add_resource(Dashboard, '/dashboard/<string:function>')
     return app
 
 
@@ -20,6 +41,8 @@ if __name__ == '__main__':
                         default="::", help="Host/IP to bind on")
     parser.add_argument("--port", action="store", dest="port", type=int,
                         default=9000, help="Port to listen on")
+    parser.add_argument("--internal", action="store_true",
+                        help="Serve the internal endpoints instead of the public ones")
     args = parser.parse_args()
-    app = create_app(__name__)
+    app = create_internal_app(__name__) if args.internal else create_app(__name__)
     app.run(debug=True, host=args.host, port=args.port)
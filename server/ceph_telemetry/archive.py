@@ -0,0 +1,173 @@
+'''
+Raw report archive.
+
+Reports are written as compact JSON compressed with zstd, using a
+dictionary trained on earlier reports: telemetry reports share most of
+their structure, so a dictionary compresses them far better than gzip.
+Each file starts with a small header:
+
+    MAGIC (4 bytes) | dictionary id (uint32, big endian, 0 = none) | zstd frame
+
+Older archives hold one plain JSON file per report, or such files
+gzipped by compress_raw_reports_telemetry.sh; decompress() and
+read_file() handle all three.  Reports are stored in daily segment
+files, see segments.py; raw_archive.py is the command line tool.
+'''
+import gzip
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+# zstandard is optional; without it reports are gzipped instead.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_DIR = '/opt/telemetry/raw'
+DICT_DIR = '/opt/telemetry/raw_dicts'
+# Holds the id of the dictionary new files are compressed with
+CURRENT_DICT_FILE = 'current'
+
+COMPRESSION_LEVEL = 6
+DICT_SIZE = 112640
+TRAIN_SAMPLES = 2000
+# Seconds between checks for a newly trained dictionary
+DICT_CHECK_INTERVAL = 60
+
+MAGIC = b'CTZ\x01'
+_HEADER = struct.Struct('>4sI')
+GZIP_MAGIC = b'\x1f\x8b'
+
+_dicts = {}
+_current = {'id': 0, 'checked': 0, 'mtime': None}
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def load_dict(dict_id):
+    d = _dicts.get(dict_id)
+    if d is None:
+        with open(os.path.join(DICT_DIR, f"{dict_id}.dict"), 'rb') as f:
+            d = zstandard.ZstdCompressionDict(f.read())
+        d.precompute_compress(level=COMPRESSION_LEVEL)
+        _dicts[dict_id] = d
+    return d
+
+
+def current_dict_id():
+    '''
+    Id of the dictionary to compress with, re-read from disk at most
+    every DICT_CHECK_INTERVAL seconds. 0 means no dictionary.
+    '''
+    now = time.monotonic()
+    if now - _current['checked'] < DICT_CHECK_INTERVAL:
+        return _current['id']
+    with _lock:
+        _current['checked'] = now
+        path = os.path.join(DICT_DIR, CURRENT_DICT_FILE)
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime != _current['mtime']:
+                with open(path, 'r') as f:
+                    _current['id'] = int(f.read().strip())
+                _current['mtime'] = mtime
+        except FileNotFoundError:
+            _current['id'] = 0
+    return _current['id']
+
+
+def _compressor(dict_id):
+    # ZstdCompressor objects must not be shared between threads
+    compressors = getattr(_local, 'compressors', None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+    c = compressors.get(dict_id)
+    if c is None:
+        if dict_id:
+            c = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=load_dict(dict_id))
+        else:
+            c = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+        compressors[dict_id] = c
+    return c
+
+
+def compress(data):
+    if zstandard is None:
+        return gzip.compress(data)
+    dict_id = current_dict_id()
+    return _HEADER.pack(MAGIC, dict_id) + _compressor(dict_id).compress(data)
+
+
+# What decompress() raises for a corrupt or truncated blob
+DECOMPRESS_ERRORS = (OSError, EOFError, ValueError, struct.error, zlib.error) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def decompress(blob):
+    '''
+    Return the JSON bytes of an archived report in any of the formats.
+    '''
+    if blob[:len(MAGIC)] == MAGIC:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read this archive')
+        _, dict_id = _HEADER.unpack_from(blob)
+        if dict_id:
+            d = zstandard.ZstdDecompressor(dict_data=load_dict(dict_id))
+        else:
+            d = zstandard.ZstdDecompressor()
+        return d.decompress(blob[_HEADER.size:])
+    if blob[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.decompress(blob)
+    return blob
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return decompress(f.read())
+
+
+def sample_files(directory, count):
+    '''
+    Pick `count` archive files uniformly at random (reservoir sampling,
+    so the directory is only listed once).
+    '''
+    sample = []
+    with os.scandir(directory) as it:
+        for n, entry in enumerate(it):
+            if not entry.is_file():
+                continue
+            if len(sample) < count:
+                sample.append(entry.path)
+            else:
+                i = random.randint(0, n)
+                if i < count:
+                    sample[i] = entry.path
+    return sample
+
+
+def train(data, size=DICT_SIZE):
+    '''
+    Train a dictionary on a sample of reports (JSON bytes), save it and
+    make it the one new reports are compressed with.  Older dictionaries
+    are kept; reports compressed with them remain readable.
+
+    Returns (dictionary id, sample bytes, sample bytes compressed).
+    '''
+    d = zstandard.train_dictionary(size, data, level=COMPRESSION_LEVEL)
+    dict_id = d.dict_id()
+
+    os.makedirs(DICT_DIR, exist_ok=True)
+    with open(os.path.join(DICT_DIR, f"{dict_id}.dict"), 'wb') as f:
+        f.write(d.as_bytes())
+    tmp = os.path.join(DICT_DIR, CURRENT_DICT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(str(dict_id))
+    os.rename(tmp, os.path.join(DICT_DIR, CURRENT_DICT_FILE))
+
+    raw = sum(len(x) for x in data)
+    packed = sum(len(zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=d).compress(x)) for x in data)
+    return dict_id, raw, packed
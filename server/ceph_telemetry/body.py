@@ -0,0 +1,83 @@
+import json
+import logging
+
+from flask import request, abort
+
+from ceph_telemetry import encoding, metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bytes read from the request stream per call
+CHUNK_SIZE = 64 * 1024
+
+REJECTED = metrics.Counter(
+    'telemetry_rejected_uploads_total',
+    'Uploads rejected before being stored',
+    ('endpoint', 'reason'))
+
+
+def read_body(endpoint, max_size, check_head=None):
+    '''
+    Read the request body in chunks, giving up with 413 as soon as it
+    grows past max_size.  A Content-Length above the limit is refused
+    before anything is read.  Compressed bodies arrive here already
+    decompressed by encoding.DecompressMiddleware, so the limit applies
+    to their decompressed size.
+
+    check_head, if given, is called with the first chunk before the
+    rest of the body is read, and may abort the request.
+    '''
+    if request.content_length is not None and request.content_length > max_size:
+        REJECTED.inc(endpoint, 'too_large')
+        logging.warning(f"rejected a {endpoint} upload due to its size ({request.content_length} bytes)")
+        abort(413)
+
+    stream = request.stream
+    buf = bytearray()
+    while True:
+        try:
+            chunk = stream.read(CHUNK_SIZE)
+        except encoding.DecodeError as e:
+            REJECTED.inc(endpoint, 'bad_encoding')
+            logging.warning(f"rejected a {endpoint} upload: {e}")
+            abort(400)
+        if not chunk:
+            break
+        if check_head is not None and not buf:
+            check_head(chunk)
+        if len(buf) + len(chunk) > max_size:
+            REJECTED.inc(endpoint, 'too_large')
+            logging.warning(f"rejected a {endpoint} upload exceeding {max_size} bytes while reading")
+            abort(413)
+        buf += chunk
+    return buf
+
+
+def read_json(endpoint, max_size, check_head=None):
+    '''
+    Return the parsed JSON body of the request, reading at most
+    max_size bytes of it.
+    '''
+    with metrics.STAGE_SECONDS.time(endpoint, 'read'):
+        buf = read_body(endpoint, max_size, check_head)
+    metrics.BODY_BYTES.observe(len(buf), endpoint)
+    with metrics.STAGE_SECONDS.time(endpoint, 'parse'):
+        return parse_json(endpoint, buf)
+
+
+def parse_json(endpoint, buf):
+    if orjson is not None:
+        try:
+            return orjson.loads(buf)
+        except ValueError:
+            # orjson is stricter than json (NaN, >64 bit integers);
+            # let the stdlib parser have the final word.
+            pass
+    try:
+        return json.loads(buf)
+    except ValueError:
+        REJECTED.inc(endpoint, 'invalid_json')
+        abort(400)
@@ -0,0 +1,254 @@
+'''
+Crash extraction at ingest time.
+
+Every report carries the recent crashes of its cluster, so the same
+crash arrives again and again until it ages out.  While a report is
+parsed anyway, its crashes get their stack signature and the ones not
+seen before are inserted into the crash table along with the report.
+
+Seen crash_ids are remembered in a Bloom filter in a file mapped by
+every server process on the host, so it survives restarts and a known
+crash costs a few bit tests instead of a database round trip.  A crash
+is only remembered once its insert is committed.  A false positive
+means a new crash is skipped; at FILTER_ERROR_RATE that is rare, and
+crashsigs.py --all picks such crashes up from the stored reports.
+'''
+import datetime
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+import psycopg2
+import psycopg2.extras
+
+from ceph_telemetry import metrics
+
+FILTER_FILE = os.environ.get('TELEMETRY_CRASH_FILTER', '/opt/telemetry/crash_filter.bin')
+# crash_ids the filter is sized for, and its false positive rate at that size
+FILTER_CAPACITY = int(os.environ.get('TELEMETRY_CRASH_FILTER_CAPACITY', 10000000))
+FILTER_ERROR_RATE = float(os.environ.get('TELEMETRY_CRASH_FILTER_ERROR_RATE', 1e-5))
+
+# Column sizes of the crash table
+MAX_CRASH_ID = 128
+MAX_ENTITY_NAME = 64
+MAX_VERSION = 64
+
+INSERT_CRASHES = '''
+INSERT INTO crash (crash_id, cluster_id, raw_report, timestamp, entity_name, version, stack_sig, stack)
+VALUES %s ON CONFLICT DO NOTHING
+'''
+
+CRASHES = metrics.Counter(
+    'telemetry_crashes_total',
+    'Crashes found in reports, by whether they were new to this host',
+    ('result',))
+
+# (?s) allows matching newline.  get everything up to "thread" and
+# then after-and-including the last colon-space.  This skips the
+# thread id, timestamp, and file:lineno, because file is already in
+# the beginning, and lineno may vary.
+_ASSERT_MSG = re.compile(r'(?s)(.*) thread .* time .*(: .*)\n')
+
+
+def sanitize_backtrace(bt):
+    ret = list()
+    for func_record in bt:
+        # split into two fields on last space, take the first one,
+        # strip off leading ( and trailing )
+        func_plus_offset = func_record.rsplit(' ', 1)[0][1:-1]
+        ret.append(func_plus_offset.split('+')[0])
+    return ret
+
+
+def sanitize_assert_msg(msg):
+    m = _ASSERT_MSG.match(msg)
+    if m is None:
+        # not the usual ceph_assert format; keep it whole
+        return msg
+    return ''.join(m.groups())
+
+
+def clip(value, size):
+    '''
+    Return value as a string of at most size characters, or None.
+    '''
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return value[:size]
+
+
+def parse_timestamp(value):
+    '''
+    Return a crash timestamp ('2020-01-01 00:00:00.000000Z') as a
+    datetime, or None if it isn't one.
+    '''
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.rstrip('Z'))
+    except ValueError:
+        return None
+
+
+def calc_sig(bt, assert_msg):
+    sig = hashlib.sha256()
+    for func in sanitize_backtrace(bt or []):
+        sig.update(func.encode())
+    if assert_msg:
+        sig.update(sanitize_assert_msg(assert_msg).encode())
+    return sig.hexdigest()
+
+
+class CrashFilter(object):
+    '''
+    Bloom filter of crash_ids.  The bit array is a shared mapping of
+    path; processes setting bits concurrently may lose one, which only
+    costs a redundant insert.  A file sized for other parameters is
+    started over.
+    '''
+    def __init__(self, path=FILTER_FILE, capacity=FILTER_CAPACITY, error_rate=FILTER_ERROR_RATE):
+        self.path = path
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = int(math.ceil(bits / 8))
+        self.bits = self.size * 8
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def _positions(self, crash_id):
+        # double hashing: k positions from two 64 bit hashes
+        digest = hashlib.blake2b(crash_id.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def __contains__(self, crash_id):
+        m = self._map
+        return all(m[p >> 3] & (1 << (p & 7)) for p in self._positions(crash_id))
+
+    def add(self, crash_id):
+        m = self._map
+        for p in self._positions(crash_id):
+            m[p >> 3] |= 1 << (p & 7)
+
+    def close(self):
+        self._map.close()
+
+
+_filter = None
+_filter_pid = None
+_filter_lock = threading.Lock()
+
+
+def get_filter():
+    global _filter, _filter_pid
+    pid = os.getpid()
+    if _filter is None or _filter_pid != pid:
+        with _filter_lock:
+            if _filter is None or _filter_pid != pid:
+                _filter = CrashFilter()
+                _filter_pid = pid
+    return _filter
+
+
+def new_crash_rows(report, known=None):
+    '''
+    Return crash table rows for the crashes of a sanitized report
+    (crashes as a list, entity names obfuscated) whose crash_id isn't
+    known yet.
+    '''
+    crashes = report.get('crashes')
+    if not crashes or not isinstance(crashes, list):
+        return []
+    if known is None:
+        known = get_filter()
+    cluster_id = report.get('report_id')
+    rows = []
+    seen = set()
+    for crash in crashes:
+        crash_id = crash.get('crash_id') if isinstance(crash, dict) else None
+        if not crash_id or not isinstance(crash_id, str) or len(crash_id) > MAX_CRASH_ID:
+            CRASHES.inc('invalid')
+            continue
+        if crash_id in seen or crash_id in known:
+            CRASHES.inc('known')
+            continue
+        seen.add(crash_id)
+        stack = crash.get('backtrace')
+        try:
+            sig = calc_sig(stack, crash.get('assert_msg'))
+        except (AttributeError, IndexError, TypeError):
+            CRASHES.inc('invalid')
+            continue
+        CRASHES.inc('new')
+        # fit the columns, so that one odd crash doesn't fail the insert;
+        # the whole crash is still in raw_report
+        timestamp = parse_timestamp(crash.get('timestamp'))
+        rows.append((crash_id,
+                     cluster_id,
+                     json.dumps(crash, indent=4),
+                     timestamp.isoformat() if timestamp else None,
+                     clip(crash.get('entity_name'), MAX_ENTITY_NAME),
+                     clip(crash.get('ceph_version'), MAX_VERSION),
+                     sig,
+                     str(stack)))
+    return rows
+
+
+def _insert(cur, rows):
+    '''
+    Insert rows in a savepoint; returns False if it was rolled back.
+    '''
+    cur.execute('SAVEPOINT crashes')
+    try:
+        psycopg2.extras.execute_values(cur, INSERT_CRASHES, [tuple(row) for row in rows])
+    except psycopg2.Error as e:
+        cur.execute('ROLLBACK TO SAVEPOINT crashes')
+        logging.warning(f"failed to insert {len(rows)} crashes of cluster {rows[0][1]}: {e}")
+        return False
+    cur.execute('RELEASE SAVEPOINT crashes')
+    return True
+
+
+def insert(cur, rows):
+    '''
+    Insert rows in the current transaction and return the ones that
+    were, to be remembered once it commits.  A bad crash must not fail
+    the reports it came with, so the insert runs in a savepoint; if it
+    fails, the rows are inserted again cluster by cluster, so that only
+    the crashes of the cluster that sent the bad one are lost.
+    '''
+    if not rows:
+        return []
+    if _insert(cur, rows):
+        return rows
+    clusters = {}
+    for row in rows:
+        clusters.setdefault(row[1], []).append(row)
+    if len(clusters) == 1:
+        return []
+    return [row for group in clusters.values() if _insert(cur, group) for row in group]
+
+
+def remember(rows, known=None):
+    '''
+    Add the crash_ids of committed rows to the filter.
+    '''
+    if known is None:
+        known = get_filter()
+    for row in rows:
+        known.add(row[0])
@@ -0,0 +1,222 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from ceph_telemetry import metrics
+
+# Legacy password file; used to build a DSN when no DSN is configured.
+PG_PASS_FILE = '/opt/telemetry/pg_pass.txt'
+# Data Source Name file, same format as /opt/telemetry/grafana.dsn
+DSN_FILE = '/opt/telemetry/server.dsn'
+
+POOL_MIN_CONN = int(os.environ.get('TELEMETRY_PG_POOL_MIN', 1))
+POOL_MAX_CONN = int(os.environ.get('TELEMETRY_PG_POOL_MAX', 8))
+# Seconds a request waits for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get('TELEMETRY_PG_POOL_TIMEOUT', 30))
+# Connections idle for longer than this are pinged before being handed out
+POOL_CHECK_IDLE = float(os.environ.get('TELEMETRY_PG_POOL_CHECK_IDLE', 60))
+# Log borrows that waited longer than this many seconds
+POOL_SLOW_WAIT = 1.0
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def load_dsn():
+    '''
+    The DSN is taken from $TELEMETRY_DSN, then from DSN_FILE.  If
+    neither exists fall back to the historical local connection with
+    the password in PG_PASS_FILE.
+    '''
+    dsn = os.environ.get('TELEMETRY_DSN')
+    if dsn:
+        return dsn
+    if os.path.isfile(DSN_FILE):
+        with open(DSN_FILE, 'r') as f:
+            return f.read().strip()
+    with open(PG_PASS_FILE, 'r') as f:
+        password = f.read().strip()
+    return psycopg2.extensions.make_dsn(
+        host='localhost',
+        dbname='telemetry',
+        user='telemetry',
+        password=password,
+        )
+
+
+class ConnectionPool(object):
+    '''
+    Bounded, thread-safe pool of long-lived connections.
+
+    psycopg2's ThreadedConnectionPool raises as soon as it is exhausted;
+    a semaphore in front of it makes callers wait (up to `timeout`)
+    for a connection to be returned instead.
+    '''
+    def __init__(self, dsn, minconn=POOL_MIN_CONN, maxconn=POOL_MAX_CONN,
+                 timeout=POOL_TIMEOUT, check_idle=POOL_CHECK_IDLE):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+
+        self.in_use = 0
+        self.max_in_use = 0
+        self.borrows = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"no database connection available after {self.timeout} seconds")
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self.discarded += 1
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self.borrows += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        if waited > POOL_SLOW_WAIT:
+            logging.warning(f"waited {waited:.3f} seconds for a database connection")
+        return conn
+
+    def putconn(self, conn):
+        # Never hand out a connection with a pending or aborted transaction
+        close = conn.closed != 0
+        if not close and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close:
+            self._last_used.pop(id(conn), None)
+            with self._lock:
+                self.discarded += 1
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.maxconn,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'utilization': self.in_use / self.maxconn,
+                'borrows': self.borrows,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'wait_total_seconds': self.wait_total,
+                'wait_avg_seconds': self.wait_total / self.borrows if self.borrows else 0.0,
+                'wait_max_seconds': self.wait_max,
+            }
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited across a fork.  Their connections share sockets with the
+# parent, and collecting them would close those sockets (sending Terminate
+# on the parent's sessions), so they are kept alive but never used.
+_inherited_pools = []
+
+
+def get_pool():
+    '''
+    Return the process-wide pool, creating it on first use.  WSGI servers
+    fork workers after import, so a pool inherited from a parent process
+    is set aside in _inherited_pools, which keeps it from being collected
+    and closing the parent's sockets, and rebuilt.
+    '''
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                if _pool is not None:
+                    _inherited_pools.append(_pool)
+                _pool = ConnectionPool(load_dsn())
+                _pool_pid = pid
+    return _pool
+
+
+def _pool_samples():
+    if _pool is None:
+        return []
+    return [((stat,), value) for stat, value in _pool.stats().items()]
+
+
+POOL_STATS = metrics.Gauge(
+    'telemetry_db_pool',
+    'Database connection pool size, utilization and wait times',
+    ('stat',),
+    callback=_pool_samples)
+
+
+def connection():
+    '''
+    Borrow a connection from the process-wide pool:
+
+        with db.connection() as conn:
+            ...
+            conn.commit()
+
+    Uncommitted work is rolled back when the connection is returned.
+    '''
+    return get_pool().connection()
@@ -0,0 +1,45 @@
+'''
+Recently seen upload keys, so that a client retrying an upload that
+already succeeded can be acknowledged without processing it again.
+The cache is per process and bounded; the database's ON CONFLICT
+clause remains the authority for duplicates the cache doesn't know.
+'''
+import os
+import threading
+from collections import OrderedDict
+
+from ceph_telemetry import metrics
+
+RECENT_KEYS = int(os.environ.get('TELEMETRY_RECENT_KEYS', 100000))
+
+DUPLICATES = metrics.Counter(
+    'telemetry_duplicate_uploads_total',
+    'Uploads that were already stored, by where the duplicate was detected',
+    ('endpoint', 'source'))
+
+
+class RecentKeys(object):
+    '''
+    Thread-safe LRU set of keys.
+    '''
+    def __init__(self, size=RECENT_KEYS):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
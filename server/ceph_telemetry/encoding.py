@@ -0,0 +1,152 @@
+import zlib
+
+from werkzeug.wsgi import LimitedStream
+
+from ceph_telemetry import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed bytes read from the client per call
+CHUNK_SIZE = 64 * 1024
+
+REQUESTS = metrics.Counter(
+    'telemetry_requests_by_encoding_total',
+    'Uploads by Content-Encoding',
+    ('encoding',))
+WIRE_BYTES = metrics.Counter(
+    'telemetry_request_wire_bytes_total',
+    'Upload bytes as received, by Content-Encoding',
+    ('encoding',))
+DECODED_BYTES = metrics.Counter(
+    'telemetry_request_decoded_bytes_total',
+    'Upload bytes after decompression, by Content-Encoding',
+    ('encoding',))
+
+
+class DecodeError(Exception):
+    pass
+
+
+class _CountingStream(object):
+    def __init__(self, raw, encoding):
+        self.raw = raw
+        self.encoding = encoding
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        WIRE_BYTES.inc(self.encoding, amount=len(data))
+        return data
+
+
+class GzipStream(object):
+    '''
+    File-like object yielding the decompressed body.  Each read()
+    returns at most `size` bytes, however well the input compresses, so
+    the reader's size cap is enforced before a bomb is inflated.
+    '''
+    def __init__(self, raw):
+        self.raw = raw
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._tail = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        while True:
+            if self._tail:
+                data, self._tail = self._tail, b''
+            elif self._d.eof and self._d.unused_data:
+                # concatenated gzip members
+                data = self._d.unused_data
+                self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self.raw.read(CHUNK_SIZE)
+                if not data:
+                    if not self._d.eof:
+                        raise DecodeError('truncated gzip body')
+                    return b''
+            try:
+                out = self._d.decompress(data, size)
+            except zlib.error as e:
+                raise DecodeError(f"invalid gzip body: {e}")
+            self._tail = self._d.unconsumed_tail
+            if out:
+                return out
+
+
+class ZstdStream(object):
+    def __init__(self, raw):
+        self._reader = zstandard.ZstdDecompressor().stream_reader(raw, read_size=CHUNK_SIZE)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        try:
+            return self._reader.read(size)
+        except zstandard.ZstdError as e:
+            raise DecodeError(f"invalid zstd body: {e}")
+
+
+class _DecodedStream(object):
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.encoding = encoding
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        DECODED_BYTES.inc(self.encoding, amount=len(data))
+        return data
+
+
+STREAMS = {
+    'gzip': GzipStream,
+    'x-gzip': GzipStream,
+}
+if zstandard is not None:
+    STREAMS['zstd'] = ZstdStream
+
+
+class DecompressMiddleware(object):
+    '''
+    WSGI middleware that transparently decompresses request bodies sent
+    with Content-Encoding gzip or zstd to the given paths.  The
+    resources then see a plain body of unknown length, so their
+    streaming size cap applies to the decompressed size.  Unsupported
+    encodings get 415.
+    '''
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') not in self.paths:
+            return self.app(environ, start_response)
+
+        encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower() or 'identity'
+        if encoding == 'identity':
+            REQUESTS.inc(encoding)
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            WIRE_BYTES.inc(encoding, amount=length)
+            DECODED_BYTES.inc(encoding, amount=length)
+            return self.app(environ, start_response)
+
+        stream_class = STREAMS.get(encoding)
+        if stream_class is None:
+            # don't let clients create arbitrary label values
+            REQUESTS.inc('unsupported')
+            start_response('415 Unsupported Media Type', [('Content-Type', 'text/plain')])
+            return [f"unsupported Content-Encoding {encoding}\n".encode()]
+
+        REQUESTS.inc(encoding)
+        raw = environ['wsgi.input']
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            raw = LimitedStream(raw, int(length))
+        environ['wsgi.input'] = _DecodedStream(stream_class(_CountingStream(raw, encoding)), encoding)
+        environ['wsgi.input_terminated'] = True
+        del environ['HTTP_CONTENT_ENCODING']
+        environ.pop('CONTENT_LENGTH', None)
+        return self.app(environ, start_response)
@@ -0,0 +1,212 @@
+'''
+In-process metrics, exposed in the Prometheus text format by the
+/metrics resource.  Every server process keeps its own values, so a
+scrape sees the process that served it.
+'''
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+# All metrics created through this module, in creation order
+REGISTRY = []
+
+# Seconds; covers sub-millisecond sanitizers up to slow multi-MB uploads
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+# Bytes; 1 KB .. 100 MB
+SIZE_BUCKETS = tuple(10 ** e for e in range(3, 9))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Counter(object):
+    '''
+    Monotonic counter with optional labels:
+
+        UPLOADS = Counter('uploads_total', 'Uploads received', ('endpoint',))
+        UPLOADS.inc('report')
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"
+                for labels, value in self.samples()]
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down.  Instead of being set, a gauge can be
+    given a callback returning [(labels, value), ...] at scrape time.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.callback is not None:
+            return list(self.callback())
+        return super(Gauge, self).samples()
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            v[0][i] += 1
+            v[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        v = self._values.get(labels)
+        return sum(v[0]) if v else 0
+
+    def render(self):
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = _labels(self.labelnames, labels, (('le', bound),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render():
+    '''
+    All registered metrics in the Prometheus text exposition format.
+    '''
+    lines = []
+    for m in REGISTRY:
+        samples = m.render()
+        if not samples:
+            continue
+        lines.append(f"# HELP {m.name} {m.documentation}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'telemetry_request_duration_seconds',
+    'Request latency by endpoint',
+    ('endpoint',))
+STAGE_SECONDS = Histogram(
+    'telemetry_ingest_stage_duration_seconds',
+    'Time spent in each ingest stage',
+    ('endpoint', 'stage'))
+BODY_BYTES = Histogram(
+    'telemetry_request_body_bytes',
+    'Upload size after decompression',
+    ('endpoint',),
+    buckets=SIZE_BUCKETS)
+IN_FLIGHT = Gauge(
+    'telemetry_requests_in_flight',
+    'Requests being served',
+    ('endpoint',))
+RESPONSES = Counter(
+    'telemetry_responses_total',
+    'Responses by endpoint and status code',
+    ('endpoint', 'code'))
+ERRORS = Counter(
+    'telemetry_errors_total',
+    'Requests that failed with a server error',
+    ('endpoint',))
+
+
+def instrument(app):
+    '''
+    Record latency, in-flight requests and status codes for every
+    request served by the Flask app.
+    '''
+    def endpoint():
+        return request.endpoint or 'unknown'
+
+    @app.before_request
+    def _start():
+        g.metrics_start = time.perf_counter()
+        g.metrics_endpoint = endpoint()
+        IN_FLIGHT.inc(g.metrics_endpoint)
+
+    @app.after_request
+    def _finish(response):
+        ep = g.get('metrics_endpoint')
+        if ep is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_start, ep)
+            RESPONSES.inc(ep, str(response.status_code))
+            if response.status_code >= 500:
+                ERRORS.inc(ep)
+            g.metrics_counted = True
+        return response
+
+    @app.teardown_request
+    def _teardown(exc):
+        ep = g.get('metrics_endpoint')
+        if ep is not None:
+            IN_FLIGHT.dec(ep)
+            if exc is not None and not g.get('metrics_counted'):
+                ERRORS.inc(ep)
@@ -0,0 +1,164 @@
+'''
+Projections of reports onto a few JSON paths, so that readers don't
+have to fetch multi-MB reports to look at a handful of keys.
+
+A path is a dotted list of keys with optional array subscripts:
+
+    osd.count
+    pools[*].pg_num
+    crashes[0].backtrace
+
+A [*] subscript makes the result a list of every match; otherwise the
+result is the single value at the path, or None.  Paths are evaluated
+by Postgres (jsonb_path_query) so only the fragments leave the
+database; project() evaluates them on an already decoded report.
+'''
+import re
+import threading
+from collections import OrderedDict
+
+from ceph_telemetry import metrics
+
+# Projections kept per process, by size of their JSON encoding
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_PATHS = 32
+
+WILDCARD = '*'
+_STEP = re.compile(r'([^.\[\]]+)|\[(\d+|\*)\]|(\.)')
+
+CACHE = metrics.Counter(
+    'telemetry_projection_cache_total',
+    'Report projection cache lookups',
+    ('result',))
+
+
+def parse_path(path):
+    '''
+    Return the steps of a path: keys (str), indexes (int) and WILDCARD.
+    Raises ValueError for malformed paths.
+    '''
+    steps = []
+    pos = 0
+    expect_key = True
+    while pos < len(path):
+        m = _STEP.match(path, pos)
+        if m is None:
+            raise ValueError(f"invalid path {path!r} at offset {pos}")
+        key, subscript, dot = m.groups()
+        if key is not None:
+            if not expect_key:
+                raise ValueError(f"invalid path {path!r} at offset {pos}")
+            steps.append(key)
+            expect_key = False
+        elif subscript is not None:
+            if expect_key:
+                raise ValueError(f"invalid path {path!r} at offset {pos}")
+            steps.append(WILDCARD if subscript == '*' else int(subscript))
+        else:
+            if expect_key:
+                raise ValueError(f"invalid path {path!r} at offset {pos}")
+            expect_key = True
+        pos = m.end()
+    if expect_key:
+        raise ValueError(f"invalid path {path!r}")
+    return steps
+
+
+def is_multi(steps):
+    return WILDCARD in steps
+
+
+def to_jsonpath(steps):
+    '''
+    The SQL/JSON path (Postgres jsonpath) equivalent of parsed steps.
+    Strict mode, so that arrays aren't unwrapped implicitly and the
+    result matches project().
+    '''
+    out = ['strict $']
+    for step in steps:
+        if step == WILDCARD:
+            out.append('[*]')
+        elif isinstance(step, int):
+            out.append(f"[{step}]")
+        else:
+            out.append('."' + step.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return ''.join(out)
+
+
+def _walk(node, steps):
+    if not steps:
+        yield node
+        return
+    step, rest = steps[0], steps[1:]
+    if step == WILDCARD:
+        if isinstance(node, list):
+            for item in node:
+                yield from _walk(item, rest)
+    elif isinstance(step, int):
+        if isinstance(node, list) and step < len(node):
+            yield from _walk(node[step], rest)
+    elif isinstance(node, dict) and step in node:
+        yield from _walk(node[step], rest)
+
+
+def project(report, paths):
+    '''
+    Return {path: fragment} for a decoded report.
+    '''
+    result = {}
+    for path in paths:
+        steps = parse_path(path)
+        matches = _walk(report, steps)
+        result[path] = list(matches) if is_multi(steps) else next(matches, None)
+    return result
+
+
+def select_sql(paths):
+    '''
+    Return (select list, params) evaluating paths on the report column.
+    '''
+    columns = []
+    params = []
+    for path in paths:
+        steps = parse_path(path)
+        func = 'jsonb_path_query_array' if is_multi(steps) else 'jsonb_path_query_first'
+        # silent: a missing key is no match rather than an error
+        columns.append(f"{func}(report, %s::jsonpath, '{{}}', true)")
+        params.append(to_jsonpath(steps))
+    return ', '.join(columns), params
+
+
+class ProjectionCache(object):
+    '''
+    LRU cache of projections, bounded by the total size of the
+    fragments.  Reports never change once stored, so entries don't
+    need to be invalidated.
+    '''
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                CACHE.inc('miss')
+                return None
+            self._entries.move_to_end(key)
+        CACHE.inc('hit')
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
@@ -0,0 +1,299 @@
+'''
+Per-client token buckets for the ingest endpoints.
+
+/report is limited per cluster (report_id), /device per client address.
+Buckets are kept in a small SQLite database on tmpfs shared by all
+server processes on the host, so a client can't multiply its allowance
+by landing on different workers.  Each process also remembers which
+keys are currently denied and until when, so a client hammering the
+server is answered 429 without touching the database.
+
+/reports is limited per cluster too, report by report.  Addresses in
+TELEMETRY_RATELIMIT_DEVICE_EXEMPT (comma separated networks, e.g. of
+relays forwarding the device uploads of many clusters) are not limited
+on /device.
+
+/report is checked against the report_id at the top level of the first
+chunk of the body, before the rest is read, and again against the one
+of the parsed report if it turns out to be different.
+'''
+import hashlib
+import ipaddress
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, g, make_response
+
+from ceph_telemetry import metrics
+
+ENABLED = os.environ.get('TELEMETRY_RATELIMIT', '1') == '1'
+DB_FILE = os.environ.get('TELEMETRY_RATELIMIT_DB', '/dev/shm/ceph-telemetry-ratelimit.sqlite')
+
+# endpoint -> (tokens added per second, bucket size).  Clusters report
+# daily; a retry loop shouldn't get more than a few reports through per hour.
+LIMITS = {
+    'report': (float(os.environ.get('TELEMETRY_RATELIMIT_REPORT_RATE', 1 / 600)),
+               int(os.environ.get('TELEMETRY_RATELIMIT_REPORT_BURST', 10))),
+    'device': (float(os.environ.get('TELEMETRY_RATELIMIT_DEVICE_RATE', 1 / 60)),
+               int(os.environ.get('TELEMETRY_RATELIMIT_DEVICE_BURST', 60))),
+}
+# Networks whose /device uploads aren't limited
+DEVICE_EXEMPT = [ipaddress.ip_network(n.strip(), strict=False)
+                 for n in os.environ.get('TELEMETRY_RATELIMIT_DEVICE_EXEMPT', '').split(',') if n.strip()]
+# Denied keys remembered per process
+DENIED_KEYS = 10000
+# How often each process deletes buckets that have been idle long enough to be full again
+EVICT_INTERVAL = 300
+# Worst offenders exposed in the metrics, per endpoint
+TOP_OFFENDERS = 10
+# Hex digits of the hash that stands for a client in the metrics
+OFFENDER_KEY_DIGITS = 12
+
+# The cluster id is near the start of a report as sent by the mgr
+# telemetry module, so it can usually be found in the first chunk.
+# Strings and brackets, to tell the top level report_id from nested ones
+_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+_REPORT_ID_VALUE = re.compile(rb'\s*:\s*"([^"\\]{1,128})"')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bucket (
+    endpoint    TEXT NOT NULL,
+    key         TEXT NOT NULL,
+    tokens      REAL NOT NULL,
+    stamp       REAL NOT NULL,
+    PRIMARY KEY (endpoint, key)
+) WITHOUT ROWID
+'''
+
+LIMITED = metrics.Counter(
+    'telemetry_rate_limited_total',
+    'Uploads refused with 429',
+    ('endpoint',))
+
+
+class RateLimiter(object):
+    def __init__(self, path=DB_FILE, limits=LIMITS):
+        self.path = path
+        self.limits = limits
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (endpoint, key) -> [monotonic time until which it is denied,
+        # number of uploads refused], least recently refused first
+        self._denied = OrderedDict()
+        self._last_evict = time.monotonic()
+        self.db.executescript(_SCHEMA)
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'db', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.db = conn
+        return conn
+
+    def _denied_for(self, endpoint, key):
+        '''
+        Seconds the key is still known to be denied for, or 0.
+        '''
+        with self._lock:
+            entry = self._denied.get((endpoint, key))
+            if entry is None:
+                return 0
+            wait = entry[0] - time.monotonic()
+            if wait <= 0:
+                return 0
+            entry[1] += 1
+            self._denied.move_to_end((endpoint, key))
+            return wait
+
+    def _deny(self, endpoint, key, seconds):
+        with self._lock:
+            entry = self._denied.setdefault((endpoint, key), [0, 0])
+            entry[0] = time.monotonic() + seconds
+            entry[1] += 1
+            self._denied.move_to_end((endpoint, key))
+            while len(self._denied) > DENIED_KEYS:
+                self._denied.popitem(last=False)
+
+    def acquire(self, endpoint, key):
+        '''
+        Take a token from the bucket of (endpoint, key).  Returns 0 if
+        allowed, otherwise the number of seconds until the next token.
+        '''
+        wait = self._denied_for(endpoint, key)
+        if wait:
+            return wait
+
+        rate, burst = self.limits[endpoint]
+        now = time.time()
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT tokens, stamp FROM bucket WHERE endpoint = ? AND key = ?',
+                             (endpoint, key)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            db.execute('INSERT OR REPLACE INTO bucket (endpoint, key, tokens, stamp) VALUES (?, ?, ?, ?)',
+                       (endpoint, key, tokens, now))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._maybe_evict()
+        if allowed:
+            return 0
+        wait = (1 - tokens) / rate
+        self._deny(endpoint, key, wait)
+        return wait
+
+    def _maybe_evict(self):
+        now = time.monotonic()
+        if now - self._last_evict < EVICT_INTERVAL:
+            return
+        self._last_evict = now
+        for endpoint, (rate, burst) in self.limits.items():
+            self.db.execute('DELETE FROM bucket WHERE endpoint = ? AND stamp < ?',
+                            (endpoint, time.time() - burst / rate))
+
+    def offenders(self, count=TOP_OFFENDERS):
+        '''
+        Return [(endpoint, key, refused), ...] for the keys this process
+        refused most often, per endpoint.
+        '''
+        with self._lock:
+            items = [(endpoint, key, refused) for (endpoint, key), (_, refused) in self._denied.items()]
+        result = []
+        for endpoint in self.limits:
+            ranked = sorted((i for i in items if i[0] == endpoint), key=lambda i: i[2], reverse=True)
+            result.extend(ranked[:count])
+        return result
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter, _limiter_pid
+    pid = os.getpid()
+    if _limiter is None or _limiter_pid != pid:
+        with _limiter_lock:
+            if _limiter is None or _limiter_pid != pid:
+                _limiter = RateLimiter()
+                _limiter_pid = pid
+    return _limiter
+
+
+def offender_key(key):
+    '''
+    The label standing for a client key (cluster id or address) in the
+    metrics, which shouldn't publish the key itself.
+    '''
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:OFFENDER_KEY_DIGITS]
+
+
+def _offender_samples():
+    if _limiter is None:
+        return []
+    return [((endpoint, offender_key(key)), denied) for endpoint, key, denied in _limiter.offenders()]
+
+
+OFFENDERS = metrics.Gauge(
+    'telemetry_rate_limited_top',
+    'Uploads refused by this process for its most limited clients, by key hash',
+    ('endpoint', 'key'),
+    callback=_offender_samples)
+
+
+def wait_for(endpoint, key):
+    '''
+    Take a token for the client identified by key.  Returns 0 if it is
+    within its limit for endpoint, otherwise the seconds to wait.
+    '''
+    if not ENABLED or key is None:
+        return 0
+    wait = get_limiter().acquire(endpoint, str(key))
+    if wait:
+        LIMITED.inc(endpoint)
+    return wait
+
+
+def device_key(address):
+    '''
+    The key /device uploads from address are limited by, or None for
+    exempt addresses.
+    '''
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    if any(ip in network for network in DEVICE_EXEMPT):
+        return None
+    return address
+
+
+def check(endpoint, key):
+    '''
+    Answer 429, with a Retry-After header, if the client identified by
+    key is over its limit for endpoint.
+    '''
+    if not ENABLED or key is None:
+        return
+    g.rate_limit_key = (endpoint, str(key))
+    wait = wait_for(endpoint, key)
+    if wait:
+        response = make_response({'status': False, 'error': 'rate limited'}, 429)
+        response.headers['Retry-After'] = str(int(wait) + 1)
+        abort(response)
+
+
+def head_report_id(head):
+    '''
+    Return the report_id of the top level object in head, the start of
+    a JSON report, or None if it isn't found or is given more than once.
+    '''
+    depth = 0
+    found = None
+    for m in _TOKEN.finditer(head):
+        token = m.group()
+        if token in (b'{', b'['):
+            depth += 1
+        elif token in (b'}', b']'):
+            depth -= 1
+        elif depth == 1 and token == b'"report_id"':
+            value = _REPORT_ID_VALUE.match(head, m.end())
+            if value is None:
+                continue
+            if found is not None:
+                return None
+            found = value.group(1).decode('utf-8', 'replace')
+    return found
+
+
+def check_report_head(head):
+    '''
+    body.read_body() hook: rate limit /report by the report_id found in
+    the first chunk of the body, before the rest is read.
+    '''
+    report_id = head_report_id(head)
+    if report_id is not None:
+        check('report', report_id)
+
+
+def check_report(report):
+    '''
+    Rate limit a parsed report, unless its head was already checked
+    against the same report_id.
+    '''
+    report_id = report.get('report_id')
+    if report_id is not None and g.get('rate_limit_key') != ('report', str(report_id)):
+        check('report', report_id)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+'''
+Store-and-forward relay for sites with many clusters or an unreliable
+link to the telemetry server.
+
+The relay accepts the same /report and /device uploads as the server,
+acknowledges them once they are fsynced to a local queue, and forwards
+them upstream in the background: reports in gzip compressed batches to
+the bulk /reports endpoint, device uploads one by one.  Failed sends are
+retried with exponential backoff; nothing is lost while the link is
+down, up to MAX_QUEUE_BYTES of queued uploads, after which the relay
+answers 503 and the clusters retry later.
+
+Reports are sent to /report one at a time instead when the upstream has
+no /reports, and on their own when they are too large for a batch.
+Uploads the upstream refuses for good (4xx, or an "invalid" or
+"rate_limited" result for a report of a batch) are kept in the queue's dead-letter file
+(spool.DEAD_LETTER) rather than dropped.  So are uploads that keep
+failing with a server error: after spool.MAX_ATTEMPTS tries a failing
+batch is sent one upload at a time, and the ones still failing are
+dead-lettered.  502, 503 and 504 mean the upstream is down or
+restarting, and are retried for as long as it takes.
+
+The queue is a spool (see spool.Spool) whose records are gzip members,
+so a batch of reports is forwarded as their concatenation without being
+recompressed.
+
+Run it under a WSGI server, with TELEMETRY_RELAY_UPSTREAM and
+TELEMETRY_RELAY_DIR set as needed:
+
+    gunicorn -w 1 --threads 16 -b [::]:9000 'ceph_telemetry.relay:wsgi_app()'
+
+or, for testing, with Flask's development server:
+
+    python3 -m ceph_telemetry.relay --upstream https://telemetry.ceph.com --port 9000
+'''
+import argparse
+import gzip
+import logging
+import os
+
+import requests
+from flask import Flask, abort, jsonify
+from flask_restful import Api, Resource
+
+from ceph_telemetry import body, dedup, metrics, serialize, spool
+from ceph_telemetry.encoding import DecompressMiddleware
+from ceph_telemetry.rest import Index, Metrics
+from ceph_telemetry.rest.device import MAX_DEVICE_REPORT_SIZE
+from ceph_telemetry.rest.report import MAX_REPORT_SIZE
+from ceph_telemetry.rest.reports import MAX_BATCH_REPORTS
+
+UPSTREAM = os.environ.get('TELEMETRY_RELAY_UPSTREAM', 'https://telemetry.ceph.com')
+RELAY_DIR = os.environ.get('TELEMETRY_RELAY_DIR', '/opt/telemetry/relay')
+# Compressed bytes queued on disk before uploads are refused
+MAX_QUEUE_BYTES = int(os.environ.get('TELEMETRY_RELAY_MAX_QUEUE_BYTES', 10 * 1024 ** 3))
+# Decompressed bytes per upstream /reports request
+UPSTREAM_BATCH_BYTES = 16 * 1024 * 1024
+UPSTREAM_TIMEOUT = 60
+COMPRESSION_LEVEL = 6
+
+FORWARDED = metrics.Counter(
+    'telemetry_relay_forwarded_total',
+    'Uploads forwarded upstream, by kind and upstream status',
+    ('kind', 'status'))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    '''
+    The upstream failed on an upload (500 and the like), maybe because
+    of the upload itself.  Not an OSError, so the spool counts it
+    towards dead-lettering the batch.
+    '''
+    pass
+
+
+class HTTPUpstream(object):
+    '''
+    The telemetry server the relay forwards to.  Anything with the same
+    put() can stand in for it, e.g. in tests.
+    '''
+    def __init__(self, url, timeout=UPSTREAM_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def put(self, path, data, headers):
+        '''
+        Returns (status code, parsed JSON response or None).
+        '''
+        r = self.session.put(self.url + path, data=data, headers=headers, timeout=self.timeout)
+        try:
+            return r.status_code, r.json()
+        except ValueError:
+            return r.status_code, None
+
+
+class Relay(spool.Spool):
+    def __init__(self, upstream, directory=RELAY_DIR, max_queue_bytes=MAX_QUEUE_BYTES):
+        self.upstream = upstream
+        self.max_queue_bytes = max_queue_bytes
+        # (report_id, report_timestamp) of reports queued by this process
+        self.recent = dedup.RecentKeys()
+        # False once the upstream turned out not to have /reports
+        self.bulk = True
+        super(Relay, self).__init__(directory, handlers={})
+
+    def enqueue(self, kind, meta, data):
+        '''
+        Queue an upload (JSON bytes) and return once it is on disk.
+        '''
+        if self.stats()['backlog_bytes'] > self.max_queue_bytes:
+            raise QueueFull()
+        member = gzip.compress(data + b'\n', compresslevel=COMPRESSION_LEVEL)
+        self.append(kind, dict(meta, size=len(data) + 1), member)
+
+    def _write(self, records):
+        batch = []
+        size = 0
+        for meta, member in records:
+            if meta['kind'] == 'device':
+                self._forward('device', '/device', [(meta, member)])
+                continue
+            if meta['size'] > UPSTREAM_BATCH_BYTES:
+                self._forward('report', '/report', [(meta, member)])
+                continue
+            if batch and (size + meta['size'] > UPSTREAM_BATCH_BYTES or len(batch) >= MAX_BATCH_REPORTS):
+                self._forward_reports(batch)
+                batch, size = [], 0
+            batch.append((meta, member))
+            size += meta['size']
+        if batch:
+            self._forward_reports(batch)
+
+    def _forward_reports(self, batch):
+        if self.bulk:
+            status = self._forward('report', '/reports', batch, fallback=(404, 405, 413))
+            if status in (404, 405):
+                logging.warning(f"upstream has no /reports ({status}), forwarding reports one by one")
+                self.bulk = False
+            elif status != 413:
+                return
+        # one by one, to /report: it has no batch size cap of its own
+        for record in batch:
+            self._forward('report', '/report', [record])
+
+    def _forward(self, kind, path, records, fallback=()):
+        '''
+        Send records, concatenated, to path and return the upstream's
+        status.  Records the upstream refuses are dead-lettered, unless
+        the status is one of fallback, which the caller handles.
+        '''
+        data = b''.join(member for _, member in records)
+        status, response = self.upstream.put(path, data, {'Content-Encoding': 'gzip'})
+        FORWARDED.inc(kind, str(status))
+        if status in (408, 429, 502, 503, 504):
+            # raising keeps the batch queued; the spool retries with backoff
+            raise IOError(f"upstream {path} answered {status}")
+        if status >= 500:
+            raise UpstreamError(f"upstream {path} answered {status}")
+        if status in fallback:
+            return status
+        if status >= 400:
+            # retrying won't help; keep the uploads without blocking the queue
+            logging.error(f"upstream {path} rejected {len(records)} {kind} uploads with {status}, "
+                          f"moving them to {spool.DEAD_LETTER}")
+            self._dead_letter([(dict(meta, error=f"upstream {path} answered {status}"), member)
+                               for meta, member in records])
+            return status
+        if response and 'results' in response:
+            # one result per record, in order
+            invalid = [(dict(meta, error=f"upstream {path}: {result.get('error', result['status'])}"), member)
+                       for (meta, member), result in zip(records, response['results'])
+                       if result.get('status') in ('invalid', 'rate_limited')]
+            if invalid:
+                logging.warning(f"upstream rejected {len(invalid)} reports as invalid or rate limited, "
+                                f"moving them to {spool.DEAD_LETTER}")
+                self._dead_letter(invalid)
+        return status
+
+
+_relay = None
+
+
+def _relay_samples():
+    if _relay is None:
+        return []
+    return [((stat,), value) for stat, value in _relay.stats().items()]
+
+
+RELAY_STATS = metrics.Gauge(
+    'telemetry_relay_queue',
+    'Relay queue backlog and throughput',
+    ('stat',),
+    callback=_relay_samples)
+
+
+class RelayReport(Resource):
+    def __init__(self, relay):
+        super(RelayReport, self).__init__()
+        self.relay = relay
+
+    def put(self):
+        report = body.read_json('report', MAX_REPORT_SIZE)
+        # simple sanity check that this json is not totally invalid
+        if 'report_id' not in report or 'report_timestamp' not in report:
+            return
+        key = (str(report['report_id']), str(report['report_timestamp']))
+        if key in self.relay.recent:
+            dedup.DUPLICATES.inc('report', 'cache')
+            return jsonify(status=True)
+        try:
+            self.relay.enqueue('report', {}, serialize.dumps(report))
+        except QueueFull:
+            body.REJECTED.inc('report', 'queue_full')
+            abort(503)
+        self.relay.recent.add(key)
+        return jsonify(status=True)
+
+
+class RelayDevice(Resource):
+    def __init__(self, relay):
+        super(RelayDevice, self).__init__()
+        self.relay = relay
+
+    def put(self):
+        upload = body.read_json('device', MAX_DEVICE_REPORT_SIZE)
+        try:
+            self.relay.enqueue('device', {}, serialize.dumps(upload))
+        except QueueFull:
+            body.REJECTED.inc('device', 'queue_full')
+            abort(503)
+        return jsonify(status=True)
+
+
+def create_app(name, relay):
+    global _relay
+    _relay = relay
+    app = Flask(name)
+    api = Api(app, catch_all_404s=True)
+    api.add_resource(Index, '/')
+    api.add_resource(RelayReport, '/report', endpoint='report', resource_class_kwargs={'relay': relay})
+    api.add_resource(RelayDevice, '/device', endpoint='device', resource_class_kwargs={'relay': relay})
+    api.add_resource(Metrics, '/metrics')
+    metrics.instrument(app)
+    app.wsgi_app = DecompressMiddleware(app.wsgi_app, ('/report', '/device'))
+    return app
+
+
+def wsgi_app():
+    '''
+    The relay app configured from the environment, for WSGI servers.
+    '''
+    return create_app(__name__, Relay(HTTPUpstream(UPSTREAM), RELAY_DIR))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ceph Telemetry store-and-forward relay')
+    parser.add_argument("--host", action="store", dest="host",
+                        default="::", help="Host/IP to bind on")
+    parser.add_argument("--port", action="store", dest="port", type=int,
+                        default=9000, help="Port to listen on")
+    parser.add_argument("--upstream", action="store", dest="upstream",
+                        default=UPSTREAM, help="Telemetry server to forward to")
+    parser.add_argument("--dir", action="store", dest="dir",
+                        default=RELAY_DIR, help="Queue directory")
+    args = parser.parse_args()
+    app = create_app(__name__, Relay(HTTPUpstream(args.upstream), args.dir))
+    # Flask's development server; use wsgi_app() in production
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -1,3 +1,7 @@
 from .index import Index
 from .report import Report
+from .reports import Reports
+from .projection import Projection
 from .device import Device
+from .dashboard import Dashboard
+from .metrics import Metrics
@@ -0,0 +1,37 @@
+import os
+from flask import make_response, request
+from flask_restful import Resource
+from ceph_telemetry import aggregates, db
+
+# Seconds browsers and proxies may reuse a result without revalidating it
+MAX_AGE = int(os.environ.get('TELEMETRY_DASHBOARD_MAX_AGE', 300))
+
+cache = aggregates.AggregateCache()
+
+
+class Dashboard(Resource):
+    '''
+    GET /dashboard/dashboard.version_by_cluster_count?time_from=...&time_to=...&display=Major&major=17&major=18
+
+    The result of a dashboard function, as {"function", "columns",
+    "rows"}.  Array arguments are repeated; timestamps are ISO 8601 or
+    epoch milliseconds.  See ceph_telemetry.aggregates.
+    '''
+    def get(self, function):
+        try:
+            values = aggregates.parse_args(function, request.args.to_dict(flat=False))
+        except ValueError as e:
+            status = 404 if function not in aggregates.FUNCTIONS else 400
+            return {'status': False, 'error': str(e)}, status
+
+        with db.connection() as conn:
+            cur = conn.cursor()
+            data = cache.get(cur, function, values)
+            conn.commit()
+            cur.close()
+
+        response = make_response(data)
+        response.mimetype = 'application/json'
+        response.set_etag(aggregates.etag(data))
+        response.headers['Cache-Control'] = f"public, max-age={MAX_AGE}"
+        return response.make_conditional(request)
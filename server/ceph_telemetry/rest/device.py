@@ -1,42 +1,104 @@
-from flask import request, jsonify
+from flask import abort, jsonify, request
 from flask_restful import Resource
 import datetime
 import hashlib
 import json
 import copy
-import psycopg2
+import logging
+import psycopg2.extras
+from ceph_telemetry import body, db, metrics, ratelimit, serialize, shards, spool
+
+MAX_DEVICE_REPORT_SIZE = 100000000  # 100 MB
+# device_report.device_id is a VARCHAR(128)
+MAX_DEVICE_ID = 128
+# Rows per INSERT statement
+INSERT_PAGE_SIZE = 1000
+
+
+def device_rows(upload):
+    '''
+    Flatten an upload of {devid: {stamp: report}} into device_report
+    rows.  All devices of a host are usually scraped at the same stamps,
+    so each distinct stamp is parsed only once.  Raises ValueError if
+    the upload isn't shaped like that.
+    '''
+    if not isinstance(upload, dict):
+        raise ValueError(f"expected an object of devices, not a {type(upload).__name__}")
+    stamps = {}
+    rows = []
+    for devid, devinfo in upload.items():
+        if not 0 < len(devid) <= MAX_DEVICE_ID or not isinstance(devinfo, dict):
+            raise ValueError(f"invalid device {devid[:MAX_DEVICE_ID]!r}")
+        for stamp, report in devinfo.items():
+            ts = stamps.get(stamp)
+            if ts is None:
+                # convert stamp string (YYYYMMDD-HHMMSS) to a python timestamp
+                ts = stamps[stamp] = datetime.datetime.strptime(stamp, '%Y%m%d-%H%M%S')
+            rows.append((devid, ts, json.dumps(report)))
+    return rows
+
+
+def insert_device_rows(cur, rows):
+    '''
+    Insert all rows with multi-row statements and return how many were
+    new; the rest were already in device_report.
+    '''
+    inserted = psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO device_report (device_id, report_stamp, report) VALUES %s ON CONFLICT DO NOTHING RETURNING 1',
+        rows,
+        page_size=INSERT_PAGE_SIZE,
+        fetch=True)
+    return len(inserted)
+
+
+def drain_spooled_devices(cur, items):
+    '''
+    Spool handler: expand each spooled upload into device_report rows
+    and insert them in one go.
+    '''
+    rows = []
+    for meta, data in items:
+        rows.extend(device_rows(json.loads(data)))
+    shards.get_router().write(cur, rows, lambda row: row[0], insert_device_rows)
+
+
+spool.register_handler('device', drain_spooled_devices)
+
 
 class Device(Resource):
     def __init__(self, report=None):
         super(Device, self).__init__()
         self.report = report
-        with open('/opt/telemetry/pg_pass.txt', 'r') as f:
-            p = f.read()
-            self.pg_password = p.strip()
 
     def put(self):
-        self.report = request.get_json(force=True)
+        ratelimit.check('device', ratelimit.device_key(request.remote_addr))
+        self.report = body.read_json('device', MAX_DEVICE_REPORT_SIZE)
 
-        self.post_to_postgres()
+        stage = metrics.STAGE_SECONDS.time
+        # also in spool mode, so that the drain never sees a bad upload
+        try:
+            with stage('device', 'rows'):
+                rows = device_rows(self.report)
+        except ValueError as e:
+            body.REJECTED.inc('device', 'invalid')
+            logging.warning(f"rejected a device upload: {e}")
+            abort(400)
 
-        return jsonify(status=True)
+        if spool.enabled():
+            with stage('device', 'spool'):
+                spool.get_spool().append('device', {}, serialize.dumps(self.report))
+            return jsonify(status=True)
 
-    def _connect_pg(self):
-        return psycopg2.connect(
-            host='localhost',
-            database='telemetry',
-            user='telemetry',
-            password=self.pg_password,
-            )
+        with stage('device', 'postgres'):
+            inserted = self.post_to_postgres(rows)
 
-    def post_to_postgres(self):
-        conn = self._connect_pg()
-        cur = conn.cursor()
-        for devid, devinfo in self.report.items():
-            for stamp, report in devinfo.items():
-                # convert stamp string (YYYYMMDD-HHMMSS) to a python timestamp
-                ts = datetime.datetime.strptime(stamp, '%Y%m%d-%H%M%S')
-                cur.execute(
-                    'INSERT INTO device_report (device_id, report_stamp, report) VALUES (%s,%s,%s) ON CONFLICT DO NOTHING',
-                    (devid, ts, json.dumps(report)))
-        conn.commit()
+        return jsonify(status=True, inserted=inserted, duplicates=len(rows) - inserted)
+
+    def post_to_postgres(self, rows):
+        with db.connection() as conn:
+            cur = conn.cursor()
+            inserted = sum(shards.get_router().write(cur, rows, lambda row: row[0], insert_device_rows))
+            conn.commit()
+            cur.close()
+        return inserted
@@ -0,0 +1,8 @@
+from flask import Response
+from flask_restful import Resource
+from ceph_telemetry import metrics
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
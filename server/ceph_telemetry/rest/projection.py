@@ -0,0 +1,59 @@
+from flask import jsonify, request
+from flask_restful import Resource
+from ceph_telemetry import metrics, projection, serialize, shards
+
+cache = projection.ProjectionCache()
+
+
+class Projection(Resource):
+    '''
+    GET /report/<cluster_id>/<report_stamp>?path=pools[*].pg_num&path=osd.count
+
+    Return only the given paths of a stored report; report_stamp can be
+    "latest".  See ceph_telemetry.projection for the path syntax.
+    '''
+    def get(self, cluster_id, report_stamp):
+        paths = request.args.getlist('path')
+        if not paths or len(paths) > projection.MAX_PATHS:
+            return {'status': False, 'error': f"give 1 to {projection.MAX_PATHS} path arguments"}, 400
+        try:
+            for path in paths:
+                projection.parse_path(path)
+        except ValueError as e:
+            return {'status': False, 'error': str(e)}, 400
+
+        with shards.get_router().connection(cluster_id) as conn:
+            cur = conn.cursor()
+            if report_stamp == 'latest':
+                cur.execute('SELECT report_stamp FROM report WHERE cluster_id = %s ORDER BY report_stamp DESC LIMIT 1',
+                            (cluster_id,))
+                row = cur.fetchone()
+                if row is None:
+                    return {'status': False, 'error': 'no such report'}, 404
+                report_stamp = row[0].isoformat()
+
+            result = {}
+            missing = []
+            for path in paths:
+                value = cache.get((cluster_id, report_stamp, path))
+                if value is None:
+                    missing.append(path)
+                else:
+                    result[path] = value[0]
+
+            if missing:
+                columns, params = projection.select_sql(missing)
+                with metrics.STAGE_SECONDS.time('projection', 'postgres'):
+                    cur.execute(f"SELECT {columns} FROM report WHERE cluster_id = %s AND report_stamp = %s",
+                                params + [cluster_id, report_stamp])
+                    row = cur.fetchone()
+                if row is None:
+                    return {'status': False, 'error': 'no such report'}, 404
+                for path, value in zip(missing, row):
+                    result[path] = value
+                    # wrapped, so that a cached None is told apart from a miss
+                    cache.put((cluster_id, report_stamp, path), (value,), len(serialize.dumps(value)))
+            cur.close()
+
+        return jsonify(cluster_id=cluster_id, report_stamp=report_stamp,
+                       paths={path: result[path] for path in paths})
@@ -1,13 +1,16 @@
-from flask import request, jsonify
+from flask import abort, jsonify
 from flask_restful import Resource
 import datetime
 import hashlib
 import json
 import copy
-import psycopg2
+import psycopg2.extras
+from ceph_telemetry import body, crashes, db, dedup, metrics, ratelimit, segments, serialize, shards, spool
 import logging
 
 MAX_REPORT_SIZE = 100000000  # 100 MB
+# report.cluster_id is a VARCHAR(50)
+MAX_CLUSTER_ID = 50
 LOG_FILE = f"/opt/telemetry/log/report_ep.log"
 
 logging.basicConfig(filename=LOG_FILE,
@@ -15,13 +18,78 @@ logging.basicConfig(filename=LOG_FILE,
                     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
+
+def parse_stamp(stamp):
+    '''
+    Return report_timestamp as a datetime; raises ValueError if it isn't
+    an ISO 8601 timestamp.
+    '''
+    if not isinstance(stamp, str):
+        raise ValueError(f"report_timestamp is a {type(stamp).__name__}, not a string")
+    if stamp.endswith('Z'):
+        stamp = stamp[:-1]
+    return datetime.datetime.fromisoformat(stamp)
+
+
+def valid_key(report):
+    '''
+    Whether report is a dict whose report_id and report_timestamp fit
+    report.cluster_id and report.report_stamp.  Reports are checked
+    before they are archived, spooled or inserted, so that a bad one
+    can't fail a spool drain or a batch insert later.
+    '''
+    if not isinstance(report, dict):
+        return False
+    cluster_id = report.get('report_id')
+    if not isinstance(cluster_id, str) or not 0 < len(cluster_id) <= MAX_CLUSTER_ID:
+        return False
+    try:
+        parse_stamp(report.get('report_timestamp'))
+    except ValueError:
+        return False
+    return True
+
+
+def insert_report_rows(cur, rows):
+    '''
+    Insert (cluster_id, report_stamp, report) rows and return how many
+    were new.
+    '''
+    inserted = psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO report (cluster_id, report_stamp, report) VALUES %s ON CONFLICT DO NOTHING RETURNING 1',
+        rows,
+        fetch=True)
+    return len(inserted)
+
+
+def drain_spooled_reports(cur, items):
+    '''
+    Spool handler: archive the raw reports and insert them, and the
+    new crashes found in them at upload time, with multi-row statements.
+    '''
+    rows = []
+    crash_rows = []
+    for meta, data in items:
+        segments.get_archive().append(meta['cluster_id'], meta['report_stamp'], data)
+        rows.append((meta['cluster_id'], meta['report_stamp'], data.decode('utf-8')))
+        crash_rows.extend(meta.get('crashes', []))
+    shards.get_router().write(cur, rows, lambda row: row[0], insert_report_rows)
+    inserted = crashes.insert(cur, crash_rows)
+    if inserted:
+        return lambda: crashes.remember(inserted)
+
+
+spool.register_handler('report', drain_spooled_reports)
+
+# (cluster_id, report_stamp) of reports stored by this process
+recent_reports = dedup.RecentKeys()
+
+
 class Report(Resource):
     def __init__(self, report=None):
         super(Report, self).__init__()
         self.report = report
-        with open('/opt/telemetry/pg_pass.txt', 'r') as f:
-            p = f.read()
-            self.pg_password = p.strip()
 
     def _crashes_to_list(self):
         '''
@@ -76,49 +144,96 @@ class Report(Resource):
                     m.update(self.report.get('report_id').encode('utf-8'))
                     crash['entity_name'] = entity_type + '.' + m.hexdigest()
 
+    def sanitize(self):
+        '''
+        Clean up the report in place and return it encoded, with NUL
+        escapes removed so that it fits a jsonb column; the file and the
+        database both store these bytes.
+        '''
+        stage = metrics.STAGE_SECONDS.time
+        self._add_timestamp()
+        with stage('report', 'crashes_to_list'):
+            self._crashes_to_list()
+        with stage('report', 'purge_hostname_from_crash'):
+            self._purge_hostname_from_crash()
+        with stage('report', 'obfuscate_entity_name'):
+            self._obfuscate_entity_name()
+        with stage('report', 'encode'):
+            return serialize.strip_nul(serialize.dumps(self.report))
+
     def put(self):
-        self.report = request.get_json(force=True)
+        self.report = body.read_json('report', MAX_REPORT_SIZE, ratelimit.check_report_head)
+        if not isinstance(self.report, dict):
+            body.REJECTED.inc('report', 'invalid')
+            abort(400)
         # simple sanity check that this json is not totally invalid
         if 'report_id' not in self.report or 'report_timestamp' not in self.report:
             return
+        if not valid_key(self.report):
+            body.REJECTED.inc('report', 'invalid')
+            logging.warning("rejected a report with an invalid report_id or report_timestamp")
+            abort(400)
+        ratelimit.check_report(self.report)
+
+        # A retry of an upload we already stored: acknowledge it without
+        # sanitizing or archiving it again.
+        key = (str(self.report['report_id']), str(self.report['report_timestamp']))
+        if key in recent_reports:
+            dedup.DUPLICATES.inc('report', 'cache')
+            return jsonify(status=True)
+
+        stage = metrics.STAGE_SECONDS.time
+        data = self.sanitize()
+        report_size = len(data)
+        with stage('report', 'crashes'):
+            crash_rows = crashes.new_crash_rows(self.report)
+
+        if report_size < MAX_REPORT_SIZE and spool.enabled():
+            with stage('report', 'spool'):
+                self.post_to_spool(data, crash_rows)
+            recent_reports.add(key)
+            return jsonify(status=True)
+
+        with stage('report', 'archive'):
+            self.post_to_file(data)
 
-        # clean up
-        self._add_timestamp()
-        self._crashes_to_list()
-        self._purge_hostname_from_crash()
-        self._obfuscate_entity_name()
-
-        self.post_to_file()
-
-        report_size = len(json.dumps(self.report))
         if report_size < MAX_REPORT_SIZE:
-            self.post_to_postgres()
+            with stage('report', 'postgres'):
+                if not self.post_to_postgres(data, crash_rows):
+                    dedup.DUPLICATES.inc('report', 'database')
+            recent_reports.add(key)
         else:
             logging.warning(f"report_id {self._report_id()} was not posted to postgres due to its size ({report_size} bytes)")
 
         return jsonify(status=True)
 
-    def post_to_file(self):
-        id = self._report_id()
-        with open('/opt/telemetry/raw/%s' % id, 'w') as f:
-            f.write(json.dumps(self.report, indent=4))
-            f.close()
-
-    def _connect_pg(self):
-        return psycopg2.connect(
-            host='localhost',
-            database='telemetry',
-            user='telemetry',
-            password=self.pg_password,
-            )
-
-    def post_to_postgres(self):
-        conn = self._connect_pg()
-        cur = conn.cursor()
-        cur.execute(
-            'INSERT INTO report (cluster_id, report_stamp, report) VALUES (%s,%s,%s)',
-            (self.report.get('report_id'),
-             self.report.get('report_timestamp'),
-             json.dumps(self.report))
-            )
-        conn.commit()
+    def post_to_file(self, data):
+        segments.get_archive().append(
+            self.report.get('report_id'),
+            self.report.get('report_timestamp'),
+            data)
+
+    def post_to_spool(self, data, crash_rows=()):
+        meta = {
+            'cluster_id': self.report.get('report_id'),
+            'report_stamp': self.report.get('report_timestamp'),
+        }
+        if crash_rows:
+            meta['crashes'] = crash_rows
+        spool.get_spool().append('report', meta, data)
+
+    def post_to_postgres(self, data, crash_rows=()):
+        '''
+        Insert the report and its new crashes.  Returns False if the
+        report was already in the database.
+        '''
+        row = (self.report.get('report_id'), self.report.get('report_timestamp'), data.decode('utf-8'))
+        with db.connection() as conn:
+            cur = conn.cursor()
+            inserted = shards.get_router().write(cur, [row], lambda row: row[0], insert_report_rows) == [1]
+            crashes_inserted = crashes.insert(cur, crash_rows)
+            conn.commit()
+            cur.close()
+        if crashes_inserted:
+            crashes.remember(crashes_inserted)
+        return inserted
@@ -0,0 +1,174 @@
+from flask import jsonify
+from flask_restful import Resource
+import logging
+import psycopg2.extras
+from werkzeug.exceptions import HTTPException
+from ceph_telemetry import body, crashes, db, dedup, metrics, ratelimit, segments, shards, spool
+from ceph_telemetry.rest.report import MAX_REPORT_SIZE, Report, recent_reports, valid_key
+
+# Whole batch, after decompression
+MAX_BATCH_SIZE = MAX_REPORT_SIZE
+# Reports per batch
+MAX_BATCH_REPORTS = 10000
+
+RECORDS = metrics.Counter(
+    'telemetry_bulk_records_total',
+    'Reports received through /reports, by outcome',
+    ('status',))
+
+# Insert the batch and return the positions of the rows that were new
+INSERT_REPORTS = '''
+WITH v (n, cluster_id, report_stamp, report) AS (VALUES %s),
+ins AS (
+    INSERT INTO report (cluster_id, report_stamp, report)
+    SELECT cluster_id, report_stamp::timestamp, report::jsonb FROM v
+    ON CONFLICT DO NOTHING
+    RETURNING cluster_id, report_stamp
+)
+SELECT v.n FROM v JOIN ins
+    ON ins.cluster_id = v.cluster_id AND ins.report_stamp = v.report_stamp::timestamp
+'''
+
+
+class Reports(Resource):
+    '''
+    Bulk upload of newline-delimited reports (NDJSON).  Every report is
+    sanitized as by Report; the batch is archived with one write and
+    inserted with one statement.  The response has a status per input
+    line, so only the failed ones need to be sent again:
+
+        {"status": true, "results": [{"status": "stored"}, {"status": "invalid"}, ...]}
+
+    Statuses are "stored", "duplicate" (already received), "invalid"
+    (not JSON, no valid report_id/report_timestamp, or malformed) and
+    "rate_limited" (its cluster is over its /report limit, see
+    ratelimit); invalid ones also have an "error", rate limited ones a
+    "retry_after" in seconds.  Reports are validated before anything is
+    archived or inserted, so an invalid one doesn't fail the others.
+    '''
+    def put(self):
+        with metrics.STAGE_SECONDS.time('reports', 'read'):
+            buf = body.read_body('reports', MAX_BATCH_SIZE)
+        metrics.BODY_BYTES.observe(len(buf), 'reports')
+
+        lines = [line for line in buf.split(b'\n') if line.strip()]
+        if len(lines) > MAX_BATCH_REPORTS:
+            body.REJECTED.inc('reports', 'too_many_reports')
+            return {'status': False, 'error': f"more than {MAX_BATCH_REPORTS} reports"}, 413
+
+        results = [None] * len(lines)
+        # position -> why the report is invalid
+        errors = {}
+        # position -> (key, encoded report)
+        batch = {}
+        # position -> new crashes of the report
+        crash_rows = {}
+        # position -> seconds until the report's cluster may send again
+        limited = {}
+        keys = set()
+        stage = metrics.STAGE_SECONDS.time
+        for i, line in enumerate(lines):
+            try:
+                with stage('reports', 'parse'):
+                    report = Report(body.parse_json('reports', line))
+            except HTTPException:
+                results[i] = 'invalid'
+                errors[i] = 'not JSON'
+                continue
+            if not valid_key(report.report):
+                results[i] = 'invalid'
+                errors[i] = 'no valid report_id and report_timestamp'
+                continue
+            wait = ratelimit.wait_for('report', report.report['report_id'])
+            if wait:
+                results[i] = 'rate_limited'
+                limited[i] = int(wait) + 1
+                continue
+            key = (str(report.report['report_id']), str(report.report['report_timestamp']))
+            if key in keys or key in recent_reports:
+                dedup.DUPLICATES.inc('reports', 'cache')
+                results[i] = 'duplicate'
+                continue
+            try:
+                data = report.sanitize()
+                with stage('reports', 'crashes'):
+                    rows = crashes.new_crash_rows(report.report)
+            except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+                # a malformed section (say, a crash that isn't an object)
+                # only fails its own report
+                logging.warning(f"rejected a report of a bulk upload that could not be sanitized: {e!r}")
+                results[i] = 'invalid'
+                errors[i] = 'malformed report'
+                continue
+            keys.add(key)
+            batch[i] = (key, data)
+            crash_rows[i] = rows
+
+        if batch:
+            if spool.enabled():
+                with stage('reports', 'spool'):
+                    self.post_to_spool(batch, crash_rows)
+                stored = set(batch)
+            else:
+                with stage('reports', 'archive'):
+                    self.post_to_file(batch.values())
+                with stage('reports', 'postgres'):
+                    stored = self.post_to_postgres(batch, crash_rows)
+            for i, (key, data) in batch.items():
+                if i in stored:
+                    results[i] = 'stored'
+                else:
+                    dedup.DUPLICATES.inc('reports', 'database')
+                    results[i] = 'duplicate'
+                recent_reports.add(key)
+
+        for status in results:
+            RECORDS.inc(status)
+        if batch:
+            logging.info(f"stored {len(batch)} of {len(lines)} reports from a bulk upload")
+        response = []
+        for i, status in enumerate(results):
+            result = {'status': status}
+            if i in errors:
+                result['error'] = errors[i]
+            if i in limited:
+                result['retry_after'] = limited[i]
+            response.append(result)
+        return jsonify(status=True, results=response)
+
+    def post_to_file(self, batch):
+        segments.get_archive().append_many(
+            [(cluster_id, report_stamp, data) for (cluster_id, report_stamp), data in batch])
+
+    def post_to_spool(self, batch, crash_rows):
+        items = []
+        for i, ((cluster_id, report_stamp), data) in batch.items():
+            meta = {'cluster_id': cluster_id, 'report_stamp': report_stamp}
+            if crash_rows.get(i):
+                meta['crashes'] = crash_rows[i]
+            items.append((meta, data))
+        spool.get_spool().append_many('report', items)
+
+    def post_to_postgres(self, batch, crash_rows):
+        '''
+        Insert {position: (key, data)} and the new crashes of the
+        reports, and return the positions that were not already in the
+        database.
+        '''
+        rows = [(i, cluster_id, report_stamp, data.decode('utf-8'))
+                for i, ((cluster_id, report_stamp), data) in batch.items()]
+        def insert(cur, rows):
+            return psycopg2.extras.execute_values(
+                cur, INSERT_REPORTS, rows, page_size=len(rows), fetch=True)
+
+        with db.connection() as conn:
+            cur = conn.cursor()
+            stored = [n for result in shards.get_router().write(cur, rows, lambda row: row[1], insert)
+                      for n, in result]
+            new_crashes = [row for i in batch for row in crash_rows.get(i, [])]
+            crashes_inserted = crashes.insert(cur, new_crashes)
+            conn.commit()
+            cur.close()
+        if crashes_inserted:
+            crashes.remember(crashes_inserted)
+        return set(stored)
@@ -0,0 +1,313 @@
+'''
+Segmented raw report archive.
+
+Instead of one file per report, reports are appended to daily segment
+files (SEGMENT_DIR/YYYY-MM-DD.seg, named after the day they were
+archived) and an SQLite index maps (cluster_id, report_stamp) to the
+location of the report in its segment.  Reading one report is a single
+pread(); a cluster's history is a range scan of the index.
+
+Every segment record is self-describing, so the index can be rebuilt
+from the segments (see reindex()):
+
+    MAGIC | len(cluster_id) | len(report_stamp) | len(blob) | crc32 | cluster_id | report_stamp | blob
+
+blob is the report compressed by archive.compress(), and the crc32
+covers cluster_id, report_stamp and blob.  A process that dies in the
+middle of an append leaves a torn record that others append after;
+readers skip it by looking for the next record that checks out.
+Records written before the checksum was added (MAGIC_V1) have no
+crc32 field.
+'''
+import datetime
+import fcntl
+import logging
+import os
+import random
+import sqlite3
+import struct
+import threading
+import zlib
+
+from ceph_telemetry import archive
+
+SEGMENT_DIR = os.path.join(archive.ARCHIVE_DIR, 'segments')
+INDEX_FILE = 'index.sqlite'
+SEGMENT_SUFFIX = '.seg'
+
+MAGIC = b'CTS\x02'
+_HEADER = struct.Struct('>4sHHII')
+MAGIC_V1 = b'CTS\x01'
+_HEADER_V1 = struct.Struct('>4sHHI')
+# Bytes read at a time while looking for the record after a torn one
+RESYNC_CHUNK = 1024 * 1024
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS report (
+    cluster_id      TEXT NOT NULL,
+    report_stamp    TEXT NOT NULL,
+    segment         TEXT NOT NULL,
+    offset          INTEGER NOT NULL,
+    length          INTEGER NOT NULL,
+    PRIMARY KEY (cluster_id, report_stamp)
+) WITHOUT ROWID
+'''
+
+
+def encode_record(cluster_id, report_stamp, blob):
+    cid = cluster_id.encode('utf-8')
+    stamp = report_stamp.encode('utf-8')
+    crc = zlib.crc32(blob, zlib.crc32(stamp, zlib.crc32(cid)))
+    return _HEADER.pack(MAGIC, len(cid), len(stamp), len(blob), crc) + cid + stamp, blob
+
+
+def _decode_record(f, pos, size):
+    '''
+    Return (cluster_id, report_stamp, blob offset, blob) for the record
+    at pos, or None if there is no intact record there.
+    '''
+    f.seek(pos)
+    head = f.read(_HEADER.size)
+    if head[:len(MAGIC)] == MAGIC and len(head) == _HEADER.size:
+        _, cid_len, stamp_len, blob_len, crc = _HEADER.unpack(head)
+        header_size = _HEADER.size
+    elif head[:len(MAGIC_V1)] == MAGIC_V1 and len(head) >= _HEADER_V1.size:
+        _, cid_len, stamp_len, blob_len = _HEADER_V1.unpack_from(head)
+        crc = None
+        header_size = _HEADER_V1.size
+    else:
+        return None
+    offset = pos + header_size + cid_len + stamp_len
+    if offset + blob_len > size:
+        return None
+    f.seek(pos + header_size)
+    cid = f.read(cid_len)
+    stamp = f.read(stamp_len)
+    blob = f.read(blob_len)
+    if crc is not None and zlib.crc32(blob, zlib.crc32(stamp, zlib.crc32(cid))) != crc:
+        return None
+    try:
+        return cid.decode('utf-8'), stamp.decode('utf-8'), offset, blob
+    except UnicodeDecodeError:
+        return None
+
+
+def _next_magic(f, pos, size):
+    '''
+    Offset of the first record magic (of any version) at or after pos,
+    or size if there is none.
+    '''
+    prefix = MAGIC[:-1]
+    while pos < size:
+        f.seek(pos)
+        chunk = f.read(RESYNC_CHUNK + len(MAGIC) - 1)
+        i = chunk.find(prefix)
+        while i != -1:
+            if chunk[i:i + len(MAGIC)] in (MAGIC, MAGIC_V1):
+                return pos + i
+            i = chunk.find(prefix, i + 1)
+        pos += RESYNC_CHUNK
+    return size
+
+
+class SegmentArchive(object):
+    def __init__(self, directory=SEGMENT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._segment = None
+        self._fd = None
+        self.db.executescript(_SCHEMA)
+
+    @property
+    def db(self):
+        # sqlite3 connections must stay in the thread that made them
+        conn = getattr(self._local, 'db', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.directory, INDEX_FILE), timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = conn
+        return conn
+
+    def _segment_fd(self, segment):
+        if segment != self._segment:
+            if self._fd is not None:
+                os.close(self._fd)
+            path = os.path.join(self.directory, segment + SEGMENT_SUFFIX)
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._segment = segment
+        return self._fd
+
+    def append(self, cluster_id, report_stamp, data, day=None):
+        '''
+        Compress and append a report (JSON bytes) to the segment of `day`
+        (default: today, UTC) and index it.  Returns False if the report
+        is already archived.
+        '''
+        return self.append_many([(cluster_id, report_stamp, data)], day)[0]
+
+    def append_many(self, reports, day=None):
+        '''
+        Archive [(cluster_id, report_stamp, data), ...] with a single
+        write and index transaction.  Returns a list telling which
+        reports were new.
+        '''
+        segment = (day or datetime.datetime.utcnow().date()).isoformat()
+        reports = [(str(cluster_id), str(report_stamp), data) for cluster_id, report_stamp, data in reports]
+        # Compressed outside the lock; reports that turn out to be
+        # archived already are dropped below.
+        blobs = {}
+        for cluster_id, report_stamp, data in reports:
+            if (cluster_id, report_stamp) not in blobs and self.locate(cluster_id, report_stamp) is None:
+                blobs[(cluster_id, report_stamp)] = archive.compress(data)
+        if not blobs:
+            return [False] * len(reports)
+
+        added = []
+        rows = []
+        with self._lock:
+            fd = self._segment_fd(segment)
+            # Several server processes append to the same segment; the
+            # index is checked and updated under the same lock, so that
+            # two of them can't both archive a report.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                records = []
+                pos = os.fstat(fd).st_size
+                for cluster_id, report_stamp, _ in reports:
+                    blob = blobs.pop((cluster_id, report_stamp), None)
+                    if blob is None or self.locate(cluster_id, report_stamp) is not None:
+                        added.append(False)
+                        continue
+                    added.append(True)
+                    header, blob = encode_record(cluster_id, report_stamp, blob)
+                    records.append(header + blob)
+                    rows.append((cluster_id, report_stamp, segment, pos + len(header), len(blob)))
+                    pos += len(header) + len(blob)
+                view = memoryview(b''.join(records))
+                while view:
+                    n = os.write(fd, view)
+                    view = view[n:]
+                with self.db:
+                    self.db.executemany(
+                        'INSERT OR IGNORE INTO report (cluster_id, report_stamp, segment, offset, length) VALUES (?,?,?,?,?)',
+                        rows)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return added
+
+    def _index(self, cluster_id, report_stamp, segment, offset, length):
+        with self.db:
+            self.db.execute(
+                'INSERT OR IGNORE INTO report (cluster_id, report_stamp, segment, offset, length) VALUES (?,?,?,?,?)',
+                (cluster_id, report_stamp, segment, offset, length))
+
+    def locate(self, cluster_id, report_stamp):
+        return self.db.execute(
+            'SELECT segment, offset, length FROM report WHERE cluster_id = ? AND report_stamp = ?',
+            (cluster_id, report_stamp)).fetchone()
+
+    def read_at(self, segment, offset, length):
+        with open(os.path.join(self.directory, segment + SEGMENT_SUFFIX), 'rb') as f:
+            return archive.decompress(os.pread(f.fileno(), length, offset))
+
+    def get(self, cluster_id, report_stamp):
+        '''
+        Return the JSON bytes of one report, or None.
+        '''
+        loc = self.locate(cluster_id, report_stamp)
+        if loc is None:
+            return None
+        return self.read_at(*loc)
+
+    def history(self, cluster_id, since=None, until=None):
+        '''
+        Yield (report_stamp, JSON bytes) for one cluster, oldest first.
+        '''
+        sql = 'SELECT report_stamp, segment, offset, length FROM report WHERE cluster_id = ?'
+        args = [cluster_id]
+        if since is not None:
+            sql += ' AND report_stamp >= ?'
+            args.append(since)
+        if until is not None:
+            sql += ' AND report_stamp < ?'
+            args.append(until)
+        rows = self.db.execute(sql + ' ORDER BY report_stamp', args).fetchall()
+        for stamp, segment, offset, length in rows:
+            yield stamp, self.read_at(segment, offset, length)
+
+    def scan(self):
+        '''
+        Yield (cluster_id, report_stamp, JSON bytes) for the whole
+        archive, segment by segment, reading each segment sequentially.
+        '''
+        for segment in self.segments():
+            for cluster_id, report_stamp, _, blob in self.read_segment(segment):
+                yield cluster_id, report_stamp, archive.decompress(blob)
+
+    def sample(self, count):
+        '''
+        Return the JSON bytes of up to `count` random reports.
+        '''
+        rows = self.db.execute(
+            'SELECT segment, offset, length FROM report ORDER BY random() LIMIT ?',
+            (count,)).fetchall()
+        random.shuffle(rows)
+        return [self.read_at(*row) for row in rows]
+
+    def segments(self):
+        return sorted(f[:-len(SEGMENT_SUFFIX)] for f in os.listdir(self.directory)
+                      if f.endswith(SEGMENT_SUFFIX))
+
+    def read_segment(self, segment):
+        '''
+        Yield (cluster_id, report_stamp, blob offset, blob) for every
+        intact record of a segment.  Torn records (crash mid-append),
+        wherever they are, are skipped.
+        '''
+        with open(os.path.join(self.directory, segment + SEGMENT_SUFFIX), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos < size:
+                record = _decode_record(f, pos, size)
+                if record is None:
+                    skip_to = _next_magic(f, pos + 1, size)
+                    logging.warning(f"segment {segment}: skipped {skip_to - pos} bytes of a torn record at offset {pos}")
+                    pos = skip_to
+                    continue
+                yield record
+                pos = record[2] + len(record[3])
+
+    def reindex(self, segment):
+        '''
+        Index every record of a segment, e.g. after a crash between a
+        segment append and its index insert.  Returns the number of
+        records that were missing from the index.
+        '''
+        added = 0
+        for cluster_id, report_stamp, offset, blob in self.read_segment(segment):
+            if self.locate(cluster_id, report_stamp) is None:
+                self._index(cluster_id, report_stamp, segment, offset, len(blob))
+                added += 1
+        return added
+
+
+_archive = None
+_archive_pid = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    '''
+    Return the process-wide segment archive.
+    '''
+    global _archive, _archive_pid
+    pid = os.getpid()
+    if _archive is None or _archive_pid != pid:
+        with _archive_lock:
+            if _archive is None or _archive_pid != pid:
+                _archive = SegmentArchive()
+                _archive_pid = pid
+    return _archive
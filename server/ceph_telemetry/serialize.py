@@ -0,0 +1,38 @@
+import json
+import re
+
+# orjson is several times faster than the stdlib encoder on large
+# reports; it is optional and we fall back to json when it's missing.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    '''
+    Encode obj as compact UTF-8 JSON bytes.  orjson refuses integers
+    wider than 64 bits, which a report may legitimately contain, so
+    those fall back to the stdlib encoder.
+    '''
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+# A \u0000 escape that isn't itself an escaped backslash followed by "u0000"
+_NUL_ESCAPE = re.compile(rb'(?<!\\)((?:\\\\)*)\\u0000')
+
+
+def strip_nul(data):
+    r'''
+    Replace \u0000 escapes in encoded JSON with spaces.  Postgres can't
+    store NUL in text or jsonb, and crash assert messages sometimes
+    contain it.
+    '''
+    if b'\\u0000' not in data:
+        return data
+    return _NUL_ESCAPE.sub(rb'\1 ', data)
@@ -0,0 +1,242 @@
+'''
+Hash sharding of public.report and public.device_report over several
+Postgres instances.
+
+Shards are listed in SHARDS_FILE, one per line: a shard number and a
+DSN.  Reports are placed by cluster_id and device reports by device_id
+on a consistent hash ring, so adding a shard only moves about 1/N of
+the keys (see rebalance_shards.py).  Everything else, including the
+crash and dashboard tables, stays in the primary database
+(db.load_dsn()).  Without SHARDS_FILE there is a single shard, the
+primary database, and nothing changes.
+
+Ids must stay unique across shards, because the importers keep
+report ids in the primary database: each shard's id sequences count
+in steps of SHARD_SLOTS starting at the shard number (see
+db_shard_setup.sql), so an id tells which shard assigned it.  Rows
+keep their id when they are moved to another shard.
+'''
+import bisect
+import hashlib
+import heapq
+import os
+import threading
+
+import psycopg2
+import psycopg2.extras
+
+from ceph_telemetry import db, metrics
+
+SHARDS_FILE = os.environ.get('TELEMETRY_SHARDS_FILE', '/opt/telemetry/shards.conf')
+# Most shards there can ever be; also the step of the id sequences
+SHARD_SLOTS = 16
+# Points per shard on the ring
+VNODES = 256
+
+
+def load_shards(path=SHARDS_FILE):
+    '''
+    Return {shard number: DSN}, or None if there is no shard file.
+    '''
+    if not os.path.isfile(path):
+        return None
+    shards = {}
+    with open(path, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            number, _, dsn = line.partition(' ')
+            if not number.isdigit() or int(number) >= SHARD_SLOTS or not dsn.strip():
+                raise ValueError(f"{path}:{lineno}: expected '<shard number below {SHARD_SLOTS}> <dsn>'")
+            if int(number) in shards:
+                raise ValueError(f"{path}:{lineno}: shard {number} is listed twice")
+            shards[int(number)] = dsn.strip()
+    if not shards:
+        raise ValueError(f"{path}: no shards")
+    return shards
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing(object):
+    def __init__(self, shards, vnodes=VNODES):
+        points = sorted((_hash(f"{shard}-{i}"), shard) for shard in shards for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._shards = [s for _, s in points]
+
+    def shard_for(self, key):
+        i = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._shards[i % len(self._shards)]
+
+
+class ShardRouter(object):
+    def __init__(self, shards=None):
+        # None: unsharded, everything is in the primary database
+        self.shards = shards
+        self.sharded = shards is not None
+        self.ring = HashRing(shards if self.sharded else [0])
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def shard_for(self, key):
+        return self.ring.shard_for(key)
+
+    def pool(self, shard):
+        if not self.sharded:
+            return db.get_pool()
+        with self._lock:
+            pool = self._pools.get(shard)
+            if pool is None:
+                # A pool of its own even for the primary database:
+                # shard writes happen while a primary connection is held.
+                pool = self._pools[shard] = db.ConnectionPool(self.shards[shard])
+            return pool
+
+    def connection(self, key):
+        '''
+        Borrow a connection to the shard of key.
+        '''
+        return self.pool(self.shard_for(key)).connection()
+
+    def group(self, items, key):
+        '''
+        Return {shard: [item, ...]}, placing items by key(item).
+        '''
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard_for(key(item)), []).append(item)
+        return groups
+
+    def write(self, cur, items, key, func):
+        '''
+        Call func(cursor, items) for the items of each shard and return
+        the results.  Unsharded, func runs once on cur, in the caller's
+        transaction.  Otherwise every shard is written and committed
+        separately, so func must be idempotent: a failure after some
+        shards committed is retried as a whole.
+        '''
+        if not self.sharded:
+            return [func(cur, items)]
+        results = []
+        for shard, group in self.group(items, key).items():
+            with self.pool(shard).connection() as conn:
+                shard_cur = conn.cursor()
+                results.append(func(shard_cur, group))
+                conn.commit()
+                shard_cur.close()
+        return results
+
+
+_router = None
+_router_pid = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router, _router_pid
+    pid = os.getpid()
+    if _router is None or _router_pid != pid:
+        with _router_lock:
+            if _router is None or _router_pid != pid:
+                _router = ShardRouter(load_shards())
+                _router_pid = pid
+    return _router
+
+
+def _shard_pool_samples():
+    if _router is None:
+        return []
+    with _router._lock:
+        pools = list(_router._pools.items())
+    return [((str(shard), stat), value) for shard, pool in pools for stat, value in pool.stats().items()]
+
+
+SHARD_POOL_STATS = metrics.Gauge(
+    'telemetry_shard_pool',
+    'Connection pool size, utilization and wait times per shard',
+    ('shard', 'stat'),
+    callback=_shard_pool_samples)
+
+
+# Readers for the importers, which run outside the server with their
+# own connections.
+
+def connect_all(primary):
+    '''
+    Return {shard: connection}: the primary connection when unsharded,
+    otherwise a new connection to every shard.
+    '''
+    shards = load_shards()
+    if shards is None:
+        return {0: primary}
+    return {shard: psycopg2.connect(dsn) for shard, dsn in shards.items()}
+
+
+def watermarks(cur, table, column):
+    '''
+    Return the highest id already imported into table.column, per
+    shard that assigned it ({None: id} when unsharded).
+    '''
+    shards = load_shards()
+    if shards is None:
+        cur.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {table}")
+        return {None: cur.fetchone()[0]}
+    marks = {}
+    for shard in shards:
+        cur.execute(f"SELECT {column} FROM {table} WHERE {column} %% %s = %s ORDER BY {column} DESC LIMIT 1",
+                    (SHARD_SLOTS, shard))
+        row = cur.fetchone()
+        marks[shard] = row[0] if row else 0
+    return marks
+
+
+def after(marks, column='id'):
+    '''
+    Return (SQL condition, params) selecting the ids past marks.
+    '''
+    if None in marks:
+        return f"{column} > %s", [marks[None]]
+    terms = []
+    params = []
+    for shard, mark in sorted(marks.items()):
+        terms.append(f"({column} %% %s = %s AND {column} > %s)")
+        params.extend((SHARD_SLOTS, shard, mark))
+    return '(' + ' OR '.join(terms) + ')', params
+
+
+class MergedCursor(object):
+    '''
+    Iterates over the rows of per-shard cursors ordered by key, merged.
+    '''
+    def __init__(self, cursors, key):
+        self.cursors = cursors
+        self.key = key
+
+    def __iter__(self):
+        return heapq.merge(*self.cursors, key=lambda row: row[self.key])
+
+    def close(self):
+        for cur in self.cursors:
+            cur.close()
+
+
+def gather(conns, query, params=(), key='id', itersize=10):
+    '''
+    Run query, which must be ordered by key, on every shard with
+    server-side cursors, and return a MergedCursor over the results.
+    '''
+    cursors = []
+    try:
+        for shard, conn in conns.items():
+            cur = conn.cursor(name=f"gather_{shard}", withhold=True,
+                              cursor_factory=psycopg2.extras.DictCursor)
+            cur.itersize = itersize
+            cur.execute(query, params)
+            cursors.append(cur)
+    except Exception:
+        MergedCursor(cursors, key).close()
+        raise
+    return MergedCursor(cursors, key)
@@ -0,0 +1,441 @@
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import psycopg2
+
+from ceph_telemetry import db, metrics
+
+# 'direct' writes every upload to the database inside the request;
+# 'spool' appends it to a local journal that is drained in the background.
+INGEST_MODE = os.environ.get('TELEMETRY_INGEST_MODE', 'direct')
+SPOOL_DIR = os.environ.get('TELEMETRY_SPOOL_DIR', '/opt/telemetry/spool')
+
+# Start a new journal file once the active one grows past this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Appends arriving within this window share a single fsync
+FSYNC_INTERVAL = 0.01
+# Upper bounds for a single drain transaction
+BATCH_RECORDS = 500
+BATCH_BYTES = 32 * 1024 * 1024
+DRAIN_INTERVAL = 0.5
+# After a failed batch wait RETRY_INTERVAL, doubling on every further
+# failure up to MAX_RETRY_INTERVAL
+RETRY_INTERVAL = 5
+MAX_RETRY_INTERVAL = 300
+# How often to look for journals left behind by dead processes
+ORPHAN_SCAN_INTERVAL = 30
+# A batch that failed this many times for reasons other than an
+# unreachable database is written one record at a time, and the records
+# that still fail are moved to the dead-letter file
+MAX_ATTEMPTS = 5
+
+JOURNAL_SUFFIX = '.jnl'
+# Records that could not be stored, framed as in journals, with the
+# error added to their meta header
+DEAD_LETTER = 'dead-letter'
+
+# Failures that say nothing about the records themselves
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, db.PoolTimeout, OSError)
+
+# Every record is: payload length, crc32 of payload, payload.
+# The payload is a one-line JSON meta header, '\n', then the body.
+_HEADER = struct.Struct('>II')
+
+# kind -> callable(cursor, [(meta, body), ...]), see register_handler()
+HANDLERS = {}
+
+
+def enabled():
+    return INGEST_MODE == 'spool'
+
+
+def register_handler(kind, handler):
+    '''
+    Register the function that writes a batch of spooled records of
+    the given kind.  It runs inside the drain transaction and must be
+    idempotent, since a batch is replayed if we crash before the
+    journal offset is persisted.  It may return a callable, which is
+    called once the transaction has been committed.
+    '''
+    HANDLERS[kind] = handler
+
+
+def encode_record(meta, body):
+    payload = json.dumps(meta).encode('utf-8') + b'\n' + body
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload):
+    meta, body = payload.split(b'\n', 1)
+    return json.loads(meta), body
+
+
+class CorruptJournal(Exception):
+    pass
+
+
+class Journal(object):
+    '''
+    An append-only journal file and its committed-offset sidecar.  The
+    file is flock()ed by the process that owns it for as long as it
+    exists, which is how other processes tell live journals from ones
+    that need to be replayed.
+    '''
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.synced = self.size
+        self.offset = self._load_offset()
+        self.sealed = False
+
+    @classmethod
+    def create(cls, directory):
+        path = os.path.join(directory, f"{os.getpid()}.{time.time_ns()}{JOURNAL_SUFFIX}")
+        # Locked under a name _adopt_orphans() skips, then renamed: under
+        # its final name, an unlocked journal would be taken for a
+        # drained orphan and removed.
+        tmp = path + '.new'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(tmp, path)
+        return cls(path, fd)
+
+    @classmethod
+    def adopt(cls, path):
+        '''
+        Take over a journal whose owner died. Returns None if it is
+        still owned or was removed while we were looking at it.
+        '''
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_APPEND)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except (BlockingIOError, FileNotFoundError):
+            os.close(fd)
+            return None
+        journal = cls(path, fd)
+        journal.sealed = True
+        return journal
+
+    @property
+    def offset_path(self):
+        return self.path + '.offset'
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def commit_offset(self, offset):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.offset_path)
+        self.offset = offset
+
+    def append(self, record):
+        view = memoryview(record)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        self.size += len(record)
+
+    def read(self, start, end, max_records, max_bytes):
+        '''
+        Return ([(meta, body), ...], next_offset) for the complete
+        records between start and end.  A short or corrupt record at
+        the end of a sealed journal is a torn write and ends the journal.
+        '''
+        records = []
+        pos = start
+        nbytes = 0
+        while pos < end and len(records) < max_records and nbytes < max_bytes:
+            header = os.pread(self.fd, _HEADER.size, pos)
+            if len(header) < _HEADER.size:
+                break
+            length, crc = _HEADER.unpack(header)
+            payload = os.pread(self.fd, length, pos + _HEADER.size)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                if pos + _HEADER.size + length < end:
+                    raise CorruptJournal(f"{self.path}: bad record at offset {pos}")
+                break
+            records.append(decode_payload(payload))
+            pos += _HEADER.size + length
+            nbytes += length
+        return records, pos
+
+    def remove(self):
+        for path in (self.offset_path, self.path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        os.close(self.fd)
+
+
+class Spool(object):
+    '''
+    Durable local queue in front of Postgres.
+
+    append() returns once the record has been fsynced to the journal;
+    concurrent appends are grouped into one fsync.  A background thread
+    drains journals into the database in batches, persisting the
+    journal offset after each commit, and replays journals left behind
+    by processes that died.
+    '''
+    def __init__(self, directory=SPOOL_DIR, handlers=None):
+        self.directory = directory
+        self.handlers = HANDLERS if handlers is None else handlers
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._dirty = threading.Event()
+        self._active = Journal.create(directory)
+        # Our own rotated journals plus adopted ones, oldest first
+        self._sealed = []
+        self._last_scan = 0
+
+        self.appended = 0
+        self.drained = 0
+        self.batches = 0
+        self.errors = 0
+        self.dead_lettered = 0
+        self.fsyncs = 0
+
+        self._adopt_orphans()
+        for target in (self._flush_loop, self._drain_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    def append(self, kind, meta, body):
+        self.append_many(kind, [(meta, body)])
+
+    def append_many(self, kind, items):
+        '''
+        Append [(meta, body), ...] and wait for a single fsync covering
+        all of them.
+        '''
+        records = b''.join(encode_record(dict(meta, kind=kind), body) for meta, body in items)
+        with self._lock:
+            journal = self._active
+            journal.append(records)
+            target = journal.size
+            self.appended += len(items)
+            self._dirty.set()
+            while journal.synced < target:
+                self._synced.wait()
+
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(FSYNC_INTERVAL)
+            with self._lock:
+                self._dirty.clear()
+                journal = self._active
+                size = journal.size
+            os.fsync(journal.fd)
+            with self._lock:
+                self.fsyncs += 1
+                journal.synced = max(journal.synced, size)
+                if journal.size >= SEGMENT_SIZE:
+                    self._rotate()
+                self._synced.notify_all()
+
+    def _rotate(self):
+        old = self._active
+        if old.synced < old.size:
+            os.fsync(old.fd)
+            old.synced = old.size
+        old.sealed = True
+        self._sealed.append(old)
+        self._active = Journal.create(self.directory)
+
+    def _adopt_orphans(self):
+        self._last_scan = time.monotonic()
+        with self._lock:
+            known = {j.path for j in self._sealed}
+            known.add(self._active.path)
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(JOURNAL_SUFFIX) or path in known:
+                continue
+            journal = Journal.adopt(path)
+            if journal is not None:
+                logging.info(f"replaying spool journal {path} from offset {journal.offset}")
+                with self._lock:
+                    self._sealed.insert(0, journal)
+
+    def _next_batch(self):
+        '''
+        Pick the oldest journal with pending records.  Fully drained
+        sealed journals are removed on the way.
+        '''
+        while True:
+            with self._lock:
+                journal = self._sealed[0] if self._sealed else self._active
+                end = journal.synced
+            try:
+                records, next_offset = journal.read(journal.offset, end, BATCH_RECORDS, BATCH_BYTES)
+            except CorruptJournal as e:
+                logging.error(f"{e}; moving it aside")
+                os.rename(journal.path, journal.path + '.corrupt')
+                records, next_offset = [], end
+                journal.offset = end
+            if records or not journal.sealed:
+                return journal, records, next_offset
+            with self._lock:
+                self._sealed.remove(journal)
+            journal.remove()
+
+    def _drain_loop(self):
+        retry = RETRY_INTERVAL
+        # (journal, offset) of the batch that is failing, and how often
+        failing = None
+        attempts = 0
+        while True:
+            if time.monotonic() - self._last_scan > ORPHAN_SCAN_INTERVAL:
+                self._adopt_orphans()
+            journal, records, next_offset = self._next_batch()
+            if not records:
+                time.sleep(DRAIN_INTERVAL)
+                continue
+            batch = (journal.path, journal.offset)
+            try:
+                if batch == failing and attempts >= MAX_ATTEMPTS:
+                    self._write_each(records)
+                else:
+                    self._write(records)
+            except Exception as e:
+                logging.exception(f"failed to drain {len(records)} records from {journal.path}, retrying in {retry} seconds")
+                with self._lock:
+                    self.errors += 1
+                if not isinstance(e, TRANSIENT_ERRORS):
+                    attempts = attempts + 1 if batch == failing else 1
+                    failing = batch
+                time.sleep(retry)
+                retry = min(retry * 2, MAX_RETRY_INTERVAL)
+                continue
+            retry = RETRY_INTERVAL
+            failing = None
+            attempts = 0
+            journal.commit_offset(next_offset)
+            with self._lock:
+                self.drained += len(records)
+                self.batches += 1
+
+    def _write(self, records):
+        '''
+        Store a batch of records; raising leaves them in the journal
+        to be retried.  Subclasses can send them elsewhere.
+        '''
+        by_kind = {}
+        for meta, body in records:
+            by_kind.setdefault(meta['kind'], []).append((meta, body))
+        committed = []
+        with db.connection() as conn:
+            cur = conn.cursor()
+            for kind, items in by_kind.items():
+                callback = self.handlers[kind](cur, items)
+                if callback is not None:
+                    committed.append(callback)
+            conn.commit()
+            cur.close()
+        for callback in committed:
+            callback()
+
+    def _write_each(self, records):
+        '''
+        Write records one at a time and move the ones that fail to the
+        dead-letter file.  A transient failure raises, leaving them all
+        to be retried; records already written are written again then,
+        which the handlers allow for.
+        '''
+        dead = []
+        for meta, body in records:
+            try:
+                self._write([(meta, body)])
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logging.exception(f"moving a spooled {meta.get('kind')} record to {DEAD_LETTER}")
+                dead.append((dict(meta, error=repr(e)), body))
+        if dead:
+            self._dead_letter(dead)
+
+    def _dead_letter(self, records):
+        path = os.path.join(self.directory, DEAD_LETTER)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            # shared by the processes of this spool directory
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = memoryview(b''.join(encode_record(meta, body) for meta, body in records))
+            while data:
+                n = os.write(fd, data)
+                data = data[n:]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self._lock:
+            self.dead_lettered += len(records)
+
+    def stats(self):
+        with self._lock:
+            journals = self._sealed + [self._active]
+            return {
+                'backlog_bytes': sum(j.synced - j.offset for j in journals),
+                'backlog_journals': len(journals),
+                'appended': self.appended,
+                'drained': self.drained,
+                'batches': self.batches,
+                'errors': self.errors,
+                'dead_lettered': self.dead_lettered,
+                'fsyncs': self.fsyncs,
+            }
+
+
+_spool = None
+_spool_pid = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    '''
+    Return the process-wide spool, creating it (and its background
+    threads) on first use in this process.
+    '''
+    global _spool, _spool_pid
+    pid = os.getpid()
+    if _spool is None or _spool_pid != pid:
+        with _spool_lock:
+            if _spool is None or _spool_pid != pid:
+                _spool = Spool()
+                _spool_pid = pid
+    return _spool
+
+
+def _spool_samples():
+    if _spool is None:
+        return []
+    return [((stat,), value) for stat, value in _spool.stats().items()]
+
+
+SPOOL_STATS = metrics.Gauge(
+    'telemetry_spool',
+    'Spool backlog depth and throughput',
+    ('stat',),
+    callback=_spool_samples)
@@ -0,0 +1,99 @@
+import decimal
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ceph_telemetry import aggregates
+from ceph_telemetry.aggregates import AggregateCache, parse_args
+
+
+class FakeCursor(object):
+    '''
+    Just enough of dashboard.cache_generation, dashboard.cache and one
+    dashboard function to run AggregateCache.get().
+    '''
+    def __init__(self):
+        self.generations = {'dashboard': 1}
+        self.shared = {}
+        self.calls = 0
+        self.description = None
+        self._result = None
+
+    def execute(self, sql, params=()):
+        if sql.startswith('SELECT schema_name'):
+            self._result = list(self.generations.items())
+        elif sql.startswith('SELECT result'):
+            row = self.shared.get(tuple(params))
+            self._result = [row] if row else []
+        elif sql.startswith('INSERT INTO dashboard.cache'):
+            self.shared[tuple(params[:3])] = tuple(params[3:])
+        else:
+            self.calls += 1
+            self.description = [('total',)]
+            self._result = [(decimal.Decimal(42),)]
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def close(self):
+        pass
+
+
+def test_parse_args():
+    values = parse_args('dashboard.capacity_by_version', {
+        'time_from': ['1700000000000'],
+        'time_to': ['2023-11-20T10:00:00Z'],
+        'display': ['Major'],
+        'major': ['18', '17', '18'],
+    })
+    assert(values == ('2023-11-14T00:00:00+00:00', '2023-11-21T00:00:00+00:00', 'Major', ['17', '18'], []))
+    with pytest.raises(ValueError):
+        parse_args('dashboard.nope', {})
+    with pytest.raises(ValueError):
+        parse_args('dashboard.osd_count_dsw', {'time_from': ['yesterday'], 'time_to': ['0']})
+    with pytest.raises(ValueError):
+        parse_args('dashboard.osd_count', {'extra': ['1']})
+
+
+def test_cache_levels():
+    cur = FakeCursor()
+    cache = AggregateCache(generation_ttl=0)
+    data = cache.get(cur, 'dashboard.osd_count', ())
+    assert(json.loads(data)['rows'] == [[42]])
+    assert(cache.get(cur, 'dashboard.osd_count', ()) == data)
+    assert(cur.calls == 1)
+
+    # another process finds the result in the shared table
+    assert(AggregateCache().get(cur, 'dashboard.osd_count', ()) == data)
+    assert(cur.calls == 1)
+
+    # an import bumps the generation
+    cur.generations['dashboard'] = 2
+    cache.get(cur, 'dashboard.osd_count', ())
+    assert(cur.calls == 2)
+    assert(len(cache._entries) == 1)
+
+
+def test_warm_calls():
+    calls = dict(aggregates.warm_calls('dashboard'))
+    assert(calls['dashboard.osd_count'] == ())
+    assert(len(calls['dashboard.active_clusters_dsw']) == 2)
+    assert('dashboard.capacity_by_version' not in calls)
+    assert('dashboard_device.get_class' not in calls)
+
+
+def test_importable_without_the_server():
+    # the nightly importers refresh the cache; they must not load the
+    # REST server, which logs to a file they can't write
+    code = ('import logging, sys\n'
+            'from ceph_telemetry import aggregates, crashes, shards\n'
+            'assert "ceph_telemetry.rest" not in sys.modules\n'
+            'assert not logging.getLogger().handlers\n')
+    server = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', code], cwd=server, check=True)
@@ -0,0 +1,27 @@
+from ceph_telemetry import create_app, create_internal_app
+
+
+def test_internal_endpoints_are_not_public():
+    public = create_app(__name__).test_client()
+    assert(public.get('/metrics').status_code == 404)
+    internal = create_internal_app(__name__).test_client()
+    assert(internal.get('/metrics').status_code == 200)
+
+
+def test_stored_reports_are_not_public():
+    public = create_app(__name__).test_client()
+    assert(public.get('/report/a/latest?path=osd.count').status_code == 404)
+
+
+def test_stored_reports_are_internal():
+    internal = create_internal_app(__name__).test_client()
+    # routed: a missing path argument is refused before querying anything
+    assert(internal.get('/report/a/latest').status_code == 400)
+
+
+def test_dashboard_is_internal():
+    public = create_app(__name__).test_client()
+    assert(public.get('/dashboard/dashboard.osd_count').status_code == 404)
+    internal = create_internal_app(__name__).test_client()
+    # routed: unexpected arguments are refused before querying anything
+    assert(internal.get('/dashboard/dashboard.osd_count?x=1').status_code == 400)
@@ -0,0 +1,79 @@
+import gzip
+import io
+import json
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from ceph_telemetry import body
+from ceph_telemetry.encoding import DecompressMiddleware
+
+app = Flask(__name__)
+
+
+def read(data, max_size, **kwargs):
+    with app.test_request_context('/', method='PUT', data=data, **kwargs):
+        return body.read_json('test', max_size)
+
+
+def status(data, max_size, **kwargs):
+    try:
+        read(data, max_size, **kwargs)
+    except HTTPException as e:
+        return e.code
+    return 200
+
+
+def test_read_json():
+    assert(read(json.dumps({'a': 1}), 100) == {'a': 1})
+
+
+def test_content_length_over_limit():
+    before = body.REJECTED.value('test', 'too_large')
+    assert(status('x' * 101, 100) == 413)
+    assert(body.REJECTED.value('test', 'too_large') == before + 1)
+
+
+def test_stream_over_limit():
+    # No Content-Length: the cap is enforced while reading
+    data = json.dumps({'a': 'b' * 200}).encode()
+    assert(status(None, 100,
+                  input_stream=io.BytesIO(data),
+                  headers={'Transfer-Encoding': 'chunked'},
+                  environ_base={'wsgi.input_terminated': True}) == 413)
+
+
+def test_invalid_json():
+    assert(status('{"a": ', 100) == 400)
+
+
+def decoded(data, encoding, max_size):
+    environ = EnvironBuilder(method='PUT', data=data,
+                             headers={'Content-Encoding': encoding}).get_environ()
+    result = {}
+
+    def resource(environ, start_response):
+        with app.request_context(environ):
+            try:
+                result['json'] = body.read_json('test', max_size)
+            except HTTPException as e:
+                result['code'] = e.code
+        return []
+
+    DecompressMiddleware(resource, ('/',))(environ, None)
+    return result
+
+
+def test_gzip_body():
+    data = gzip.compress(json.dumps({'a': 1}).encode())
+    assert(decoded(data, 'gzip', 100) == {'json': {'a': 1}})
+
+
+def test_gzip_bomb():
+    # 10 MB of zeros compress to ~10 KB; the cap applies after decompression
+    data = gzip.compress(b'0' * 10000000)
+    assert(len(data) < 100000)
+    assert(decoded(data, 'gzip', 100000) == {'code': 413})
+
+
+def test_bad_gzip():
+    assert(decoded(b'not gzip at all', 'gzip', 100) == {'code': 400})
@@ -0,0 +1,97 @@
+import hashlib
+
+import psycopg2
+import psycopg2.extras
+
+from ceph_telemetry import crashes
+from ceph_telemetry.crashes import CrashFilter, calc_sig, new_crash_rows, remember, sanitize_assert_msg
+
+BACKTRACE = [
+    '(()+0x12730) [0x7f0b5d8a3730]',
+    '(gsignal()+0x10b) [0x7f0b5d3867bb]',
+    '(ceph::__ceph_assert_fail(char const*, char const*, int, char const*)+0x1a3) [0x55d7c5b1c2d3]',
+]
+ASSERT_MSG = ('/build/ceph/src/osd/PG.cc: In function \'void PG::foo()\' thread 7f0b4a1f2700 '
+              'time 2020-01-01 00:00:00.000000\n/build/ceph/src/osd/PG.cc: 123: FAILED ceph_assert(x)\n')
+
+
+def crash(crash_id):
+    return {'crash_id': crash_id, 'backtrace': BACKTRACE, 'assert_msg': ASSERT_MSG,
+            'timestamp': '2020-01-01 00:00:00.000000Z', 'entity_name': 'osd.1'}
+
+
+def test_calc_sig_ignores_offsets_and_thread():
+    sig = hashlib.sha256()
+    for func in ('()', 'gsignal()', 'ceph::__ceph_assert_fail(char const*, char const*, int, char const*)'):
+        sig.update(func.encode())
+    sig.update(("/build/ceph/src/osd/PG.cc: In function 'void PG::foo()'"
+                ": FAILED ceph_assert(x)").encode())
+    assert(calc_sig(BACKTRACE, ASSERT_MSG) == sig.hexdigest())
+    other = [line.replace('0x1a3', '0x1b0') for line in BACKTRACE]
+    assert(calc_sig(other, ASSERT_MSG.replace('7f0b4a1f2700', '7f0b4a1f2800')) == sig.hexdigest())
+
+
+def test_filter_persists(tmp_path):
+    path = str(tmp_path / 'filter')
+    known = CrashFilter(path, capacity=1000, error_rate=0.001)
+    known.add('a')
+    known.close()
+    known = CrashFilter(path, capacity=1000, error_rate=0.001)
+    assert('a' in known)
+    assert('b' not in known)
+    # different parameters start over
+    known = CrashFilter(path, capacity=2000, error_rate=0.001)
+    assert('a' not in known)
+
+
+def test_new_crash_rows(tmp_path):
+    known = CrashFilter(str(tmp_path / 'filter'), capacity=1000, error_rate=0.001)
+    report = {'report_id': 'c1', 'crashes': [crash('a'), crash('a'), crash('b'), {'backtrace': []}]}
+    rows = new_crash_rows(report, known)
+    assert([row[0] for row in rows] == ['a', 'b'])
+    assert(rows[0][1] == 'c1')
+    assert(rows[0][6] == calc_sig(BACKTRACE, ASSERT_MSG))
+
+    remember(rows[:1], known)
+    assert([row[0] for row in new_crash_rows(report, known)] == ['b'])
+
+
+def test_sanitize_assert_msg():
+    assert(sanitize_assert_msg(ASSERT_MSG) == ("/build/ceph/src/osd/PG.cc: In function 'void PG::foo()'"
+                                               ": FAILED ceph_assert(x)"))
+    # messages not in the ceph_assert format are kept whole instead of failing
+    assert(sanitize_assert_msg('abort') == 'abort')
+    assert(sanitize_assert_msg('') == '')
+    assert(calc_sig(BACKTRACE, 'abort') != calc_sig(BACKTRACE, 'other abort'))
+
+
+def test_new_crash_rows_fit_the_columns(tmp_path):
+    known = CrashFilter(str(tmp_path / 'filter'), capacity=1000, error_rate=0.001)
+    odd = dict(crash('a'), entity_name='osd.' + 'x' * 100, ceph_version=['16.2.0'], timestamp='yesterday')
+    row, = new_crash_rows({'report_id': 'c1', 'crashes': [odd]}, known)
+    assert(row[3] is None)
+    assert(len(row[4]) == crashes.MAX_ENTITY_NAME)
+    assert(row[5] == '["16.2.0"]')
+    row, = new_crash_rows({'report_id': 'c1', 'crashes': [crash('b')]}, known)
+    assert(row[3] == '2020-01-01T00:00:00')
+
+
+class FakeCursor(object):
+    def execute(self, sql):
+        pass
+
+
+def test_insert_isolates_clusters(monkeypatch):
+    inserted = []
+
+    def execute_values(cur, sql, rows):
+        if any(row[0] == 'poison' for row in rows):
+            raise psycopg2.DataError('bad crash')
+        inserted.extend(row[0] for row in rows)
+
+    monkeypatch.setattr(psycopg2.extras, 'execute_values', execute_values)
+    rows = [('a', 'c1'), ('poison', 'c2'), ('b', 'c2'), ('c', 'c3')]
+    assert(crashes.insert(FakeCursor(), rows) == [('a', 'c1'), ('c', 'c3')])
+    assert(inserted == ['a', 'c'])
+    assert(crashes.insert(FakeCursor(), rows[1:3]) == [])
+    assert(crashes.insert(FakeCursor(), []) == [])
@@ -0,0 +1,28 @@
+import gc
+import weakref
+
+from ceph_telemetry import db
+
+
+class FakePool(object):
+    def __init__(self, dsn):
+        self.dsn = dsn
+
+
+def test_pool_inherited_across_fork_is_kept(monkeypatch):
+    monkeypatch.setattr(db, 'ConnectionPool', FakePool)
+    monkeypatch.setattr(db, 'load_dsn', lambda: 'dbname=telemetry')
+    monkeypatch.setattr(db, '_pool', None)
+    monkeypatch.setattr(db, '_inherited_pools', [])
+    monkeypatch.setattr(db.os, 'getpid', lambda: 100)
+    parent = db.get_pool()
+    assert(db.get_pool() is parent)
+    ref = weakref.ref(parent)
+    del parent
+
+    monkeypatch.setattr(db.os, 'getpid', lambda: 101)
+    child = db.get_pool()
+    gc.collect()
+    assert(child is not ref() and ref() is not None)
+    assert(db._inherited_pools == [ref()])
+    assert(db.get_pool() is child)
@@ -0,0 +1,21 @@
+from ceph_telemetry.dedup import RecentKeys
+
+
+def test_recent_keys():
+    keys = RecentKeys(size=2)
+    keys.add(('a', '1'))
+    keys.add(('b', '1'))
+    assert(('a', '1') in keys)
+    assert(('c', '1') not in keys)
+
+
+def test_recent_keys_evicts_least_recently_used():
+    keys = RecentKeys(size=2)
+    keys.add('a')
+    keys.add('b')
+    # a lookup refreshes 'a', so 'b' is the one evicted
+    assert('a' in keys)
+    keys.add('c')
+    assert('a' in keys)
+    assert('b' not in keys)
+    assert(len(keys) == 2)
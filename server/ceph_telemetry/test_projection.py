@@ -0,0 +1,43 @@
+import pytest
+from ceph_telemetry import projection
+
+REPORT = {
+    'osd': {'count': 3},
+    'pools': [{'pool': 1, 'pg_num': 32}, {'pool': 2, 'pg_num': 64}],
+    'crashes': [{'crash_id': 'a', 'backtrace': ['f()']}, {'crash_id': 'b'}],
+}
+
+
+def test_parse_path():
+    assert(projection.parse_path('osd.count') == ['osd', 'count'])
+    assert(projection.parse_path('pools[*].pg_num') == ['pools', '*', 'pg_num'])
+    assert(projection.parse_path('crashes[0].backtrace[1]') == ['crashes', 0, 'backtrace', 1])
+    for bad in ('', 'a.', '.a', 'a..b', '[0]', 'a[x]', 'a[0]b'):
+        with pytest.raises(ValueError):
+            projection.parse_path(bad)
+
+
+def test_project():
+    assert(projection.project(REPORT, ['osd.count', 'pools[*].pg_num', 'crashes[*].crash_id', 'crashes[0].backtrace', 'nope', 'osd[*]']) == {
+        'osd.count': 3,
+        'pools[*].pg_num': [32, 64],
+        'crashes[*].crash_id': ['a', 'b'],
+        'crashes[0].backtrace': ['f()'],
+        'nope': None,
+        'osd[*]': [],
+    })
+
+
+def test_to_jsonpath():
+    steps = projection.parse_path('pools[*].pg_num')
+    assert(projection.to_jsonpath(steps) == 'strict $."pools"[*]."pg_num"')
+    assert(projection.to_jsonpath(['a"b']) == 'strict $."a\\"b"')
+
+
+def test_cache_is_bounded():
+    cache = projection.ProjectionCache(max_bytes=10)
+    cache.put('a', 1, 6)
+    cache.put('b', 2, 6)
+    assert(cache.get('a') is None)
+    assert(cache.get('b') == 2)
+    assert(cache.size == 6)
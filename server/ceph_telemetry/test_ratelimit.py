@@ -0,0 +1,99 @@
+import ipaddress
+import os
+import tempfile
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+from ceph_telemetry import body, ratelimit
+
+app = Flask(__name__)
+
+
+def limiter(rate=0.001, burst=2):
+    path = os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite')
+    return ratelimit.RateLimiter(path, {'report': (rate, burst)})
+
+
+def test_token_bucket():
+    rl = limiter()
+    assert(rl.acquire('report', 'a') == 0)
+    assert(rl.acquire('report', 'a') == 0)
+    assert(rl.acquire('report', 'a') > 0)
+    # other clusters have their own bucket
+    assert(rl.acquire('report', 'b') == 0)
+
+
+def test_shared_between_processes():
+    rl = limiter()
+    other = ratelimit.RateLimiter(rl.path, rl.limits)
+    rl.acquire('report', 'a')
+    other.acquire('report', 'a')
+    assert(rl.acquire('report', 'a') > 0)
+
+
+def test_offenders():
+    rl = limiter(burst=1)
+    for _ in range(5):
+        rl.acquire('report', 'a')
+    rl.acquire('report', 'b')
+    rl.acquire('report', 'b')
+    assert(rl.offenders() == [('report', 'a', 4), ('report', 'b', 1)])
+
+
+def test_limited_before_parsing(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'ENABLED', True)
+    monkeypatch.setattr(ratelimit, '_limiter', limiter(burst=1))
+    monkeypatch.setattr(ratelimit, '_limiter_pid', os.getpid())
+    codes = []
+    for _ in range(2):
+        # not valid JSON: a 400 would mean it was parsed
+        with app.test_request_context('/', method='PUT', data='{"report_id": "a", '):
+            try:
+                body.read_json('report', 1000, ratelimit.check_report_head)
+            except HTTPException as e:
+                codes.append(e.get_response().status_code)
+    assert(codes == [400, 429])
+
+
+def test_head_report_id():
+    assert(ratelimit.head_report_id(b'{"report_timestamp": "t", "report_id": "a", "x": 1') == 'a')
+    # nested decoys don't count
+    assert(ratelimit.head_report_id(b'{"x": {"report_id": "b"}, "y": ["report_id"], "report_id": "a"}') == 'a')
+    assert(ratelimit.head_report_id(b'{"x": "\\"report_id\\": \\"b\\"", "report_id": "a"}') == 'a')
+    assert(ratelimit.head_report_id(b'{"x": {"report_id": "b"}') is None)
+    # which one the parser keeps is its business
+    assert(ratelimit.head_report_id(b'{"report_id": "b", "report_id": "a"}') is None)
+
+
+def test_limited_by_parsed_report_id(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'ENABLED', True)
+    rl = limiter(burst=1)
+    monkeypatch.setattr(ratelimit, '_limiter', rl)
+    monkeypatch.setattr(ratelimit, '_limiter_pid', os.getpid())
+    rl.acquire('report', 'a')
+    # a report whose head doesn't give its report_id away is still checked
+    data = '{"report_id": "a", "report_id": "a"}'
+    with app.test_request_context('/', method='PUT', data=data):
+        report = body.read_json('report', 1000, ratelimit.check_report_head)
+        try:
+            ratelimit.check_report(report)
+            code = None
+        except HTTPException as e:
+            code = e.get_response().status_code
+    assert(code == 429)
+
+
+def test_offenders_metric_hides_keys(monkeypatch):
+    rl = limiter(burst=1)
+    monkeypatch.setattr(ratelimit, '_limiter', rl)
+    rl.acquire('report', 'secret-cluster')
+    rl.acquire('report', 'secret-cluster')
+    text = '\n'.join(ratelimit.OFFENDERS.render())
+    assert('secret-cluster' not in text)
+    assert(ratelimit.offender_key('secret-cluster') in text)
+
+
+def test_device_exempt(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'DEVICE_EXEMPT', [ipaddress.ip_network('10.1.0.0/16')])
+    assert(ratelimit.device_key('10.1.2.3') is None)
+    assert(ratelimit.device_key('10.2.2.3') == '10.2.2.3')
+    assert(ratelimit.device_key('::1') == '::1')
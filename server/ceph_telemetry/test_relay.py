@@ -0,0 +1,175 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+from ceph_telemetry import relay, spool
+
+
+class StubUpstream(object):
+    '''
+    Stands in for the telemetry server; fails the first `failures` puts,
+    and answers puts to the paths in `statuses` with their status, or
+    with what status(lines) returns: a status or (status, response).
+    '''
+    def __init__(self, failures=0, statuses=None):
+        self.failures = failures
+        self.statuses = statuses or {}
+        self.puts = []
+
+    def put(self, path, data, headers):
+        if self.failures:
+            self.failures -= 1
+            return 503, None
+        lines = gzip.decompress(data).splitlines()
+        if path in self.statuses:
+            status = self.statuses[path]
+            if callable(status):
+                status = status([json.loads(line) for line in lines])
+            if isinstance(status, tuple):
+                if status[0] == 200:
+                    self.puts.append((path, [json.loads(line) for line in lines]))
+                return status
+            return status, None
+        self.puts.append((path, [json.loads(line) for line in lines]))
+        return 200, {'status': True}
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return predicate()
+
+
+def client(upstream, **kwargs):
+    r = relay.Relay(upstream, tempfile.mkdtemp(), **kwargs)
+    return r, relay.create_app(__name__, r).test_client()
+
+
+def test_forwards_reports_in_batches():
+    upstream = StubUpstream()
+    r, c = client(upstream)
+    for i in range(3):
+        report = {'report_id': str(i), 'report_timestamp': '2026-01-01T00:00:00'}
+        assert(c.put('/report', data=json.dumps(report)).status_code == 200)
+    assert(c.put('/device', data=json.dumps({'dev': {}})).status_code == 200)
+    assert(wait_for(lambda: r.stats()['drained'] == 4))
+    reports = [report['report_id'] for path, batch in upstream.puts if path == '/reports' for report in batch]
+    assert(sorted(reports) == ['0', '1', '2'])
+    assert(('/device', [{'dev': {}}]) in upstream.puts)
+
+
+def test_dedupes_reports():
+    upstream = StubUpstream()
+    r, c = client(upstream)
+    report = json.dumps({'report_id': 'a', 'report_timestamp': '2026-01-01T00:00:00'})
+    c.put('/report', data=report)
+    c.put('/report', data=report)
+    assert(r.stats()['appended'] == 1)
+
+
+def test_retries_while_upstream_is_down(monkeypatch):
+    monkeypatch.setattr(relay.spool, 'RETRY_INTERVAL', 0.01)
+    upstream = StubUpstream(failures=2)
+    r, c = client(upstream)
+    c.put('/report', data=json.dumps({'report_id': 'a', 'report_timestamp': 't'}))
+    assert(wait_for(lambda: upstream.puts))
+    assert(r.stats()['errors'] == 2)
+    assert(r.stats()['dead_lettered'] == 0)
+
+
+def test_refuses_uploads_when_queue_is_full():
+    upstream = StubUpstream(failures=1000)
+    r, c = client(upstream, max_queue_bytes=0)
+    c.put('/report', data=json.dumps({'report_id': 'a', 'report_timestamp': 't'}))
+    assert(c.put('/report', data=json.dumps({'report_id': 'b', 'report_timestamp': 't'})).status_code == 503)
+
+
+def dead_letters(r):
+    path = os.path.join(r.directory, spool.DEAD_LETTER)
+    fd = os.open(path, os.O_RDONLY)
+    records, _ = spool.Journal(path, fd).read(0, 1 << 20, 10, 1 << 20)
+    os.close(fd)
+    return records
+
+
+def put_reports(c, n):
+    for i in range(n):
+        report = {'report_id': str(i), 'report_timestamp': '2026-01-01T00:00:00'}
+        assert(c.put('/report', data=json.dumps(report)).status_code == 200)
+
+
+def test_falls_back_to_single_reports_without_bulk_endpoint():
+    upstream = StubUpstream(statuses={'/reports': 404})
+    r, c = client(upstream)
+    put_reports(c, 3)
+    assert(wait_for(lambda: r.stats()['drained'] == 3))
+    assert(sorted(batch[0]['report_id'] for path, batch in upstream.puts if path == '/report') == ['0', '1', '2'])
+    assert(not r.bulk)
+    assert(r.stats()['dead_lettered'] == 0)
+
+
+def test_splits_batches_the_upstream_finds_too_large():
+    # the upstream takes one report per batch at most
+    upstream = StubUpstream(statuses={'/reports': lambda lines: 413 if len(lines) > 1 else 200})
+    r, c = client(upstream)
+    put_reports(c, 3)
+    assert(wait_for(lambda: r.stats()['drained'] == 3))
+    assert(sorted(batch[0]['report_id'] for _, batch in upstream.puts) == ['0', '1', '2'])
+    assert(r.bulk)
+
+
+def test_sends_oversize_reports_on_their_own(monkeypatch):
+    monkeypatch.setattr(relay, 'UPSTREAM_BATCH_BYTES', 100)
+    upstream = StubUpstream()
+    r, c = client(upstream)
+    report = {'report_id': 'big', 'report_timestamp': '2026-01-01T00:00:00', 'pad': 'x' * 100}
+    assert(c.put('/report', data=json.dumps(report)).status_code == 200)
+    assert(wait_for(lambda: r.stats()['drained'] == 1))
+    assert(upstream.puts == [('/report', [report])])
+
+
+def test_dead_letters_rejected_uploads():
+    upstream = StubUpstream(statuses={'/device': 400})
+    r, c = client(upstream)
+    assert(c.put('/device', data=json.dumps({'dev': {}})).status_code == 200)
+    put_reports(c, 1)
+    assert(wait_for(lambda: r.stats()['drained'] == 2))
+    assert(r.stats()['dead_lettered'] == 1)
+    records = dead_letters(r)
+    assert([(meta['kind'], json.loads(gzip.decompress(member))) for meta, member in records] ==
+           [('device', {'dev': {}})])
+    assert('400' in records[0][0]['error'])
+    # the reports behind it were forwarded
+    assert([path for path, _ in upstream.puts] == ['/reports'])
+
+
+def test_dead_letters_uploads_the_upstream_fails_on(monkeypatch):
+    monkeypatch.setattr(relay.spool, 'RETRY_INTERVAL', 0.01)
+    monkeypatch.setattr(relay.spool, 'MAX_ATTEMPTS', 2)
+    poison = lambda reports: 500 if any(r['report_id'] == '1' for r in reports) else (200, {'status': True})
+    upstream = StubUpstream(statuses={'/reports': poison})
+    r, c = client(upstream)
+    put_reports(c, 3)
+    assert(wait_for(lambda: r.stats()['drained'] == 3))
+    assert(sorted(report['report_id'] for _, batch in upstream.puts for report in batch) == ['0', '2'])
+    records = dead_letters(r)
+    assert([json.loads(gzip.decompress(member))['report_id'] for _, member in records] == ['1'])
+    assert('500' in records[0][0]['error'])
+
+
+def test_dead_letters_reports_the_upstream_finds_invalid():
+    def results(reports):
+        return 200, {'status': True, 'results': [
+            {'status': 'invalid', 'error': 'malformed report'} if r['report_id'] == '1' else
+            {'status': 'rate_limited', 'retry_after': 600} if r['report_id'] == '2' else {'status': 'stored'}
+            for r in reports]}
+    upstream = StubUpstream(statuses={'/reports': results})
+    r, c = client(upstream)
+    put_reports(c, 3)
+    assert(wait_for(lambda: r.stats()['drained'] == 3))
+    records = dead_letters(r)
+    assert([json.loads(gzip.decompress(member))['report_id'] for _, member in records] == ['1', '2'])
+    assert('malformed report' in records[0][0]['error'])
+    assert('rate_limited' in records[1][0]['error'])
@@ -0,0 +1,113 @@
+import json
+import os
+import uuid
+
+import pytest
+
+from ceph_telemetry import create_app, ratelimit
+from ceph_telemetry.rest import reports
+from ceph_telemetry.rest.reports import Reports
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    '''
+    Stands in for the archive and the database: collects the stored
+    reports, and reports the ones listed in stored['existing'] as
+    already in the database.
+    '''
+    stored = {'archived': [], 'inserted': [], 'existing': set()}
+
+    def post_to_file(self, batch):
+        stored['archived'].extend(key for key, _ in batch)
+
+    def post_to_postgres(self, batch, crash_rows):
+        new = {i for i, (key, _) in batch.items() if key not in stored['existing']}
+        stored['inserted'].extend(batch[i][0] for i in sorted(new))
+        return new
+
+    monkeypatch.setattr(Reports, 'post_to_file', post_to_file)
+    monkeypatch.setattr(Reports, 'post_to_postgres', post_to_postgres)
+    return stored
+
+
+def upload(lines):
+    client = create_app(__name__).test_client()
+    return client.put('/reports', data='\n'.join(lines))
+
+
+def report(cluster_id, stamp='2024-01-02T03:04:05.123456'):
+    return json.dumps({'report_id': cluster_id, 'report_timestamp': stamp})
+
+
+def test_mixed_valid_and_invalid(stored):
+    cluster = str(uuid.uuid4())
+    response = upload([
+        report(cluster),
+        '{not json',
+        report(cluster, 'yesterday'),
+        json.dumps({'report_id': cluster}),
+        json.dumps([1, 2]),
+        report(cluster, '2024-01-02T03:04:06'),
+    ])
+    assert(response.status_code == 200)
+    results = response.get_json()['results']
+    assert([r['status'] for r in results] == ['stored', 'invalid', 'invalid', 'invalid', 'invalid', 'stored'])
+    assert(all('error' in r for r in results[1:5]))
+    assert('error' not in results[0])
+    # only the valid reports reach the archive and the database
+    assert(stored['archived'] == [(cluster, '2024-01-02T03:04:05.123456'), (cluster, '2024-01-02T03:04:06')])
+    assert(stored['inserted'] == stored['archived'])
+
+
+def test_duplicates(stored):
+    cluster = str(uuid.uuid4())
+    stored['existing'].add((cluster, '2024-01-01T00:00:00'))
+    response = upload([report(cluster), report(cluster), report(cluster, '2024-01-01T00:00:00')])
+    assert([r['status'] for r in response.get_json()['results']] == ['stored', 'duplicate', 'duplicate'])
+
+    # a retry of the whole batch is answered from the recently stored keys
+    before = len(stored['archived'])
+    response = upload([report(cluster)])
+    assert([r['status'] for r in response.get_json()['results']] == ['duplicate'])
+    assert(len(stored['archived']) == before)
+
+
+def test_size_caps(stored, monkeypatch):
+    monkeypatch.setattr(reports, 'MAX_BATCH_REPORTS', 2)
+    response = upload([report(str(uuid.uuid4())) for _ in range(3)])
+    assert(response.status_code == 413)
+
+    monkeypatch.setattr(reports, 'MAX_BATCH_SIZE', 100)
+    response = upload([report(str(uuid.uuid4())) for _ in range(2)])
+    assert(response.status_code == 413)
+    assert(stored['archived'] == [])
+
+
+def test_malformed_reports_fail_alone(stored):
+    cluster = str(uuid.uuid4())
+    stamp = '2024-01-02T03:04:05'
+    response = upload([
+        json.dumps({'report_id': cluster, 'report_timestamp': stamp, 'crashes': [1]}),
+        json.dumps({'report_id': cluster, 'report_timestamp': stamp,
+                    'crashes': [{'crash_id': 'c1', 'entity_name': 5}]}),
+        report(cluster, stamp),
+    ])
+    assert(response.status_code == 200)
+    results = response.get_json()['results']
+    assert([r['status'] for r in results] == ['invalid', 'invalid', 'stored'])
+    assert(all('error' in r for r in results[:2]))
+    assert(stored['archived'] == [(cluster, stamp)])
+
+
+def test_rate_limited_per_report(stored, tmp_path, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'ENABLED', True)
+    limiter = ratelimit.RateLimiter(str(tmp_path / 'ratelimit.sqlite'), {'report': (0.001, 1)})
+    monkeypatch.setattr(ratelimit, '_limiter', limiter)
+    monkeypatch.setattr(ratelimit, '_limiter_pid', os.getpid())
+    cluster, other = str(uuid.uuid4()), str(uuid.uuid4())
+    response = upload([report(cluster), report(cluster, '2024-01-02T03:04:06'), report(other)])
+    results = response.get_json()['results']
+    assert([r['status'] for r in results] == ['stored', 'rate_limited', 'stored'])
+    assert(results[1]['retry_after'] > 0)
+    assert(len(stored['archived']) == 2)
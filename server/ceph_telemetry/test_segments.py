@@ -0,0 +1,75 @@
+import datetime
+import os
+
+import pytest
+
+from ceph_telemetry import archive, segments
+from ceph_telemetry.segments import SEGMENT_SUFFIX, SegmentArchive
+
+DAY = datetime.date(2024, 1, 2)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # compress without a trained dictionary
+    monkeypatch.setattr(archive, 'DICT_DIR', str(tmp_path / 'dicts'))
+    monkeypatch.setitem(archive._current, 'checked', 0)
+    return SegmentArchive(str(tmp_path / 'segments'))
+
+
+def segment_path(store):
+    return os.path.join(store.directory, DAY.isoformat() + SEGMENT_SUFFIX)
+
+
+def test_append_and_read(store):
+    assert(store.append_many([('c1', 's1', b'{"a": 1}'), ('c1', 's2', b'{"a": 2}'), ('c1', 's1', b'{"a": 1}')],
+                             day=DAY) == [True, True, False])
+    assert(store.append('c1', 's1', b'{"a": 1}', day=DAY) is False)
+    assert(store.get('c1', 's2') == b'{"a": 2}')
+    assert(store.get('c1', 's3') is None)
+    assert(list(store.history('c1')) == [('s1', b'{"a": 1}'), ('s2', b'{"a": 2}')])
+    assert(list(store.scan()) == [('c1', 's1', b'{"a": 1}'), ('c1', 's2', b'{"a": 2}')])
+
+
+def test_torn_record_mid_segment(store):
+    store.append('c1', 's1', b'{"a": 1}', day=DAY)
+    # another process died halfway through its append...
+    header, blob = segments.encode_record('c2', 's1', archive.compress(b'{"b": 1}'))
+    with open(segment_path(store), 'ab') as f:
+        f.write(header + blob[:len(blob) // 2])
+    # ...and the others go on appending after it
+    store.append('c3', 's1', b'{"c": 1}', day=DAY)
+
+    assert(list(store.scan()) == [('c1', 's1', b'{"a": 1}'), ('c3', 's1', b'{"c": 1}')])
+    assert(store.get('c3', 's1') == b'{"c": 1}')
+
+
+def test_corrupt_record_mid_segment(store):
+    store.append_many([('c1', 's1', b'{"a": 1}'), ('c2', 's1', b'{"b": 1}'), ('c3', 's1', b'{"c": 1}')], day=DAY)
+    _, offset, length = store.locate('c2', 's1')
+    with open(segment_path(store), 'r+b') as f:
+        f.seek(offset + length // 2)
+        f.write(b'\xff\xff')
+    assert([key for key, _, _ in store.scan()] == ['c1', 'c3'])
+
+
+def test_reindex(store):
+    store.append_many([('c1', 's1', b'{"a": 1}'), ('c2', 's1', b'{"b": 1}')], day=DAY)
+    with open(segment_path(store), 'ab') as f:
+        f.write(segments.MAGIC + b'\x00')
+    with store.db:
+        store.db.execute('DELETE FROM report WHERE cluster_id = ?', ('c2',))
+    assert(store.reindex(DAY.isoformat()) == 1)
+    assert(store.reindex(DAY.isoformat()) == 0)
+    assert(store.get('c2', 's1') == b'{"b": 1}')
+
+
+def test_read_v1_records(store):
+    # records written before the checksum was added
+    blob = archive.compress(b'{"a": 1}')
+    record = segments._HEADER_V1.pack(segments.MAGIC_V1, 2, 2, len(blob)) + b'c1s1' + blob
+    with open(segment_path(store), 'wb') as f:
+        f.write(record)
+    assert(list(store.scan()) == [('c1', 's1', b'{"a": 1}')])
+    assert(store.reindex(DAY.isoformat()) == 1)
+    assert(store.get('c1', 's1') == b'{"a": 1}')
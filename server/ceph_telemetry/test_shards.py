@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+
+from ceph_telemetry.shards import HashRing, ShardRouter, after, load_shards
+
+
+def test_load_shards(tmp_path):
+    path = tmp_path / 'shards.conf'
+    assert(load_shards(str(path)) is None)
+    path.write_text('# number dsn\n0 host=db0 dbname=telemetry\n\n3 host=db3 dbname=telemetry\n')
+    assert(load_shards(str(path)) == {0: 'host=db0 dbname=telemetry', 3: 'host=db3 dbname=telemetry'})
+    path.write_text('16 host=db16\n')
+    with pytest.raises(ValueError):
+        load_shards(str(path))
+
+
+def test_ring_moves_keys_only_to_new_shard():
+    keys = [f"cluster-{i}" for i in range(10000)]
+    before = HashRing([0, 1, 2])
+    after_add = HashRing([0, 1, 2, 3])
+    moved = 0
+    for key in keys:
+        old, new = before.shard_for(key), after_add.shard_for(key)
+        if old != new:
+            assert(new == 3)
+            moved += 1
+    # about a quarter of the keys
+    assert(1500 < moved < 3500)
+
+
+def test_after():
+    assert(after({None: 7}) == ('id > %s', [7]))
+    sql, params = after({0: 32, 1: 17})
+    assert(sql == '((id %% %s = %s AND id > %s) OR (id %% %s = %s AND id > %s))')
+    assert(params == [16, 0, 32, 16, 1, 17])
+
+
+class FakePool(object):
+    def __init__(self):
+        self.commits = 0
+        self.borrowed = 0
+
+    @contextmanager
+    def connection(self):
+        pool = self
+
+        class Conn(object):
+            def cursor(self):
+                return self
+
+            def commit(self):
+                pool.commits += 1
+
+            def close(self):
+                pass
+
+        self.borrowed += 1
+        yield Conn()
+
+
+def test_router_write():
+    rows = [(f"cluster-{i}", i) for i in range(100)]
+    unsharded = ShardRouter()
+    assert(unsharded.write('cur', rows, lambda row: row[0], lambda cur, items: (cur, len(items))) == [('cur', 100)])
+
+    router = ShardRouter({0: 'dbname=a', 1: 'dbname=b'})
+    router._pools = {0: FakePool(), 1: FakePool()}
+    results = router.write(None, rows, lambda row: row[0], lambda cur, items: len(items))
+    assert(len(results) == 2 and sum(results) == 100)
+    assert(router._pools[0].commits == 1 and router._pools[1].commits == 1)
+
+
+def sharded_router():
+    router = ShardRouter({0: 'dbname=a', 1: 'dbname=b', 2: 'dbname=c'})
+    router._pools = {0: FakePool(), 1: FakePool(), 2: FakePool()}
+    return router
+
+
+def test_router_write_groups_by_shard():
+    router = sharded_router()
+    rows = [f"cluster-{i}" for i in range(100)]
+    written = {}
+
+    def func(cur, items):
+        for item in items:
+            written.setdefault(item, []).append(cur)
+        return items
+
+    results = router.write(None, rows, lambda row: row, func)
+    assert(sorted(row for result in results for row in result) == sorted(rows))
+    # every row was written once, on the connection of its shard
+    for row in rows:
+        assert(len(written[row]) == 1)
+    for result in results:
+        assert(len({router.shard_for(row) for row in result}) == 1)
+    # the ring the importers build from the shard numbers places rows the same way
+    ring = HashRing({0: None, 1: None, 2: None})
+    assert(all(ring.shard_for(row) == router.shard_for(row) for row in rows))
+
+
+def test_router_write_failure():
+    router = sharded_router()
+    rows = [f"cluster-{i}" for i in range(100)]
+    groups = router.group(rows, lambda row: row)
+    failing = list(groups)[1]
+
+    def func(cur, items):
+        if router.shard_for(items[0]) == failing:
+            raise psycopg2.OperationalError('shard is down')
+        return len(items)
+
+    with pytest.raises(psycopg2.OperationalError):
+        router.write(None, rows, lambda row: row, func)
+    # the shards written before the failure committed, the failing one
+    # didn't, and the ones after it weren't written
+    commits = {shard: pool.commits for shard, pool in router._pools.items()}
+    order = list(groups)
+    assert(commits[order[0]] == 1)
+    assert(commits[failing] == 0)
+    assert(all(commits[shard] == 0 and router._pools[shard].borrowed == 0 for shard in order[2:]))
@@ -0,0 +1,90 @@
+import os
+import time
+
+import psycopg2
+
+from ceph_telemetry import spool
+from ceph_telemetry.spool import DEAD_LETTER, JOURNAL_SUFFIX, Journal, Spool
+
+
+class FakeSpool(Spool):
+    '''
+    Writes to a list instead of the database; a body of b'poison'
+    always fails, and fail_transient makes every write fail as if the
+    database were down.
+    '''
+    def __init__(self, directory):
+        self.written = []
+        self.fail_transient = False
+        super(FakeSpool, self).__init__(directory, handlers={})
+
+    def _write(self, records):
+        if self.fail_transient:
+            raise psycopg2.OperationalError('database is down')
+        if any(body == b'poison' for _, body in records):
+            raise ValueError('poison record')
+        self.written.extend(body for _, body in records)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert(time.monotonic() < deadline)
+        time.sleep(0.01)
+
+
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(spool, 'RETRY_INTERVAL', 0.01)
+    monkeypatch.setattr(spool, 'DRAIN_INTERVAL', 0.01)
+    monkeypatch.setattr(spool, 'MAX_ATTEMPTS', 2)
+
+
+def test_poison_record_is_dead_lettered(tmp_path, monkeypatch):
+    fast_retries(monkeypatch)
+    s = FakeSpool(str(tmp_path))
+    s.append_many('report', [({}, b'one'), ({}, b'poison'), ({}, b'two')])
+    wait_for(lambda: s.written == [b'one', b'two'])
+    s.append('report', {}, b'three')
+    wait_for(lambda: s.written[-1:] == [b'three'])
+
+    stats = s.stats()
+    assert(stats['dead_lettered'] == 1)
+    assert(stats['errors'] == 2)
+    fd = os.open(str(tmp_path / DEAD_LETTER), os.O_RDONLY)
+    records, _ = Journal(str(tmp_path / DEAD_LETTER), fd).read(0, 1 << 20, 10, 1 << 20)
+    os.close(fd)
+    assert([body for _, body in records] == [b'poison'])
+    assert(records[0][0]['kind'] == 'report')
+    assert('poison record' in records[0][0]['error'])
+
+
+def test_transient_failures_are_retried(tmp_path, monkeypatch):
+    fast_retries(monkeypatch)
+    s = FakeSpool(str(tmp_path))
+    s.fail_transient = True
+    s.append('device', {}, b'one')
+    wait_for(lambda: s.stats()['errors'] > 2 * spool.MAX_ATTEMPTS)
+    s.fail_transient = False
+    wait_for(lambda: s.written == [b'one'])
+    assert(s.stats()['dead_lettered'] == 0)
+    assert(not (tmp_path / DEAD_LETTER).exists())
+
+
+def test_journal_is_locked_before_it_is_visible(tmp_path, monkeypatch):
+    # what another process scanning for orphans sees when the new
+    # journal gets locked
+    seen = []
+    flock = spool.fcntl.flock
+
+    def watching_flock(fd, op):
+        seen.extend(name for name in os.listdir(str(tmp_path)) if name.endswith(JOURNAL_SUFFIX))
+        return flock(fd, op)
+
+    monkeypatch.setattr(spool.fcntl, 'flock', watching_flock)
+    journal = Journal.create(str(tmp_path))
+    assert(seen == [])
+    assert(os.listdir(str(tmp_path)) == [os.path.basename(journal.path)])
+    monkeypatch.setattr(spool.fcntl, 'flock', flock)
+    # and it is taken for a live journal
+    assert(Journal.adopt(journal.path) is None)
+    os.close(journal.fd)
@@ -0,0 +1,48 @@
+import datetime
+
+import pytest
+
+from dbhelper import BulkWriter, _copy_field
+
+
+def test_copy_field():
+    assert(_copy_field(None) == '')
+    assert(_copy_field('') == '""')
+    assert(_copy_field('a "b", c\nd') == '"a ""b"", c\nd"')
+    assert(_copy_field(True) == 't' and _copy_field(False) == 'f')
+    assert(_copy_field(3) == '3' and _copy_field(1.5) == '1.5')
+    assert(_copy_field(datetime.datetime(2024, 1, 2, 3, 4, 5, 6)) == '2024-01-02T03:04:05.000006')
+    assert(_copy_field(datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)) == '2024-01-02T00:00:00+00:00')
+    assert(_copy_field(datetime.date(2024, 1, 2)) == '2024-01-02')
+    with pytest.raises(TypeError):
+        _copy_field({'a': 1})
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.copied = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, buf):
+        self.copied.append((sql, buf.read()))
+
+    def close(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_bulk_writer_copy():
+    conn = FakeConn()
+    writer = BulkWriter(conn, batch_size=10, method='copy')
+    ts = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    writer.insert('device_smart', {'ts': ts, 'device_id': 'd"1', 'vendor': None, 'ok': True})
+    writer.insert('device_smart', {'ts': ts, 'device_id': '', 'vendor': 'v', 'ok': False})
+    writer.commit()
+    assert(conn.copied == [('COPY device_smart (ts,device_id,vendor,ok) FROM STDIN WITH (FORMAT csv)',
+                            '2024-01-02T03:04:05,"d""1",,t\n2024-01-02T03:04:05,"","v",f\n')])
+    assert(writer.rows == {'device_smart': 2} and conn.commits == 1)
@@ -0,0 +1,26 @@
+import gzip
+import json
+import os
+
+import raw_archive
+from ceph_telemetry import archive, segments
+
+
+def test_pack_sets_unreadable_files_aside(tmp_path, monkeypatch, capsys):
+    # compress without a trained dictionary
+    monkeypatch.setattr(archive, 'DICT_DIR', str(tmp_path / 'dicts'))
+    monkeypatch.setitem(archive._current, 'checked', 0)
+    store = segments.SegmentArchive(str(tmp_path / 'segments'))
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    report = json.dumps({'report_id': 'c1', 'report_timestamp': '2024-01-02T03:04:05'}).encode()
+    (raw / 'good').write_bytes(gzip.compress(report))
+    (raw / 'truncated').write_bytes(gzip.compress(report)[:20])
+    (raw / 'not-json').write_bytes(b'{"report_id": ')
+    (raw / 'no-key').write_bytes(b'[1]')
+
+    raw_archive.pack(store, str(raw), delete=True)
+    assert(store.get('c1', '2024-01-02T03:04:05') == report)
+    assert(sorted(os.listdir(str(raw))) == [raw_archive.UNPACKABLE])
+    assert(sorted(os.listdir(str(raw / raw_archive.UNPACKABLE))) == ['no-key', 'not-json', 'truncated'])
+    assert('Packed 1 reports, skipped 3' in capsys.readouterr().out)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# vim: ts=4 sw=4 expandtab
+'''
+Compare grafana.weekly_reports_sliding and device.weekly_reports_sliding,
+which the importers update incrementally, with their full recomputation
+(see db_create_weekly_reports_sliding.sql). Windows after the last update
+are not compared.
+
+    ./verify_weekly_reports_sliding.py
+    ./verify_weekly_reports_sliding.py --schema device --repair
+
+Exits with 1 if a table differs and was not repaired.
+'''
+import argparse
+import sys
+import time
+
+import psycopg2
+
+# Data Source Name file
+DSN = '/opt/telemetry/grafana.dsn'
+
+# schema -> columns of its weekly_reports_sliding
+SCHEMAS = {
+    'grafana': 'daily_window, report_id',
+    'device': 'daily_window, report_id, device_id, error',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the weekly_reports_sliding tables with a full recomputation')
+    parser.add_argument('--dsn', default=DSN, help='file with the DSN to connect with')
+    parser.add_argument('--schema', choices=sorted(SCHEMAS), action='append',
+                        help='only this schema (repeatable; default all)')
+    parser.add_argument('--show', type=int, default=10, help='differing rows to print')
+    parser.add_argument('--repair', action='store_true',
+                        help='rebuild a table that differs from scratch')
+    return parser.parse_args()
+
+
+def compare(conn, schema, show):
+    '''
+    Return the number of rows missing from and extra in the table.
+    '''
+    columns = SCHEMAS[schema]
+    cur = conn.cursor()
+    start = time.monotonic()
+    cur.execute(f"""WITH upto AS (
+                        SELECT MAX(daily_window) AS daily_window FROM {schema}.weekly_reports_sliding
+                    ),
+                    recomputed AS (
+                        SELECT {columns} FROM {schema}.weekly_reports_sliding_full()
+                        WHERE daily_window <= (SELECT daily_window FROM upto)
+                    ),
+                    incremental AS (
+                        SELECT {columns} FROM {schema}.weekly_reports_sliding
+                    )
+                    SELECT 'missing', * FROM (SELECT * FROM recomputed EXCEPT ALL SELECT * FROM incremental) m
+                    UNION ALL
+                    SELECT 'extra', * FROM (SELECT * FROM incremental EXCEPT ALL SELECT * FROM recomputed) e
+                    ORDER BY 2, 3""")
+    counts = {'missing': 0, 'extra': 0}
+    for row in cur:
+        counts[row[0]] += 1
+        if sum(counts.values()) <= show:
+            print(f"{schema}.weekly_reports_sliding: {row[0]} ({columns}) = {row[1:]}")
+    cur.close()
+    conn.rollback()
+    print(f"{schema}.weekly_reports_sliding: {counts['missing']} rows missing, {counts['extra']} extra "
+          f"(compared in {time.monotonic() - start:.1f} seconds)")
+    return counts['missing'], counts['extra']
+
+
+def repair(conn, schema):
+    cur = conn.cursor()
+    cur.execute(f"TRUNCATE {schema}.weekly_reports_sliding")
+    # an empty table is filled from scratch
+    cur.execute(f"SELECT {schema}.update_weekly_reports_sliding('{{}}')")
+    rows = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    print(f"{schema}.weekly_reports_sliding: rebuilt with {rows} rows")
+
+
+def main():
+    args = parse_args()
+    with open(args.dsn, 'r') as f:
+        dsn_str = f.read().strip()
+    conn = psycopg2.connect(dsn_str)
+
+    ret = 0
+    for schema in args.schema or sorted(SCHEMAS):
+        missing, extra = compare(conn, schema, args.show)
+        if not missing and not extra:
+            continue
+        if args.repair:
+            repair(conn, schema)
+        else:
+            ret = 1
+
+    conn.close()
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
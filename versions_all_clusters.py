@@ -69,7 +69,8 @@ def main():
             ''', (start_date, cur_date))
         versmap = defaultdict(int)
         for cluster_id, report_stamp, report in cur:
-            report = json.loads(report)
+            if isinstance(report, str):
+                report = json.loads(report)
             for (entity_type, info) in report.get('metadata', {}).items():
                 for (version, num) in info.get('ceph_version', {}).items():
                     mo = re.match('ceph version v*([0-9.]+|Dev).*', version)